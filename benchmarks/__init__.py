@@ -0,0 +1,2 @@
+# Copyright 2024 Ableton
+# All rights reserved
@@ -0,0 +1,385 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import argparse
+import http.client
+import itertools
+import json
+import math
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import bcrypt  # type: ignore
+
+from core.dependencies import DatabasePool, ShardedDatabasePool
+from core.schemas import UserIn
+
+ROUTES = ('/register', '/login', '/current-user')
+DEFAULT_MIX = 'register=1,login=4,current-user=15'
+SEED_PASSWORD = 'LoadTest123'
+EMAIL_DOMAIN = 'loadgen.example.com'
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights: Dict[str, float] = {}
+    for item in mix.split(','):
+        if not item.strip():
+            continue
+        name, _, weight = item.partition('=')
+        route = '/' + name.strip().lstrip('/')
+        if route not in ROUTES:
+            raise ValueError(f'Unknown route in mix: {route}')
+        weights[route] = float(weight) if weight.strip() else 1.0
+        if weights[route] < 0:
+            raise ValueError(f'Negative weight for route: {route}')
+
+    if not any(weight > 0 for weight in weights.values()):
+        raise ValueError('Mix must contain at least one route with a positive weight.')
+
+    return {route: weight for route, weight in weights.items() if weight > 0}
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+
+    return sorted_values[rank - 1]
+
+
+class LatencyRecorder:
+    def __init__(self, routes):
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, List[float]] = {route: [] for route in routes}
+        self._errors: Dict[str, int] = {route: 0 for route in routes}
+        self._status_codes: Dict[str, Dict[str, int]] = {route: {} for route in routes}
+
+    def record(self, route: str, latency: float, status: int) -> None:
+        key = str(status) if status else 'connection_error'
+        with self._lock:
+            self._latencies[route].append(latency)
+            codes = self._status_codes[route]
+            codes[key] = codes.get(key, 0) + 1
+            if not status or status >= 400:
+                self._errors[route] += 1
+
+    def summary(self, elapsed: float) -> Dict:
+        with self._lock:
+            routes = {route: self._route_summary(latencies, self._errors[route],
+                                                 self._status_codes[route], elapsed)
+                      for route, latencies in self._latencies.items()}
+            all_latencies = [latency for latencies in self._latencies.values() for latency in latencies]
+            total = self._route_summary(all_latencies, sum(self._errors.values()), {}, elapsed)
+
+        del total['status_codes']
+
+        return {'total': total, 'routes': routes}
+
+    @staticmethod
+    def _route_summary(latencies: List[float], errors: int, status_codes: Dict[str, int], elapsed: float) -> Dict:
+        ordered = sorted(latencies)
+        requests = len(ordered)
+
+        return {'requests': requests,
+                'errors': errors,
+                'error_rate': errors / requests if requests else 0.0,
+                'throughput_rps': requests / elapsed if elapsed > 0 else 0.0,
+                'status_codes': dict(status_codes),
+                'latency_ms': {'mean': sum(ordered) / requests * 1000 if requests else 0.0,
+                               'p50': percentile(ordered, 50) * 1000,
+                               'p95': percentile(ordered, 95) * 1000,
+                               'p99': percentile(ordered, 99) * 1000,
+                               'max': (ordered[-1] if ordered else 0.0) * 1000}}
+
+
+def seed_users(db_path: str, count: int, prefix: str, password: str = SEED_PASSWORD, shards: int = 0) -> List[str]:
+    # Seeded through the same layout the server was started with, so sharded servers find the users on their shard.
+    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    emails = []
+    pool = ShardedDatabasePool(db_path, shard_count=shards) if shards else DatabasePool(db_path)
+    try:
+        with pool.connection() as db, db.transaction():
+            for index in range(count):
+                user_in = UserIn(email=f'{prefix}-{index}@{EMAIL_DOMAIN}',
+                                 first_name='Load',
+                                 last_name='Generator',
+                                 password=password)
+                user_in.password = hashed_password
+                user_id = db.user_repository.insert_user(user_in)
+                db.user_repository.verify_user(id_=user_id)
+                emails.append(user_in.email)
+    finally:
+        pool.clear()
+
+    return emails
+
+
+class LoadClient:
+    def __init__(self, host: str, port: int, timeout: float):
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method: str, path: str, body: Optional[dict] = None,
+                headers: Optional[Dict[str, str]] = None) -> Tuple[int, bytes]:
+        request_headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            request_headers['Content-Type'] = 'application/json'
+        try:
+            self.connection.request(method, path, body=payload, headers=request_headers)
+            response = self.connection.getresponse()
+            content = response.read()
+            if response.will_close:
+                self.connection.close()
+
+            return response.status, content
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            return 0, b''
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+@dataclass
+class LoadOptions:  # pylint: disable=too-many-instance-attributes
+    host: str = 'localhost'
+    port: int = 5000
+    db_path: str = 'ableton_user_management.db'
+    users: int = 50
+    concurrency: int = 8
+    duration: float = 10.0
+    rps: Optional[float] = None
+    mix: str = DEFAULT_MIX
+    timeout: float = 10.0
+    shards: int = 0
+    admin_token: Optional[str] = None
+
+    def client(self) -> LoadClient:
+        return LoadClient(self.host, self.port, self.timeout)
+
+
+class Workload:
+    def __init__(self, mix: Dict[str, float], emails: List[str], tokens: List[str], prefix: str):
+        self.routes = list(mix)
+        self.weights = [mix[route] for route in self.routes]
+        self.emails = emails
+        self.tokens = tokens
+        self.prefix = prefix
+        self._registrations = itertools.count()
+        self._operations: Dict[str, Callable[[LoadClient, random.Random], int]] = {
+            '/register': self._register,
+            '/login': self._login,
+            '/current-user': self._current_user
+        }
+
+    def choose(self, rng: random.Random) -> str:
+        return rng.choices(self.routes, weights=self.weights)[0]
+
+    def execute(self, route: str, client: LoadClient, rng: random.Random) -> int:
+        return self._operations[route](client, rng)
+
+    def _register(self, client: LoadClient, _rng: random.Random) -> int:
+        data = {'email': f'{self.prefix}-new-{next(self._registrations)}@{EMAIL_DOMAIN}',
+                'first_name': 'Load',
+                'last_name': 'Generator',
+                'password': SEED_PASSWORD}
+        status, _ = client.request('POST', '/register', body=data)
+
+        return status
+
+    def _login(self, client: LoadClient, rng: random.Random) -> int:
+        data = {'email': rng.choice(self.emails), 'password': SEED_PASSWORD}
+        status, _ = client.request('POST', '/login', body=data)
+
+        return status
+
+    def _current_user(self, client: LoadClient, rng: random.Random) -> int:
+        status, _ = client.request('GET', '/current-user',
+                                   headers={'Authorization': rng.choice(self.tokens)})
+
+        return status
+
+
+def rebuild_email_filter(options: LoadOptions) -> None:
+    # Users are seeded behind the server's back, so its email filter only knows them once rebuilt; otherwise they
+    # cannot log in before its next periodic refresh.
+    if not options.admin_token:
+        sys.stderr.write('No --admin-token given: seeded users can only log in once the server refreshes its email '
+                         'filter (EMAIL_FILTER_REFRESH_INTERVAL_IN_MINS), unless it runs with EMAIL_FILTER=off.\n')
+        return
+
+    client = options.client()
+    try:
+        status, _ = client.request('POST', '/admin/email-filter/rebuild', body={},
+                                   headers={'Authorization': f'Bearer {options.admin_token}'})
+    finally:
+        client.close()
+    # 404 means the filter is off, so there is nothing to rebuild.
+    if status not in (200, 404):
+        raise RuntimeError(f'Could not rebuild the email filter: HTTP {status}')
+
+
+def acquire_tokens(options: LoadOptions, emails: List[str], count: int) -> List[str]:
+    client = options.client()
+    tokens = []
+    try:
+        for email in emails[:count]:
+            status, content = client.request('POST', '/login', body={'email': email, 'password': SEED_PASSWORD})
+            if status != 200:
+                raise RuntimeError(f'Could not log in seeded user {email}: HTTP {status}')
+            tokens.append(json.loads(content)['data']['access_token'])
+    finally:
+        client.close()
+
+    return tokens
+
+
+def run_closed_loop(workload: Workload, recorder: LatencyRecorder, options: LoadOptions) -> float:
+    deadline = time.perf_counter() + options.duration
+
+    def worker(seed: int) -> None:
+        rng = random.Random(seed)
+        client = options.client()
+        try:
+            while time.perf_counter() < deadline:
+                route = workload.choose(rng)
+                started = time.perf_counter()
+                status = workload.execute(route, client, rng)
+                recorder.record(route, time.perf_counter() - started, status)
+        finally:
+            client.close()
+
+    return _run_workers(worker, options.concurrency)
+
+
+def run_open_loop(workload: Workload, recorder: LatencyRecorder, options: LoadOptions) -> float:
+    schedule: queue.Queue = queue.Queue()
+    rps = options.rps or 1.0
+
+    def worker(seed: int) -> None:
+        rng = random.Random(seed)
+        client = options.client()
+        try:
+            while True:
+                scheduled = schedule.get()
+                if scheduled is None:
+                    return
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                route = workload.choose(rng)
+                status = workload.execute(route, client, rng)
+                # Latency is measured from the scheduled start so that a slow server cannot hide its
+                # queueing delay by slowing down the arrival rate (coordinated omission).
+                recorder.record(route, time.perf_counter() - scheduled, status)
+        finally:
+            client.close()
+
+    def dispatcher() -> None:
+        started = time.perf_counter()
+        for index in range(int(options.duration * rps)):
+            scheduled = started + index / rps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            schedule.put(scheduled)
+        for _ in range(options.concurrency):
+            schedule.put(None)
+
+    threading.Thread(target=dispatcher, daemon=True).start()
+
+    return _run_workers(worker, options.concurrency)
+
+
+def _run_workers(worker: Callable[[int], None], concurrency: int) -> float:
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(seed,), daemon=True) for seed in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - started
+
+
+def run_load_test(options: LoadOptions) -> Dict:
+    weights = parse_mix(options.mix)
+    prefix = f'loadgen-{uuid.uuid4().hex[:8]}'
+
+    emails = seed_users(db_path=options.db_path, count=max(options.users, 1), prefix=prefix, shards=options.shards)
+    rebuild_email_filter(options)
+    tokens = []
+    if '/current-user' in weights:
+        tokens = acquire_tokens(options, emails, count=min(len(emails), options.concurrency))
+
+    workload = Workload(weights, emails, tokens, prefix)
+    recorder = LatencyRecorder(weights)
+    if options.rps:
+        elapsed = run_open_loop(workload, recorder, options)
+    else:
+        elapsed = run_closed_loop(workload, recorder, options)
+
+    report: Dict[str, Any] = {'mode': 'open' if options.rps else 'closed',
+                               'target': f'{options.host}:{options.port}',
+                               'concurrency': options.concurrency,
+                               'target_rps': options.rps,
+                               'seeded_users': len(emails),
+                               'mix': weights,
+                               'elapsed_s': elapsed}
+    report.update(recorder.summary(elapsed))
+    report['throttled'] = sum(route['status_codes'].get('429', 0) for route in report['routes'].values())
+    if report['throttled']:
+        # Every client connects from this host, so a server with rate limiting on soon throttles most logins and
+        # registrations, and the report measures its rate limiter instead.
+        sys.stderr.write(f"{report['throttled']} requests were throttled (429); start the server with "
+                         'RATE_LIMIT_STORE=off for load tests.\n')
+
+    return report
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Drive the user management service with a mixed workload.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--db-path', default='ableton_user_management.db',
+                        help='database used by the target server, for pre-seeding verified users')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='number of shards the target server was started with (0 for a single file)')
+    parser.add_argument('--admin-token', default=None,
+                        help="the server's ADMIN_TOKEN, to rebuild its email filter once users are seeded")
+    parser.add_argument('--users', type=int, default=50, help='number of verified users to pre-seed')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=10.0, help='test duration in seconds')
+    parser.add_argument('--rps', type=float, default=None,
+                        help='fixed arrival rate (open loop); closed loop when omitted')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='comma separated route weights, e.g. "register=1,login=4,current-user=15"')
+    parser.add_argument('--timeout', type=float, default=10.0, help='per request timeout in seconds')
+    parser.add_argument('--output', default=None, help='write the JSON report to this file')
+
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    report = run_load_test(LoadOptions(host=args.host, port=args.port, db_path=args.db_path, users=args.users,
+                                       concurrency=args.concurrency, duration=args.duration, rps=args.rps,
+                                       mix=args.mix, timeout=args.timeout, shards=args.shards,
+                                       admin_token=args.admin_token))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output + '\n')
+    sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = 'import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)'
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def measure_import_time() -> float:
+    output = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET], cwd=ROOT_DIR, check=True,
+                            capture_output=True, text=True).stdout
+
+    return float(output.strip().splitlines()[-1])
+
+
+def _request(port: int, method: str, path: str, body: Optional[dict] = None) -> int:
+    connection = http.client.HTTPConnection('localhost', port, timeout=5)
+    try:
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        connection.request(method, path, body=payload, headers=headers)
+        response = connection.getresponse()
+        response.read()
+
+        return response.status
+    finally:
+        connection.close()
+
+
+def measure_startup(db_path: str, timeout: float = 30.0) -> Dict[str, float]:
+    port = free_port()
+    started = time.perf_counter()
+    with subprocess.Popen([sys.executable, 'main.py', '--port', str(port), '--db-path', db_path],
+                          cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) as process:
+        try:
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f'Server exited during startup with code {process.returncode}')
+                if time.perf_counter() - started > timeout:
+                    raise RuntimeError('Server did not become healthy in time')
+                try:
+                    if _request(port, 'GET', '/health-check') == 200:
+                        break
+                except OSError:
+                    time.sleep(0.005)
+            healthy = time.perf_counter() - started
+
+            request_started = time.perf_counter()
+            _request(port, 'POST', '/login', body={'email': 'startup@example.com', 'password': 'Startup123'})
+            first_request = time.perf_counter() - request_started
+        finally:
+            process.terminate()
+            process.wait()
+
+    return {'time_to_first_healthy_response_s': healthy, 'first_database_request_s': first_request}
+
+
+def _summarize(values: List[float]) -> Dict[str, float]:
+    return {'min': min(values), 'median': statistics.median(values), 'max': max(values)}
+
+
+def run_startup_benchmark(iterations: int = 5) -> Dict:
+    import_times = [measure_import_time() for _ in range(iterations)]
+    startups = []
+    for _ in range(iterations):
+        with tempfile.TemporaryDirectory() as directory:
+            startups.append(measure_startup(os.path.join(directory, 'startup.db')))
+
+    report = {'iterations': iterations, 'import_time_s': _summarize(import_times)}
+    for key in startups[0]:
+        report[key] = _summarize([startup[key] for startup in startups])
+
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Measure import time and time to first healthy response.')
+    parser.add_argument('--iterations', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    sys.stdout.write(json.dumps(run_startup_benchmark(iterations=args.iterations), indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
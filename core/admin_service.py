@@ -0,0 +1,70 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+from typing import Optional
+
+from core.admission import get_admission_controller
+from core.backup import BackupInProgress, get_backup_manager
+from core.database_manager import get_lock_stats
+from core.dependencies import get_database_provider, get_email_filter
+from core.maintenance import file_stats, get_maintenance_scheduler
+from core.single_flight import get_single_flight
+
+
+def email_filter_stats() -> dict:
+    email_filter = get_email_filter()
+    if email_filter is None:
+        return {'message': 'The email filter is disabled.', 'status_code': 404}
+
+    return {'data': email_filter.stats(), 'status_code': 200}
+
+
+def rebuild_email_filter() -> dict:
+    # Lookups keep using the current filter while the new one is filled.
+    email_filter = get_email_filter()
+    if email_filter is None:
+        return {'message': 'The email filter is disabled.', 'status_code': 404}
+
+    return {'data': email_filter.rebuild(), 'status_code': 200}
+
+
+def admission_stats() -> dict:
+    return {'data': get_admission_controller().stats(), 'status_code': 200}
+
+
+def database_stats(query_params: dict) -> dict:
+    # ?tables=true adds the size of every table and index, which reads the whole file.
+    scheduler = get_maintenance_scheduler()
+    tables = query_params.get('tables') == 'true'
+
+    return {'data': {'locks': get_lock_stats().snapshot(),
+                     'files': {db_path: file_stats(db_path, tables=tables)
+                               for db_path in get_database_provider().writers()},
+                     'maintenance': scheduler.stats() if scheduler else None},
+            'status_code': 200}
+
+
+def single_flight_stats() -> dict:
+    return {'data': get_single_flight().stats(), 'status_code': 200}
+
+
+def start_backup(data: Optional[dict] = None) -> dict:
+    writers = get_database_provider().writers()
+    if not writers:
+        return {'message': 'Backups need the SQLite storage.', 'status_code': 404}
+
+    try:
+        job = get_backup_manager().start(writers, compress=isinstance(data, dict) and bool(data.get('compress')))
+    except BackupInProgress as exc:
+        return {'message': str(exc), 'status_code': 409}
+
+    return {'data': job.stats(), 'status_code': 202}
+
+
+def backup_status() -> dict:
+    job = get_backup_manager().job
+    if job is None:
+        return {'message': 'No backup has been started.', 'status_code': 404}
+
+    return {'data': job.stats(), 'status_code': 200}
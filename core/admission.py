@@ -0,0 +1,122 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Generator, Optional
+
+from core.configuration import Settings, get_settings
+
+HIGH = 'high'
+LOW = 'low'
+
+# Once every request of a class waited longer than the target delay for a whole interval, the queue is standing
+# rather than absorbing a burst, and further requests of that class are shed on arrival instead of queueing.
+SHED_INTERVAL_IN_SECS = 1.0
+
+
+class Overloaded(Exception):
+    def __init__(self, priority: str, retry_after: int):
+        super().__init__(f'Too many {priority} priority requests.')
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+class PriorityClass:  # pylint: disable=too-many-instance-attributes
+    def __init__(self, name: str):
+        self.name = name
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self.shedding = False
+        self._above_target_until: Optional[float] = None
+        self.condition = threading.Condition()
+
+    def observe_delay(self, delay: float, target: float, now: float) -> None:
+        # CoDel-style: a single short wait resets the state, so only a queue that never drains turns shedding on.
+        if delay < target:
+            self._above_target_until = None
+            self.shedding = False
+        elif self._above_target_until is None:
+            self._above_target_until = now + SHED_INTERVAL_IN_SECS
+        elif now >= self._above_target_until:
+            self.shedding = True
+
+    def stats(self) -> Dict[str, object]:
+        return {'active': self.active,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'shed': self.shed,
+                'shedding': self.shedding}
+
+
+class AdmissionController:
+    # Bounds how many requests of each priority class run at once. Low priority work (password hashing) has a
+    # small limit and a short queue deadline, so under load it is refused with a 503 long before high priority
+    # requests, which have their own slots and never wait behind it.
+    def __init__(self):
+        self.classes = {HIGH: PriorityClass(HIGH), LOW: PriorityClass(LOW)}
+
+    @staticmethod
+    def _limits(priority: str, settings: Settings):
+        if priority == LOW:
+            return settings.admission_low_concurrency, settings.admission_low_queue_timeout
+
+        return settings.admission_high_concurrency, settings.admission_high_queue_timeout
+
+    def _acquire(self, priority_class: PriorityClass, settings: Settings) -> None:
+        limit, queue_timeout = self._limits(priority_class.name, settings)
+        retry_after = max(math.ceil(queue_timeout), 1)
+        arrived = time.monotonic()
+        deadline = arrived + queue_timeout
+        with priority_class.condition:
+            if priority_class.active >= limit and (priority_class.shedding or priority_class.name == LOW
+                                                   and self.classes[HIGH].waiting):
+                priority_class.shed += 1
+                raise Overloaded(priority_class.name, retry_after)
+
+            priority_class.waiting += 1
+            try:
+                while priority_class.active >= limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        priority_class.shed += 1
+                        raise Overloaded(priority_class.name, retry_after)
+                    priority_class.condition.wait(remaining)
+            finally:
+                priority_class.waiting -= 1
+
+            now = time.monotonic()
+            priority_class.observe_delay(now - arrived, settings.admission_target_delay, now)
+            priority_class.active += 1
+            priority_class.admitted += 1
+
+    @staticmethod
+    def _release(priority_class: PriorityClass) -> None:
+        with priority_class.condition:
+            priority_class.active -= 1
+            priority_class.condition.notify()
+
+    @contextmanager
+    def admit(self, priority: str) -> Generator[None, None, None]:
+        # Raises Overloaded when the request is shed; limits are read per request, so reloads apply at once.
+        priority_class = self.classes[priority]
+        self._acquire(priority_class, get_settings())
+        try:
+            yield
+        finally:
+            self._release(priority_class)
+
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        return {name: priority_class.stats() for name, priority_class in self.classes.items()}
+
+
+_admission_controller = AdmissionController()  # pylint: disable=invalid-name
+
+
+def get_admission_controller() -> AdmissionController:
+    return _admission_controller
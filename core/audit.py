@@ -0,0 +1,148 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from typing import IO, Any, Dict, List, Optional, Tuple
+
+from core.configuration import Settings, get_settings
+
+Event = Tuple[float, str, Dict[str, Any]]
+
+
+class AuditLog:  # pylint: disable=too-many-instance-attributes
+    # Requests only append to an in-memory queue; a background thread writes the queued events as JSON lines in
+    # batches, one write and fsync per batch, to files rotated by size and age. When the queue is full, events
+    # are either dropped and counted or the request waits for room, depending on AUDIT_OVERFLOW.
+    def __init__(self, settings: Settings):
+        self.directory = settings.audit_log_dir
+        self.flush_interval = settings.audit_flush_interval
+        self.batch_size = settings.audit_batch_size
+        self.max_file_bytes = settings.audit_max_file_bytes
+        self.rotate_interval = settings.audit_rotate_interval.total_seconds()
+        self.block = settings.audit_overflow == 'block'
+        self._queue: 'queue.Queue[Optional[Event]]' = queue.Queue(maxsize=settings.audit_queue_size)
+        self._file: Optional[IO[str]] = None
+        self._file_opened_at = 0.0
+        self._file_index = 0
+        self._dropped = 0
+        self._written = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    @property
+    def written(self) -> int:
+        return self._written
+
+    def record(self, event: str, **fields: Any) -> None:
+        # Serialization is left to the writer thread so the request path only pays for the enqueue.
+        item = (time.time(), event, fields)
+        if self.block:
+            self._queue.put(item)
+            return
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+    def _open_file(self, now: float) -> IO[str]:
+        if self._file is not None:
+            expired = now - self._file_opened_at >= self.rotate_interval
+            if not expired and self._file.tell() < self.max_file_bytes:
+                return self._file
+            self._file.close()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._file_index += 1
+        stamp = datetime.fromtimestamp(now, timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        path = os.path.join(self.directory, f'audit-{stamp}-{os.getpid()}-{self._file_index}.jsonl')
+        self._file = open(path, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+        self._file_opened_at = now
+
+        return self._file
+
+    def _write(self, events: List[Event]) -> None:
+        lines = ''.join(json.dumps({'timestamp': datetime.fromtimestamp(timestamp, timezone.utc).isoformat(),
+                                    'event': event,
+                                    **fields}, default=str) + '\n'
+                        for timestamp, event, fields in events)
+        audit_file = self._open_file(time.time())
+        audit_file.write(lines)
+        audit_file.flush()
+        os.fsync(audit_file.fileno())
+        self._written += len(events)
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            events: List[Event] = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(events) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                events.append(item)
+            if events:
+                try:
+                    self._write(events)
+                except OSError as exc:
+                    print(f'Error writing {len(events)} audit event(s): {exc}')
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='audit-log', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        # The sentinel is queued behind every event recorded so far, so they are all written before the thread ends.
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+
+_audit_log: Optional[AuditLog] = None  # pylint: disable=invalid-name
+
+
+def start_audit_log(settings: Optional[Settings] = None) -> Optional[AuditLog]:
+    # Auditing is off unless AUDIT_LOG_DIR is configured.
+    global _audit_log  # pylint: disable=global-statement
+    settings = settings or get_settings()
+    if not settings.audit_log_dir:
+        return None
+
+    audit_log = AuditLog(settings)
+    audit_log.start()
+    _audit_log = audit_log
+
+    return audit_log
+
+
+def stop_audit_log() -> None:
+    global _audit_log  # pylint: disable=global-statement
+    audit_log, _audit_log = _audit_log, None
+    if audit_log:
+        audit_log.stop()
+
+
+def audit(event: str, **fields: Any) -> None:
+    audit_log = _audit_log
+    if audit_log is not None:
+        audit_log.record(event, **fields)
@@ -2,29 +2,78 @@
 # All rights reserved
 
 
+import hashlib
+import math
+import secrets
+import time
 import uuid
 from dataclasses import asdict
-from datetime import datetime, timedelta
+from datetime import datetime
 from sqlite3 import Error
+from typing import Any, Dict, List, Optional, Tuple
 
 import bcrypt  # type: ignore
 import jwt
 
-from core.configuration import (AUTH_TOKEN_EXPIRY_PERIOD,
-                                SECRET_KEY,
-                                VERIFICATION_TOKEN_EXPIRY_PERIOD)
-from core.database_manager import DatabaseManager
-from core.helpers import decode_jwt
-from core.schemas import Credentials, User, UserIn
+from core.audit import audit
+from core.configuration import get_settings
+from core.dependencies import get_email_filter
+from core.repositories import Database
+from core.helpers import decode_jwt, etag_matches, get_header, to_epoch
+from core.rate_limiter import get_rate_limiter
+from core.schemas import (AccessTokenClaims, Credentials, RefreshRequest, TokenBatchRequest, User, UserBatchRequest,
+                          UserIn, UserLookup)
+from core.signing_keys import get_key_ring
+from core.single_flight import coalesce
 
 
-def register(data: dict, db: DatabaseManager) -> dict:
+def _rate_limited(client_address: Optional[str], email: str) -> Optional[dict]:
+    # Checked before any lookup or password hashing, so throttled attempts cost next to nothing.
+    rate_limiter = get_rate_limiter()
+    retry_after = rate_limiter.check(client_address, email) if rate_limiter else 0
+    if not retry_after:
+        return None
+
+    audit('rate_limited', client_address=client_address, email=email.lower())
+    return {'message': 'Too Many Requests',
+            'status_code': 429,
+            'headers': {'Retry-After': str(max(math.ceil(retry_after), 1))}}
+
+
+def register(data: dict, db: Database, client_address: Optional[str] = None) -> dict:
     try:
         user_in = UserIn.from_dict(data)
+        user_in.email = user_in.email.lower()
+        rate_limited = _rate_limited(client_address, user_in.email)
+        if rate_limited:
+            return rate_limited
+        # Duplicates are turned away before paying for bcrypt; the filter spares the lookup for new emails. A user it
+        # has not seen yet (written by another process) only costs the hash: the unique index still rejects the insert.
+        email_filter = get_email_filter()
+        if ((email_filter is None or email_filter.might_contain(user_in.email))
+                and db.user_repository.get_internal_user_by_email(email=user_in.email)):
+            raise ValueError('Your request could not be processed. Please try again.')
+        if email_filter is not None:
+            # Added before the insert, so a login racing the commit is never turned away; an insert that fails
+            # only leaves a false positive behind.
+            email_filter.add(user_in.email)
         user_in.password = bcrypt.hashpw(user_in.password.encode('utf-8'),
                                          bcrypt.gensalt())
-        user_in.email = user_in.email.lower()
-        user_id = db.user_repository.insert_user(user_in)
+        verification_token = str(uuid.uuid4())
+        expiry = datetime.utcnow() + get_settings().verification_token_expiry
+        link = f'http://localhost:5000/verify-email?token={verification_token}'
+
+        # The verification email is only queued here; the mail dispatcher delivers it in the background, so
+        # registration never waits on the mail server and a failed insert never leaves an orphaned message.
+        with db.transaction():
+            user_id = db.user_repository.insert_user(user_in)
+            db.verification_repository.insert_verification_token(user_id=user_id,
+                                                                 token=verification_token,
+                                                                 expiry=expiry)
+            db.outbox_repository.enqueue(recipient=user_in.email,
+                                         subject='Verify your email address',
+                                         body=f'Please verify your email address by opening {link}',
+                                         send_after=int(time.time()))
 
         user = User(id=user_id,
                     email=user_in.email,
@@ -32,45 +81,47 @@ def register(data: dict, db: DatabaseManager) -> dict:
                     last_name=user_in.last_name,
                     email_verified=False)
 
-        verification_token = str(uuid.uuid4())
-        expiry = datetime.utcnow() + timedelta(minutes=float(VERIFICATION_TOKEN_EXPIRY_PERIOD))
-        db.verification_repository.insert_verification_token(user_id=user_id,
-                                                                 token=verification_token,
-                                                                 expiry=expiry)
-
-        message = f'''For demo purposes, please use the following link for email verification: http://localhost:5000/verify-email?token={verification_token}'''  # pylint: disable=line-too-long
+        audit('register', outcome='success', user_id=user_id, email=user_in.email)
+        message = f'''For demo purposes, please use the following link for email verification: {link}'''
 
         return {'data': asdict(user),
                 'message': message,
                 'status_code': 201}
 
     except ValueError as exc:
+        audit('register', outcome='failure', reason=str(exc))
         return {'message': str(exc), 'status_code': 400}
     except Error as exc:
+        audit('register', outcome='failure', reason=str(exc))
         return {'message': str(exc), 'status_code': 400}
 
 
-def verify_email(query_params: dict, db: DatabaseManager) -> dict:
+def verify_email(query_params: dict, db: Database) -> dict:
     if not query_params and not query_params.get('token', None):
         return {'message': 'Bad Request', 'status_code': 400}
-    try:
-        token = query_params.get('token', None)
-        verification_token = db.verification_repository.get_verification_token(
-            token=token)
-        if not verification_token:
-            return {'message': 'Bad Request', 'status_code': 400}
-
-        expiry = datetime.strptime(verification_token.expiry,
-                                   '%Y-%m-%d %H:%M:%S.%f')
-        if expiry < datetime.utcnow():
-            return {'message': 'Token Expired', 'status_code': 400}
+    token = query_params.get('token', None)
+
+    # A double-clicked link is verified once; the second request gets the same answer instead of a 400 for a
+    # token the first one just consumed.
+    return dict(coalesce(f'verify_email:{token}', lambda: _verify_email(token, db)))
+
 
-        user = db.user_repository.get_user_by_id(id_=verification_token.user_id)
+def _verify_email(token: str, db: Database) -> dict:
+    try:
+        # One transaction marks the user verified and consumes the token; only a failure needs a second look
+        # to tell an expired token from an unknown or already used one.
+        now = int(time.time())
+        user = db.verification_repository.redeem_verification_token(token=token, now=now)
         if not user:
-            return {'message': 'Bad Request', 'status_code': 400}
+            verification_token = db.verification_repository.get_verification_token(token=token)
+            if not verification_token or verification_token.expiry >= now:
+                audit('verify_email', outcome='failure', reason='unknown token')
+                return {'message': 'Bad Request', 'status_code': 400}
+
+            audit('verify_email', outcome='failure', reason='token expired', user_id=verification_token.user_id)
+            return {'message': 'Token Expired', 'status_code': 400}
 
-        db.user_repository.verify_user(id_=verification_token.user_id)
-        db.verification_repository.delete_verification_token(token=token)
+        audit('verify_email', outcome='success', user_id=user.id)
 
         return {'message': f'Email verified for user: {user.email}', 'status_code': 200}
 
@@ -78,28 +129,63 @@ def verify_email(query_params: dict, db: DatabaseManager) -> dict:
         return {'message': str(exc), 'status_code': 400}
 
 
-def authenticate(data: dict, db: DatabaseManager) -> dict:
+def _hash_refresh_token(refresh_token: str) -> str:
+    # Refresh tokens are random, so a fast unsalted hash is enough to keep them out of the database in the clear.
+    return hashlib.sha256(refresh_token.encode('utf-8')).hexdigest()
+
+
+def _issue_tokens(user_id: int, db: Database, family_id: Optional[str] = None) -> Tuple[dict, datetime]:
+    # Returns the access token's expiry with the tokens, so an auth token row stored for it expires with the JWT.
+    settings = get_settings()
+    now = datetime.utcnow()
+    expiry = now + settings.auth_token_expiry
+    key = get_key_ring().active
+    access_token = jwt.encode({'user_id': user_id, 'expiry': expiry.isoformat(), 'exp': to_epoch(expiry)},
+                              key.signing_key,
+                              algorithm=key.algorithm,
+                              headers={'kid': key.kid} if key.kid else None)
+    refresh_token = secrets.token_urlsafe(32)
+    db.refresh_repository.insert_refresh_token(user_id=user_id,
+                                               token_hash=_hash_refresh_token(refresh_token),
+                                               family_id=family_id or str(uuid.uuid4()),
+                                               expiry=now + settings.refresh_token_expiry)
+
+    return {'access_token': access_token,
+            'refresh_token': refresh_token,
+            'token_type': 'Bearer',
+            'expires_in': int(settings.auth_token_expiry.total_seconds())}, expiry
+
+
+def authenticate(data: dict, db: Database,  # pylint: disable=too-many-return-statements
+                 client_address: Optional[str] = None) -> dict:
     try:
         credentials = Credentials.from_dict(data)
+        rate_limited = _rate_limited(client_address, credentials.email)
+        if rate_limited:
+            return rate_limited
 
-        user = db.user_repository.get_internal_user_by_email(
-            email=credentials.email.lower())
+        # Unknown emails, such as those of a credential stuffing run, are turned away without a query.
+        email_filter = get_email_filter()
+        user = None
+        if email_filter is None or email_filter.might_contain(credentials.email):
+            user = db.user_repository.get_credentials_by_email(email=credentials.email.lower())
         if not user:
+            audit('login', outcome='failure', reason='unknown email', email=credentials.email.lower())
             return {'message': 'Invalid credentials', 'status_code': 401}
         if user.email_verified is False:
+            audit('login', outcome='failure', reason='email not verified', user_id=user.id)
             return {'message': 'Email not verified, please verify your email.', 'status_code': 403}
 
         if bcrypt.checkpw(credentials.password.encode('utf-8'), user.password):
-            expiry = datetime.utcnow() + timedelta(minutes=float(AUTH_TOKEN_EXPIRY_PERIOD))
-            token = jwt.encode({'user_id': user.id, 'expiry': expiry.isoformat()},
-                               SECRET_KEY,
-                               algorithm='HS256')
-            db.auth_repository.insert_auth_token(user_id=user.id,
-                                                               token=token,
-                                                               expiry=expiry)
+            with db.transaction():
+                tokens, expiry = _issue_tokens(user_id=user.id, db=db)
+                db.auth_repository.insert_auth_token(user_id=user.id, token=tokens['access_token'], expiry=expiry)
+            audit('login', outcome='success', user_id=user.id)
+            audit('token_issued', grant='password', user_id=user.id)
 
-            return {'data': {'access_token': token}, 'status_code': 200}
+            return {'data': tokens, 'status_code': 200}
 
+        audit('login', outcome='failure', reason='wrong password', user_id=user.id)
         return {'message': 'Invalid credentials', 'status_code': 401}
 
     except ValueError as exc:
@@ -108,8 +194,133 @@ def authenticate(data: dict, db: DatabaseManager) -> dict:
         return {'message': str(exc), 'status_code': 400}
 
 
-def get_current_logged_user(headers: dict, db: DatabaseManager) -> dict:
+def refresh_access_token(data: dict, db: Database) -> dict:
+    try:
+        request = RefreshRequest.from_dict(data)
+
+        with db.transaction():
+            refresh_token = db.refresh_repository.get_refresh_token(
+                token_hash=_hash_refresh_token(request.refresh_token))
+            if not refresh_token:
+                return {'message': 'Invalid refresh token.', 'status_code': 401}
+            # Checked before the token is revoked, so an expired token is turned away without being consumed.
+            if refresh_token.expiry < time.time():
+                return {'message': 'Refresh token expired.', 'status_code': 401}
+
+            # A rotated token presented again has leaked or been replayed, so every token descended from the
+            # same login is revoked and the user has to log in again. Losing the race against a concurrent
+            # refresh with the same token counts as reuse too.
+            if refresh_token.revoked or not db.refresh_repository.revoke_refresh_token(id_=refresh_token.id):
+                db.refresh_repository.revoke_refresh_token_family(family_id=refresh_token.family_id,
+                                                                  user_id=refresh_token.user_id)
+                audit('refresh_token_reuse', user_id=refresh_token.user_id, family_id=refresh_token.family_id)
+                return {'message': 'Invalid refresh token.', 'status_code': 401}
+
+            tokens, _ = _issue_tokens(user_id=refresh_token.user_id, db=db, family_id=refresh_token.family_id)
+
+        audit('token_issued', grant='refresh_token', user_id=refresh_token.user_id)
+        return {'data': tokens, 'status_code': 200}
+
+    except ValueError as exc:
+        return {'message': str(exc), 'status_code': 400}
+    except Error as exc:
+        return {'message': str(exc), 'status_code': 400}
+
+
+def get_current_logged_user(headers: dict, db: Database) -> dict:
     user_id, _ = decode_jwt(token=headers.get('Authorization', ''))
-    user = db.user_repository.get_user_by_id(id_=int(user_id))
+    # Gateways validating a popular token at once share one lookup.
+    user = coalesce(f'get_user_by_id:{int(user_id)}', lambda: db.user_repository.get_user_by_id(id_=int(user_id)))
+    if user is None:
+        # The token is still valid, but the user it was issued to has been deleted since.
+        return {'message': 'User not found.', 'status_code': 404}
+
+    # The version only changes when the user row does, so an unchanged user is answered with a 304 and no body.
+    # The response is per user: shared caches must not store it, and clients revalidate before every reuse.
+    cache_headers = {'ETag': f'"{user.id}-{user.version}"',
+                     'Cache-Control': 'private, no-cache',
+                     'Vary': 'Authorization'}
+    if etag_matches(get_header(headers, 'If-None-Match'), cache_headers['ETag']):
+        return {'status_code': 304, 'headers': cache_headers}
+
+    return {'data': asdict(user), 'status_code': 200, 'headers': cache_headers}
+
+
+def get_jwks(headers: dict) -> dict:
+    # Public keys for services verifying access tokens themselves. They may be cached for JWKS_MAX_AGE_IN_SECS,
+    # so a new key must be added that long before it becomes active.
+    key_ring = get_key_ring()
+    cache_headers = {'ETag': key_ring.etag,
+                     'Cache-Control': f'public, max-age={get_settings().jwks_max_age}'}
+    if etag_matches(get_header(headers, 'If-None-Match'), cache_headers['ETag']):
+        return {'status_code': 304, 'headers': cache_headers}
+
+    return {**key_ring.jwks, 'status_code': 200, 'headers': cache_headers}
+
+
+def _get_users(ids: List[int], db: Database) -> dict:
+    # A single IN query for the distinct ids, whatever the batch size.
+    return {user.id: user for user in db.user_repository.get_users_by_ids(list(dict.fromkeys(ids)))}
+
+
+def get_users_batch(data: dict, db: Database) -> dict:
+    try:
+        request = UserBatchRequest.from_dict(data)
+        lookups = UserLookup.validate_many({'id': id_} for id_ in request.ids)
+        users = _get_users([lookup.id for lookup, _ in lookups if lookup is not None], db)
+
+        results: List[Dict[str, Any]] = []
+        for id_, (lookup, error) in zip(request.ids, lookups):
+            if lookup is None:
+                results.append({'id': id_, 'message': error, 'status_code': 400})
+            elif lookup.id in users:
+                results.append({'id': id_, 'data': asdict(users[lookup.id]), 'status_code': 200})
+            else:
+                results.append({'id': id_, 'message': 'Not Found', 'status_code': 404})
+
+        return {'data': results, 'status_code': 200}
 
-    return {'data': asdict(user), 'status_code': 200}
+    except ValueError as exc:
+        return {'message': str(exc), 'status_code': 400}
+    except Error as exc:
+        return {'message': str(exc), 'status_code': 400}
+
+
+def introspect_tokens(data: dict, db: Database) -> dict:
+    try:
+        request = TokenBatchRequest.from_dict(data)
+
+        decoded: List[dict] = []
+        errors: List[Optional[str]] = []
+        for token in request.tokens:
+            try:
+                user_id, expiry = decode_jwt(token=token)
+                decoded.append({'user_id': user_id, 'expiry': expiry})
+                errors.append(None)
+            except jwt.ExpiredSignatureError:
+                decoded.append({})
+                errors.append('Token expired.')
+            except jwt.InvalidTokenError:
+                decoded.append({})
+                errors.append('Invalid token.')
+        # A correctly signed token can still carry claims that are not an id and an expiry; that only fails its item.
+        claims = [claim if error is None else None
+                  for (claim, _), error in zip(AccessTokenClaims.validate_many(decoded), errors)]
+
+        users = _get_users([claim.user_id for claim in claims if claim is not None], db)
+
+        results: List[Dict[str, Any]] = []
+        for claim, error in zip(claims, errors):
+            if claim is not None and claim.user_id in users:
+                results.append({'active': True, 'expiry': claim.expiry, 'data': asdict(users[claim.user_id])})
+            elif claim is not None:
+                results.append({'active': False, 'message': 'Unknown user.'})
+            else:
+                results.append({'active': False, 'message': error or 'Invalid token.'})
+
+        return {'data': results, 'status_code': 200}
+
+    except ValueError as exc:
+        return {'message': str(exc), 'status_code': 400}
+    except Error as exc:
+        return {'message': str(exc), 'status_code': 400}
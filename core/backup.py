@@ -0,0 +1,180 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import argparse
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from core.configuration import Settings, get_settings
+from core.database_manager import DEFAULT_DB_PATH, DatabaseWriter
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class BackupInProgress(Exception):
+    pass
+
+
+def backup_file(writer: DatabaseWriter, target: str, compress: bool = False, *, step_pages: int = 256,
+                step_pause: float = 0.01, progress: Optional[Callable[[int, int], None]] = None) -> int:
+    # Copies the database through its writer connection with SQLite's online backup API, step_pages pages at a
+    # time. The writer lock is only held during a step and released for step_pause in between, so writes keep
+    # going; because they go through the connection being backed up, SQLite applies them to the copy as well
+    # instead of restarting it, and the snapshot is consistent as of the last step. The snapshot is written next
+    # to the target and renamed into place, so the target is never a partial file. A compressed backup is gzipped
+    # from that snapshot, which needs free space for the whole database as well as the compressed copy while it
+    # runs. Returns the target's size.
+    directory = os.path.dirname(os.path.abspath(target))
+    os.makedirs(directory, exist_ok=True)
+    handle, snapshot_path = tempfile.mkstemp(suffix='.partial', dir=directory)
+    os.close(handle)
+
+    def step(_status: int, remaining: int, total: int) -> None:
+        if progress:
+            progress(total - remaining, total)
+        if remaining:
+            writer.lock.release()
+            try:
+                time.sleep(step_pause)
+            finally:
+                writer.lock.acquire()
+
+    try:
+        snapshot = sqlite3.connect(snapshot_path)
+        try:
+            with writer.lock:
+                writer.connection.backup(snapshot, pages=step_pages, progress=step)
+        finally:
+            snapshot.close()
+
+        if compress:
+            compressed_path = f'{snapshot_path}.gz'
+            try:
+                with open(snapshot_path, 'rb') as source, gzip.open(compressed_path, 'wb') as output:
+                    shutil.copyfileobj(source, output)
+                os.replace(compressed_path, target)
+            finally:
+                if os.path.exists(compressed_path):
+                    os.remove(compressed_path)
+        else:
+            os.replace(snapshot_path, target)
+    finally:
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+
+    return os.path.getsize(target)
+
+
+def backup_path(backup_dir: str, db_path: str, started_at: datetime, compress: bool) -> str:
+    # Down to the microsecond, so backups started within the same second do not overwrite each other.
+    name = f'{Path(db_path).stem}-{started_at.strftime("%Y%m%dT%H%M%S%fZ")}.db'
+
+    return os.path.join(backup_dir, f'{name}.gz' if compress else name)
+
+
+class BackupJob:  # pylint: disable=too-many-instance-attributes
+    # Backs up every database file of the provider, one after the other; sharded storage has one file per shard.
+    def __init__(self, writers: Dict[str, DatabaseWriter], settings: Settings, compress: bool = False):
+        self.started_at = datetime.now(timezone.utc)
+        self.finished_at: Optional[datetime] = None
+        self.state = RUNNING
+        self.error: Optional[str] = None
+        self.compress = compress
+        self.step_pages = settings.backup_step_pages
+        self.step_pause = settings.backup_step_pause
+        self.writers = writers
+        self.files: List[Dict[str, Any]] = [{'source': db_path,
+                                             'target': backup_path(settings.backup_dir, db_path, self.started_at,
+                                                                   compress),
+                                             'copied_pages': 0,
+                                             'total_pages': 0,
+                                             'size_bytes': None} for db_path in writers]
+
+    def run(self) -> None:
+        try:
+            for backup in self.files:
+                def progress(copied: int, total: int, backup=backup) -> None:
+                    backup['copied_pages'], backup['total_pages'] = copied, total
+
+                backup['size_bytes'] = backup_file(self.writers[backup['source']], backup['target'],
+                                                   self.compress, step_pages=self.step_pages,
+                                                   step_pause=self.step_pause, progress=progress)
+            self.state = DONE
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            self.state = FAILED
+            self.error = str(exc)
+        finally:
+            self.finished_at = datetime.now(timezone.utc)
+
+    def stats(self) -> Dict[str, object]:
+        copied = sum(backup['copied_pages'] for backup in self.files)
+        total = sum(backup['total_pages'] for backup in self.files)
+
+        return {'state': self.state,
+                'started_at': self.started_at.isoformat(),
+                'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+                'compress': self.compress,
+                'progress': 1.0 if self.state == DONE else copied / total if total else 0.0,
+                'error': self.error,
+                'files': [dict(backup) for backup in self.files]}
+
+
+class BackupManager:
+    # Runs at most one backup at a time in the background and remembers the last one for progress reports.
+    def __init__(self):
+        self.job: Optional[BackupJob] = None
+        self._lock = threading.Lock()
+
+    def start(self, writers: Dict[str, DatabaseWriter], compress: bool = False) -> BackupJob:
+        with self._lock:
+            if self.job is not None and self.job.state == RUNNING:
+                raise BackupInProgress('A backup is already running.')
+            self.job = BackupJob(writers, get_settings(), compress)
+        threading.Thread(target=self.job.run, name='database-backup', daemon=True).start()
+
+        return self.job
+
+
+_backup_manager = BackupManager()  # pylint: disable=invalid-name
+
+
+def get_backup_manager() -> BackupManager:
+    return _backup_manager
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Take a consistent snapshot of a user database.')
+    parser.add_argument('--db-path', default=DEFAULT_DB_PATH)
+    parser.add_argument('--target', required=True, help='the snapshot file to write')
+    parser.add_argument('--gzip', action='store_true', help='compress the snapshot')
+    parser.add_argument('--step-pages', type=int, default=256, help='pages copied per step')
+    parser.add_argument('--step-pause', type=float, default=0.01, help='seconds to pause between steps')
+    args = parser.parse_args()
+    if not os.path.exists(args.db_path):
+        parser.error(f'no database found at {args.db_path}')
+
+    def progress(copied: int, total: int) -> None:
+        print(f'\rCopied {copied}/{total} pages', end='', flush=True)
+
+    writer = DatabaseWriter(args.db_path)
+    try:
+        size = backup_file(writer, args.target, args.gzip, step_pages=args.step_pages, step_pause=args.step_pause,
+                           progress=progress)
+    finally:
+        writer.close()
+    print(f'\nWrote {size} bytes to {args.target}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,286 @@
 
 
 import configparser
+import signal
+import threading
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Callable, List, Optional, Tuple
 
-config = configparser.ConfigParser()
-config.read('.env')
+DEFAULT_CONFIGURATION_PATH = '.env'
+SECTION = 'VARIABLES'
 
 
-SECRET_KEY = config.get('VARIABLES', 'SECRET_KEY', fallback='your secret key')
-AUTH_TOKEN_EXPIRY_PERIOD = config.get('VARIABLES',
-                                      'AUTH_TOKEN_EXPIRY_PERIOD_IN_MINS',
-                                      fallback=1440)
-VERIFICATION_TOKEN_EXPIRY_PERIOD = config.get('VARIABLES',
-                                              'VERIFICATION_TOKEN_EXPIRY_PERIOD_IN_MINS',
-                                              fallback=1440)
+@dataclass(frozen=True)
+class Settings:  # pylint: disable=too-many-instance-attributes
+    secret_key: str = 'your secret key'
+    jwt_key_dir: str = ''
+    jwt_active_key_id: str = ''
+    jwks_max_age: int = 300
+    auth_token_expiry: timedelta = timedelta(minutes=15)
+    refresh_token_expiry: timedelta = timedelta(days=30)
+    verification_token_expiry: timedelta = timedelta(minutes=1440)
+    db_pool_size: int = 4
+    statement_cache_size: int = 128
+    db_busy_timeout: float = 5.0
+    db_busy_retries: int = 5
+    db_busy_retry_backoff: float = 0.05
+    backup_dir: str = 'backups'
+    backup_step_pages: int = 256
+    backup_step_pause: float = 0.01
+    maintenance: str = 'on'
+    maintenance_max_in_flight: int = 2
+    maintenance_checkpoint_interval: timedelta = timedelta(minutes=1)
+    maintenance_truncate_interval: timedelta = timedelta(minutes=60)
+    maintenance_optimize_interval: timedelta = timedelta(minutes=60)
+    maintenance_analyze_interval: timedelta = timedelta(minutes=1440)
+    maintenance_purge_interval: timedelta = timedelta(minutes=60)
+    max_request_body_bytes: int = 64 * 1024
+    max_batch_size: int = 100
+    drain_timeout: float = 30.0
+    smtp_host: str = ''
+    smtp_port: int = 25
+    smtp_sender: str = 'no-reply@localhost'
+    outbox_batch_size: int = 50
+    outbox_max_attempts: int = 8
+    outbox_poll_interval: float = 1.0
+    outbox_retry_backoff: float = 2.0
+    admission_high_concurrency: int = 64
+    admission_low_concurrency: int = 8
+    admission_high_queue_timeout: float = 5.0
+    admission_low_queue_timeout: float = 1.0
+    admission_target_delay: float = 0.1
+    rate_limit_store: str = 'memory'
+    rate_limit_db_path: str = 'rate_limits.db'
+    rate_limit_max_keys: int = 100000
+    rate_limit_ip_burst: int = 30
+    rate_limit_ip_per_minute: float = 30.0
+    rate_limit_email_burst: int = 10
+    rate_limit_email_per_minute: float = 5.0
+    trusted_proxies: Tuple[str, ...] = ()
+    single_flight_timeout: float = 5.0
+    email_filter: str = 'on'
+    email_filter_false_positive_rate: float = 0.01
+    email_filter_refresh_interval: timedelta = timedelta(minutes=1)
+    admin_token: str = ''
+    audit_log_dir: str = ''
+    audit_queue_size: int = 10000
+    audit_batch_size: int = 500
+    audit_flush_interval: float = 1.0
+    audit_overflow: str = 'drop'
+    audit_max_file_bytes: int = 10 * 1024 * 1024
+    audit_rotate_interval: timedelta = timedelta(minutes=1440)
+
+
+def _positive_int(config: configparser.ConfigParser, key: str, fallback: int) -> int:
+    try:
+        value = config.getint(SECTION, key, fallback=fallback)
+    except ValueError as exc:
+        raise ValueError(f'{key} must be an integer.') from exc
+    if value <= 0:
+        raise ValueError(f'{key} must be greater than zero.')
+
+    return value
+
+
+def _positive_float(config: configparser.ConfigParser, key: str, fallback: float) -> float:
+    try:
+        value = config.getfloat(SECTION, key, fallback=fallback)
+    except ValueError as exc:
+        raise ValueError(f'{key} must be a number.') from exc
+    if value <= 0:
+        raise ValueError(f'{key} must be greater than zero.')
+
+    return value
+
+
+def _minutes(config: configparser.ConfigParser, key: str, fallback: timedelta) -> timedelta:
+    try:
+        value = config.getfloat(SECTION, key, fallback=fallback.total_seconds() / 60)
+    except ValueError as exc:
+        raise ValueError(f'{key} must be a number of minutes.') from exc
+    if value <= 0:
+        raise ValueError(f'{key} must be greater than zero.')
+
+    return timedelta(minutes=value)
+
+
+def _list(config: configparser.ConfigParser, key: str, fallback: Tuple[str, ...]) -> Tuple[str, ...]:
+    value = config.get(SECTION, key, fallback=None)
+    if value is None:
+        return fallback
+
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+def _choice(config: configparser.ConfigParser, key: str, fallback: str, choices: Tuple[str, ...]) -> str:
+    value = config.get(SECTION, key, fallback=fallback).strip().lower()
+    if value not in choices:
+        raise ValueError(f'{key} must be one of: {", ".join(choices)}.')
+
+    return value
+
+
+def _rate(config: configparser.ConfigParser, key: str, fallback: float) -> float:
+    value = _positive_float(config, key, fallback)
+    if value >= 1:
+        raise ValueError(f'{key} must be less than one.')
+
+    return value
+
+
+def load_settings(path: str = DEFAULT_CONFIGURATION_PATH) -> Settings:
+    config = configparser.ConfigParser()
+    config.read(path)
+    defaults = Settings()
+
+    secret_key = config.get(SECTION, 'SECRET_KEY', fallback=defaults.secret_key)
+    if not secret_key.strip():
+        raise ValueError('SECRET_KEY must not be empty.')
+
+    return Settings(
+        secret_key=secret_key,
+        jwt_key_dir=config.get(SECTION, 'JWT_KEY_DIR', fallback=defaults.jwt_key_dir).strip(),
+        jwt_active_key_id=config.get(SECTION, 'JWT_ACTIVE_KEY_ID', fallback=defaults.jwt_active_key_id).strip(),
+        jwks_max_age=_positive_int(config, 'JWKS_MAX_AGE_IN_SECS', defaults.jwks_max_age),
+        auth_token_expiry=_minutes(config, 'AUTH_TOKEN_EXPIRY_PERIOD_IN_MINS', defaults.auth_token_expiry),
+        refresh_token_expiry=_minutes(config, 'REFRESH_TOKEN_EXPIRY_PERIOD_IN_MINS', defaults.refresh_token_expiry),
+        verification_token_expiry=_minutes(config, 'VERIFICATION_TOKEN_EXPIRY_PERIOD_IN_MINS',
+                                           defaults.verification_token_expiry),
+        db_pool_size=_positive_int(config, 'DB_POOL_SIZE', defaults.db_pool_size),
+        statement_cache_size=_positive_int(config, 'STATEMENT_CACHE_SIZE', defaults.statement_cache_size),
+        db_busy_timeout=_positive_float(config, 'DB_BUSY_TIMEOUT_IN_SECS', defaults.db_busy_timeout),
+        db_busy_retries=_positive_int(config, 'DB_BUSY_RETRIES', defaults.db_busy_retries),
+        db_busy_retry_backoff=_positive_float(config, 'DB_BUSY_RETRY_BACKOFF_IN_SECS', defaults.db_busy_retry_backoff),
+        backup_dir=config.get(SECTION, 'BACKUP_DIR', fallback=defaults.backup_dir).strip(),
+        backup_step_pages=_positive_int(config, 'BACKUP_STEP_PAGES', defaults.backup_step_pages),
+        backup_step_pause=_positive_float(config, 'BACKUP_STEP_PAUSE_IN_SECS', defaults.backup_step_pause),
+        maintenance=_choice(config, 'MAINTENANCE', defaults.maintenance, ('on', 'off')),
+        maintenance_max_in_flight=_positive_int(config, 'MAINTENANCE_MAX_IN_FLIGHT',
+                                                defaults.maintenance_max_in_flight),
+        maintenance_checkpoint_interval=_minutes(config, 'MAINTENANCE_CHECKPOINT_INTERVAL_IN_MINS',
+                                                 defaults.maintenance_checkpoint_interval),
+        maintenance_truncate_interval=_minutes(config, 'MAINTENANCE_TRUNCATE_INTERVAL_IN_MINS',
+                                               defaults.maintenance_truncate_interval),
+        maintenance_optimize_interval=_minutes(config, 'MAINTENANCE_OPTIMIZE_INTERVAL_IN_MINS',
+                                               defaults.maintenance_optimize_interval),
+        maintenance_analyze_interval=_minutes(config, 'MAINTENANCE_ANALYZE_INTERVAL_IN_MINS',
+                                              defaults.maintenance_analyze_interval),
+        maintenance_purge_interval=_minutes(config, 'MAINTENANCE_PURGE_INTERVAL_IN_MINS',
+                                            defaults.maintenance_purge_interval),
+        max_request_body_bytes=_positive_int(config, 'MAX_REQUEST_BODY_BYTES', defaults.max_request_body_bytes),
+        max_batch_size=_positive_int(config, 'MAX_BATCH_SIZE', defaults.max_batch_size),
+        drain_timeout=_positive_float(config, 'DRAIN_TIMEOUT_IN_SECS', defaults.drain_timeout),
+        smtp_host=config.get(SECTION, 'SMTP_HOST', fallback=defaults.smtp_host).strip(),
+        smtp_port=_positive_int(config, 'SMTP_PORT', defaults.smtp_port),
+        smtp_sender=config.get(SECTION, 'SMTP_SENDER', fallback=defaults.smtp_sender),
+        outbox_batch_size=_positive_int(config, 'OUTBOX_BATCH_SIZE', defaults.outbox_batch_size),
+        outbox_max_attempts=_positive_int(config, 'OUTBOX_MAX_ATTEMPTS', defaults.outbox_max_attempts),
+        outbox_poll_interval=_positive_float(config, 'OUTBOX_POLL_INTERVAL_IN_SECS', defaults.outbox_poll_interval),
+        outbox_retry_backoff=_positive_float(config, 'OUTBOX_RETRY_BACKOFF_IN_SECS', defaults.outbox_retry_backoff),
+        admission_high_concurrency=_positive_int(config, 'ADMISSION_HIGH_CONCURRENCY',
+                                                 defaults.admission_high_concurrency),
+        admission_low_concurrency=_positive_int(config, 'ADMISSION_LOW_CONCURRENCY',
+                                                defaults.admission_low_concurrency),
+        admission_high_queue_timeout=_positive_float(config, 'ADMISSION_HIGH_QUEUE_TIMEOUT_IN_SECS',
+                                                     defaults.admission_high_queue_timeout),
+        admission_low_queue_timeout=_positive_float(config, 'ADMISSION_LOW_QUEUE_TIMEOUT_IN_SECS',
+                                                    defaults.admission_low_queue_timeout),
+        admission_target_delay=_positive_float(config, 'ADMISSION_TARGET_DELAY_IN_SECS',
+                                               defaults.admission_target_delay),
+        rate_limit_store=_choice(config, 'RATE_LIMIT_STORE', defaults.rate_limit_store, ('memory', 'sqlite', 'off')),
+        rate_limit_db_path=config.get(SECTION, 'RATE_LIMIT_DB_PATH', fallback=defaults.rate_limit_db_path).strip(),
+        rate_limit_max_keys=_positive_int(config, 'RATE_LIMIT_MAX_KEYS', defaults.rate_limit_max_keys),
+        rate_limit_ip_burst=_positive_int(config, 'RATE_LIMIT_IP_BURST', defaults.rate_limit_ip_burst),
+        rate_limit_ip_per_minute=_positive_float(config, 'RATE_LIMIT_IP_PER_MINUTE', defaults.rate_limit_ip_per_minute),
+        rate_limit_email_burst=_positive_int(config, 'RATE_LIMIT_EMAIL_BURST', defaults.rate_limit_email_burst),
+        rate_limit_email_per_minute=_positive_float(config, 'RATE_LIMIT_EMAIL_PER_MINUTE',
+                                                    defaults.rate_limit_email_per_minute),
+        trusted_proxies=_list(config, 'TRUSTED_PROXIES', defaults.trusted_proxies),
+        single_flight_timeout=_positive_float(config, 'SINGLE_FLIGHT_TIMEOUT_IN_SECS', defaults.single_flight_timeout),
+        email_filter=_choice(config, 'EMAIL_FILTER', defaults.email_filter, ('on', 'off')),
+        email_filter_false_positive_rate=_rate(config, 'EMAIL_FILTER_FALSE_POSITIVE_RATE',
+                                               defaults.email_filter_false_positive_rate),
+        email_filter_refresh_interval=_minutes(config, 'EMAIL_FILTER_REFRESH_INTERVAL_IN_MINS',
+                                               defaults.email_filter_refresh_interval),
+        admin_token=config.get(SECTION, 'ADMIN_TOKEN', fallback=defaults.admin_token).strip(),
+        audit_log_dir=config.get(SECTION, 'AUDIT_LOG_DIR', fallback=defaults.audit_log_dir).strip(),
+        audit_queue_size=_positive_int(config, 'AUDIT_QUEUE_SIZE', defaults.audit_queue_size),
+        audit_batch_size=_positive_int(config, 'AUDIT_BATCH_SIZE', defaults.audit_batch_size),
+        audit_flush_interval=_positive_float(config, 'AUDIT_FLUSH_INTERVAL_IN_SECS', defaults.audit_flush_interval),
+        audit_overflow=_choice(config, 'AUDIT_OVERFLOW', defaults.audit_overflow, ('drop', 'block')),
+        audit_max_file_bytes=_positive_int(config, 'AUDIT_MAX_FILE_BYTES', defaults.audit_max_file_bytes),
+        audit_rotate_interval=_minutes(config, 'AUDIT_ROTATE_INTERVAL_IN_MINS', defaults.audit_rotate_interval))
+
+
+_settings: Optional[Settings] = None  # pylint: disable=invalid-name
+_settings_path = DEFAULT_CONFIGURATION_PATH  # pylint: disable=invalid-name
+_reload_listeners: List[Callable[[Settings], None]] = []
+_activation_hooks: List[Callable[[Settings], Callable[[], None]]] = []
+_reload_lock = threading.Lock()
+
+
+def _activate(settings: Settings, path: str) -> None:
+    global _settings, _settings_path  # pylint: disable=global-statement
+    # Every hook prepares what it derives from the new settings before they are swapped in, so settings a hook
+    # rejects with ValueError leave the current ones, and everything derived from them, in use.
+    installs = [hook(settings) for hook in list(_activation_hooks)]
+    with _reload_lock:
+        _settings, _settings_path = settings, path
+        for install in installs:
+            install()
+
+
+def load_configuration(path: str = DEFAULT_CONFIGURATION_PATH) -> Settings:
+    settings = load_settings(path)
+    _activate(settings, path)
+
+    return settings
+
+
+def get_settings() -> Settings:
+    # Requests read the settings object once and keep using it, so a reload swapping the reference never
+    # changes values underneath an in-flight request.
+    settings = _settings
+    if settings is None:
+        settings = load_configuration()
+
+    return settings
+
+
+def add_activation_hook(hook: Callable[[Settings], Callable[[], None]]) -> None:
+    # A hook is given settings about to be loaded or reloaded and returns what installs its state for them.
+    _activation_hooks.append(hook)
+
+
+def add_reload_listener(listener: Callable[[Settings], None]) -> None:
+    _reload_listeners.append(listener)
+
+
+def remove_reload_listener(listener: Callable[[Settings], None]) -> None:
+    _reload_listeners.remove(listener)
+
+
+def reload_settings() -> Settings:
+    # An invalid file or key ring raises here and leaves the current settings in place.
+    settings = load_settings(_settings_path)
+    _activate(settings, _settings_path)
+    for listener in list(_reload_listeners):
+        listener(settings)
+
+    return settings
+
+
+def _reload_from_signal() -> None:
+    try:
+        reload_settings()
+        print(f'Configuration reloaded from {_settings_path}.')
+    except ValueError as exc:
+        print(f'Configuration not reloaded: {exc}')
+
+
+def install_reload_handler() -> None:
+    # The reload runs on its own thread rather than inside the signal handler, which may interrupt the main
+    # thread while it holds the reload lock.
+    signal.signal(signal.SIGHUP,
+                  lambda _signum, _frame: threading.Thread(target=_reload_from_signal, daemon=True).start())
@@ -2,81 +2,392 @@
 # All rights reserved
 
 
+import random
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime
-from sqlite3 import Connection, Error, IntegrityError
-from typing import Optional
+from pathlib import Path
+from sqlite3 import Connection, Cursor, Error, IntegrityError, OperationalError
+from typing import Callable, Dict, Generator, Iterator, List, Optional, Tuple, TypeVar
 
-from core.schemas import InternalUser, User, UserIn, UserVerificationToken
+from core import repositories
+from core.helpers import to_epoch
+from core.row_mapping import DEFAULT_BATCH_SIZE, Query
+from core.sharding import bucket_id, email_bucket, id_bucket
+from core.schemas import (InternalUser, OutboundEmail, RefreshToken, User, UserCredentials, UserIn,
+                          UserVerificationToken)
 
+DEFAULT_DB_PATH = 'ableton_user_management.db'
+SCHEMA_VERSION = 5
+# Waits shorter than this are not counted as lock waits.
+LOCK_WAIT_THRESHOLD_IN_SECS = 0.001
 
-class DatabaseManager:
-    def __init__(self, db_path: str = 'ableton_user_management.db'):
+R = TypeVar('R')
+
+
+class DatabaseBusyError(Exception):
+    # Deliberately not an sqlite3.Error: the service layer turns those into 400s, while a database that stayed
+    # locked through every retry is a temporary condition, answered with a 503.
+    pass
+
+
+@dataclass(frozen=True)
+class BusyPolicy:
+    # SQLite itself waits up to `timeout` for a lock held by another connection; a BEGIN or COMMIT that still
+    # finds the database locked is retried `retries` times with jittered exponential backoff.
+    timeout: float = 5.0
+    retries: int = 5
+    backoff: float = 0.05
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+
+class LockStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = dict.fromkeys(('lock_waits', 'lock_wait_seconds', 'busy_retries',
+                                                          'busy_failures'), 0)
+
+    def record_wait(self, seconds: float) -> None:
+        if seconds >= LOCK_WAIT_THRESHOLD_IN_SECS:
+            with self._lock:
+                self._counters['lock_waits'] += 1
+                self._counters['lock_wait_seconds'] += seconds
+
+    def increment(self, counter: str) -> None:
+        with self._lock:
+            self._counters[counter] += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._counters)
+
+
+_lock_stats = LockStats()  # pylint: disable=invalid-name
+
+
+def get_lock_stats() -> LockStats:
+    return _lock_stats
+
+
+def is_busy(exc: OperationalError) -> bool:
+    return getattr(exc, 'sqlite_errorcode', None) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED) or \
+        'database is locked' in str(exc)
+
+
+def connect(db_path: str, statement_cache_size: int = 128, read_only: bool = False,
+            busy_timeout: float = BusyPolicy.timeout) -> Connection:
+    # Pooled connections are handed from thread to thread, but only ever used by one thread at a time.
+    if read_only:
+        return sqlite3.connect(f'{Path(db_path).absolute().as_uri()}?mode=ro',
+                               uri=True,
+                               timeout=busy_timeout,
+                               check_same_thread=False,
+                               cached_statements=statement_cache_size)
+
+    return sqlite3.connect(db_path, timeout=busy_timeout, check_same_thread=False,
+                           cached_statements=statement_cache_size)
+
+
+class DatabaseWriter:
+    # The one read-write connection of a database file. Writers take turns on the lock, so they never contend
+    # for SQLite's write lock themselves, and under WAL the read-only connections never block them either.
+    # Other processes (or a second server on the same file) still can, which is what the busy policy is for.
+    def __init__(self, db_path: str, statement_cache_size: int = 128, busy_policy: Optional[BusyPolicy] = None):
+        self.busy_policy = busy_policy or BusyPolicy()
+        self.connection = connect(db_path, statement_cache_size, busy_timeout=self.busy_policy.timeout)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.lock = threading.RLock()
+
+    @contextmanager
+    def locked(self) -> Generator[None, None, None]:
+        started = time.monotonic()
+        with self.lock:
+            _lock_stats.record_wait(time.monotonic() - started)
+            yield
+
+    def retry_busy(self, operation: Callable[[], R]) -> R:
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                result = operation()
+                _lock_stats.record_wait(time.monotonic() - started)
+                return result
+            except OperationalError as exc:
+                _lock_stats.record_wait(time.monotonic() - started)
+                if not is_busy(exc):
+                    raise
+                if attempt == self.busy_policy.retries:
+                    _lock_stats.increment('busy_failures')
+                    raise DatabaseBusyError(str(exc)) from exc
+                _lock_stats.increment('busy_retries')
+                time.sleep(self.busy_policy.delay(attempt))
+                attempt += 1
+
+    def begin(self) -> None:
+        # Write transactions take SQLite's write lock up front, where waiting and retrying is safe, instead of
+        # upgrading a read lock at the first write, which fails immediately when another writer got there first.
+        self.retry_busy(lambda: self.connection.execute('BEGIN IMMEDIATE'))
+
+    def commit(self) -> None:
+        self.retry_busy(self.connection.commit)
+
+    def checkpoint(self, mode: str = 'PASSIVE') -> Tuple[int, int, int]:
+        # PASSIVE copies what it can without waiting; TRUNCATE waits for readers, then empties the WAL file.
+        with self.locked():
+            return self.connection.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+
+    def optimize(self) -> None:
+        # Lets SQLite re-analyze the tables whose statistics it considers stale; usually cheap.
+        with self.locked():
+            self.connection.execute('PRAGMA optimize')
+
+    def analyze(self) -> None:
+        with self.locked():
+            self.connection.execute('ANALYZE')
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class DatabaseManager(repositories.Database):  # pylint: disable=too-many-instance-attributes
+    def __init__(self, db_path: str = DEFAULT_DB_PATH, statement_cache_size: int = 128,
+                 writer: Optional[DatabaseWriter] = None, sharded: bool = False,
+                 busy_policy: Optional[BusyPolicy] = None):
         self.db_path = db_path
-        self.initialize_database()
-        self.user_repository = self.UserRepository(self.db)
-        self.verification_repository = self.VerificationTokenRepository(
-            self.db)
-        self.auth_repository = self.AuthenticationTokenRepository(self.db)
+        self.statement_cache_size = statement_cache_size
+        self.busy_policy = busy_policy or (writer.busy_policy if writer else BusyPolicy())
+        # Shard files allocate bucket-encoded ids (see core.sharding) instead of relying on AUTOINCREMENT.
+        self.sharded = sharded
+        # A manager opened on its own owns its writer; pooled managers share the pool's writer.
+        self._owns_writer = writer is None
+        self._in_transaction = False
+        self.initialize_database(writer)
+        self._build_repositories(self)
 
-    def initialize_database(self) -> None:
+    def initialize_database(self, writer: Optional[DatabaseWriter] = None) -> None:
         try:
-            self.db: Connection = sqlite3.connect(self.db_path)
-            self.create_tables()
+            self.writer = writer or DatabaseWriter(self.db_path, self.statement_cache_size, self.busy_policy)
+            self.db: Connection = self.writer.connection
+            if self._owns_writer:
+                with self.writer.lock:
+                    self.create_tables()
+            # Opened after the schema exists: a read-only connection cannot create the database file.
+            self.read_only_db: Connection = connect(self.db_path, self.statement_cache_size, read_only=True,
+                                                    busy_timeout=self.busy_policy.timeout)
         except Error as exc:
             print(f'Error connecting to the database: {exc}')
 
     def create_tables(self) -> None:
         create_users_table_sql = '''CREATE TABLE IF NOT EXISTS users (
                                         id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                        email TEXT NOT NULL UNIQUE,
+                                        email TEXT NOT NULL COLLATE NOCASE,
                                         first_name TEXT NOT NULL,
                                         last_name TEXT NOT NULL,
                                         password TEXT NOT NULL,
-                                        email_verified BOOLEAN NOT NULL
+                                        email_verified INTEGER NOT NULL DEFAULT 0,
+                                        version INTEGER NOT NULL DEFAULT 1
                                     );'''
         create_verification_tokens_table_sql = '''CREATE TABLE IF NOT EXISTS verification_tokens (
                                                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                                                     user_id INTEGER NOT NULL UNIQUE,
                                                     token TEXT NOT NULL,
-                                                    expiry DATETIME NOT NULL,
+                                                    expiry INTEGER NOT NULL,
                                                     FOREIGN KEY (user_id) REFERENCES users(id)
                                                 );'''
         create_auth_tokens_table_sql = '''CREATE TABLE IF NOT EXISTS auth_tokens (
                                             token TEXT NOT NULL,
                                             user_id INTEGER NOT NULL,
-                                            expiry DATETIME NOT NULL,
+                                            expiry INTEGER NOT NULL,
                                             FOREIGN KEY (user_id) REFERENCES users(id)
                                         );'''
+        create_refresh_tokens_table_sql = '''CREATE TABLE IF NOT EXISTS refresh_tokens (
+                                               id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                               user_id INTEGER NOT NULL,
+                                               token_hash TEXT NOT NULL,
+                                               family_id TEXT NOT NULL,
+                                               expiry INTEGER NOT NULL,
+                                               revoked INTEGER NOT NULL DEFAULT 0,
+                                               FOREIGN KEY (user_id) REFERENCES users(id)
+                                           );'''
+        create_id_sequences_table_sql = '''CREATE TABLE IF NOT EXISTS id_sequences (
+                                             name TEXT NOT NULL,
+                                             bucket INTEGER NOT NULL,
+                                             value INTEGER NOT NULL,
+                                             PRIMARY KEY (name, bucket)
+                                         );'''
+        create_email_outbox_table_sql = '''CREATE TABLE IF NOT EXISTS email_outbox (
+                                              id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                              recipient TEXT NOT NULL,
+                                              subject TEXT NOT NULL,
+                                              body TEXT NOT NULL,
+                                              attempts INTEGER NOT NULL DEFAULT 0,
+                                              next_attempt_at INTEGER NOT NULL,
+                                              last_error TEXT
+                                          );'''
         try:
             cursor = self.db.cursor()
             cursor.execute(create_users_table_sql)
             cursor.execute(create_verification_tokens_table_sql)
             cursor.execute(create_auth_tokens_table_sql)
+            cursor.execute(create_refresh_tokens_table_sql)
+            cursor.execute(create_email_outbox_table_sql)
+            cursor.execute(create_id_sequences_table_sql)
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            if version < SCHEMA_VERSION:
+                self.migrate(cursor, version)
             self.db.commit()
         except Error as exc:
             print(f'Error creating the database table(s): {exc}')
             self.db.rollback()
             raise exc
 
-    def close(self):
-        if self.db:
-            self.db.close()
+    def migrate(self, cursor: Cursor, version: int) -> None:
+        if version < 1:
+            # Expiries written by sqlite3's datetime adapter are UTC text; store them as integer epoch seconds
+            # and booleans as 0/1 so range scans and deletes are plain integer comparisons on an index.
+            for table in ('verification_tokens', 'auth_tokens'):
+                cursor.execute(f'''UPDATE {table}
+                                   SET expiry = CAST(strftime('%s', expiry) AS INTEGER)
+                                   WHERE typeof(expiry) = 'text'
+                                ''')
+            cursor.execute('''UPDATE users
+                              SET email_verified = CASE WHEN email_verified THEN 1 ELSE 0 END
+                              WHERE typeof(email_verified) != 'integer'
+                           ''')
+            cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS users_email_nocase
+                              ON users(email COLLATE NOCASE)''')
+            cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS verification_tokens_token
+                              ON verification_tokens(token)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS verification_tokens_expiry
+                              ON verification_tokens(expiry)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS auth_tokens_user_id
+                              ON auth_tokens(user_id)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS auth_tokens_expiry
+                              ON auth_tokens(expiry)''')
+        if version < 2:
+            cursor.execute('''CREATE INDEX IF NOT EXISTS email_outbox_next_attempt_at
+                              ON email_outbox(next_attempt_at)''')
+        if version < 3:
+            cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS refresh_tokens_token_hash
+                              ON refresh_tokens(token_hash)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS refresh_tokens_family_id
+                              ON refresh_tokens(family_id)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS refresh_tokens_expiry
+                              ON refresh_tokens(expiry)''')
+        if version < 4:
+            # Databases created before the column existed; the CREATE TABLE above already has it otherwise.
+            columns = {row[1] for row in cursor.execute('PRAGMA table_info(users)')}
+            if 'version' not in columns:
+                cursor.execute('ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
 
-    class UserRepository:
-        def __init__(self, db: Connection):
-            self.db = db
+    def allocate_id(self, name: str, bucket: int) -> Optional[int]:
+        # Called with the writer held; None lets SQLite assign the id in an unsharded database.
+        if not self.sharded:
+            return None
+
+        sql = '''INSERT INTO id_sequences(name, bucket, value) VALUES(?, ?, 1)
+                 ON CONFLICT(name, bucket) DO UPDATE SET value = value + 1
+                 RETURNING value'''
+
+        return bucket_id(self.db.execute(sql, (name, bucket)).fetchone()[0], bucket)
+
+    def check_shard_layout(self, index: int, shard_count: int) -> None:
+        with self.writing() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS shard_layout (
+                              shard_index INTEGER NOT NULL,
+                              shard_count INTEGER NOT NULL
+                          )''')
+            row = db.execute('SELECT shard_index, shard_count FROM shard_layout').fetchone()
+            if row is None:
+                db.execute('INSERT INTO shard_layout VALUES(?, ?)', (index, shard_count))
+            elif row != (index, shard_count):
+                raise ValueError(f'{self.db_path} is shard {row[0]} of {row[1]}, not shard {index} of {shard_count}; '
+                                 f'run core.shard_rebalance to change the shard count.')
+
+    @property
+    def reader(self) -> Connection:
+        # Inside a transaction reads go through the writer, so they see the transaction's own changes.
+        return self.db if self._in_transaction else self.read_only_db
+
+    @contextmanager
+    def writing(self) -> Generator[Connection, None, None]:
+        # Repository writes commit on their own unless they run inside transaction(), which commits once at the end.
+        with self.writer.locked():
+            if self._in_transaction:
+                yield self.db
+                return
+
+            self.writer.begin()
+            try:
+                yield self.db
+                self.writer.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+
+    @contextmanager
+    def transaction(self) -> Generator['DatabaseManager', None, None]:
+        if self._in_transaction:
+            yield self
+            return
+
+        with self.writer.locked():
+            self.writer.begin()
+            self._in_transaction = True
+            try:
+                yield self
+                self.writer.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+            finally:
+                self._in_transaction = False
+
+    def close(self) -> None:
+        self.read_only_db.close()
+        if self._owns_writer:
+            self.writer.close()
+
+    class UserRepository(repositories.UserRepository):
+        GET_INTERNAL_USER_BY_EMAIL = Query(InternalUser,
+                                           '''SELECT id, email, first_name, last_name, password, email_verified, version
+                                              FROM users
+                                              WHERE email = ? COLLATE NOCASE''')
+        GET_CREDENTIALS_BY_EMAIL = Query(UserCredentials,
+                                         '''SELECT id, password, email_verified
+                                            FROM users
+                                            WHERE email = ? COLLATE NOCASE''')
+        GET_USER_BY_ID = Query(User,
+                               '''SELECT id, email, first_name, last_name, email_verified, version
+                                  FROM users
+                                  WHERE id = ?''')
+        LIST_USERS = Query(User,
+                           '''SELECT id, email, first_name, last_name, email_verified, version
+                              FROM users
+                              ORDER BY id''')
+
+        def __init__(self, manager: 'DatabaseManager'):
+            self.manager = manager
 
         def insert_user(self, user: UserIn) -> int:
-            sql = '''INSERT INTO users(email, first_name, last_name, password, email_verified)
-                    VALUES(?,?,?,?, False)'''
+            sql = '''INSERT INTO users(id, email, first_name, last_name, password, email_verified)
+                    VALUES(?,?,?,?,?,0)'''
             try:
-                cursor = self.db.cursor()
-                cursor.execute(sql, (user.email,
-                                     user.first_name,
-                                     user.last_name,
-                                     user.password))
-                self.db.commit()
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    cursor.execute(sql, (self.manager.allocate_id('users', email_bucket(user.email)),
+                                         user.email,
+                                         user.first_name,
+                                         user.last_name,
+                                         user.password))
 
                 return cursor.lastrowid
             except IntegrityError as exc:
@@ -88,121 +399,277 @@ class DatabaseManager:
                     'An error occurred. Please try again later.') from exc
 
         def get_internal_user_by_email(self, email: str) -> Optional[InternalUser]:
-            sql = '''SELECT id, email, first_name, last_name, password, email_verified
-                    FROM users
-                    WHERE email = ?'''
             try:
-                cursor = self.db.cursor()
-                cursor.execute(sql, (email,))
-                row = cursor.fetchone()
-                if row:
-                    return InternalUser(id=row[0],
-                                        email=row[1],
-                                        first_name=row[2],
-                                        last_name=row[3],
-                                        password=row[4],
-                                        email_verified=bool(row[5]))
-                return None
+                return self.GET_INTERNAL_USER_BY_EMAIL.fetch_one(self.manager.reader, (email,))
+            except Error as exc:
+                raise exc
+
+        def get_credentials_by_email(self, email: str) -> Optional[UserCredentials]:
+            try:
+                return self.GET_CREDENTIALS_BY_EMAIL.fetch_one(self.manager.reader, (email,))
             except Error as exc:
                 raise exc
 
         def get_user_by_id(self, id_: int) -> Optional[User]:
-            sql = 'SELECT id, email, first_name, last_name, email_verified FROM users WHERE id = ?'
             try:
-                cursor = self.db.cursor()
-                cursor.execute(sql, (id_,))
-                row = cursor.fetchone()
-                if row:
-                    return User(id=row[0],
-                                email=row[1],
-                                first_name=row[2],
-                                last_name=row[3],
-                                email_verified=bool(row[4]))
-                return None
+                return self.GET_USER_BY_ID.fetch_one(self.manager.reader, (id_,))
+            except Error as exc:
+                raise exc
+
+        def get_users_by_ids(self, ids: List[int]) -> List[User]:
+            # One statement per placeholder count; callers cap the batch size, which bounds the cached variants.
+            placeholders = ','.join('?' * len(ids))
+            sql = f'''SELECT id, email, first_name, last_name, email_verified, version
+                      FROM users
+                      WHERE id IN ({placeholders})'''
+            try:
+                return Query(User, sql).fetch_all(self.manager.reader, ids)
+            except Error as exc:
+                raise exc
+
+        def iter_users(self, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[User]:
+            try:
+                yield from self.LIST_USERS.stream(self.manager.reader, batch_size=batch_size)
             except Error as exc:
                 raise exc
 
         def verify_user(self, id_: int) -> bool:
-            sql = 'UPDATE users SET email_verified = true WHERE id = ?'
+            # Every change to a user bumps its version, which is what ETags on /current-user are derived from.
+            sql = 'UPDATE users SET email_verified = 1, version = version + 1 WHERE id = ?'
             try:
-                cursor = self.db.cursor()
-                cursor.execute(sql, (id_,))
-                self.db.commit()
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    cursor.execute(sql, (id_,))
 
                 return cursor.rowcount > 0
             except Error as exc:
                 raise exc
 
-    class VerificationTokenRepository:
-        def __init__(self, db: Connection):
-            self.db = db
+    class VerificationTokenRepository(repositories.VerificationTokenRepository):
+        GET_BY_TOKEN = Query(UserVerificationToken,
+                             'SELECT id, user_id, token, expiry FROM verification_tokens WHERE token = ?')
+        GET_BY_ID = Query(UserVerificationToken,
+                          'SELECT id, user_id, token, expiry FROM verification_tokens WHERE id = ?')
+        VERIFY_TOKEN_USER = Query(User,
+                                  '''UPDATE users SET email_verified = 1, version = version + 1
+                                     WHERE id = (SELECT user_id FROM verification_tokens
+                                                 WHERE token = ? AND expiry >= ?)
+                                     RETURNING id, email, first_name, last_name, email_verified, version''')
+
+        def __init__(self, manager: 'DatabaseManager'):
+            self.manager = manager
 
         def insert_verification_token(self, user_id: int, token: str, expiry: datetime) -> int:
-            sql = 'INSERT INTO verification_tokens(user_id, token, expiry) VALUES(?,?,?)'
+            sql = 'INSERT INTO verification_tokens(id, user_id, token, expiry) VALUES(?,?,?,?)'
             try:
-                cursor = self.db.cursor()
-                cursor.execute(sql, (user_id, token, expiry))
-                self.db.commit()
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    id_ = self.manager.allocate_id('verification_tokens', id_bucket(user_id))
+                    cursor.execute(sql, (id_, user_id, token, to_epoch(expiry)))
 
                 return cursor.lastrowid
             except Error as exc:
                 raise exc
 
         def get_verification_token(self, token: str) -> Optional[UserVerificationToken]:
-            sql = 'SELECT id, user_id, token, expiry FROM verification_tokens WHERE token = ?'
             try:
-                cursor = self.db.cursor()
-                cursor.execute(sql, (token,))
-                row = cursor.fetchone()
-                if row:
-                    return UserVerificationToken(id=row[0], user_id=row[1], token=row[2], expiry=row[3])
-                return None
+                return self.GET_BY_TOKEN.fetch_one(self.manager.reader, (token,))
             except Error as exc:
                 raise exc
 
         def get_verification_token_by_id(self, id_: int) -> Optional[UserVerificationToken]:
-            sql = 'SELECT id, user_id, token, expiry FROM verification_tokens WHERE id = ?'
             try:
-                cursor = self.db.cursor()
-                cursor.execute(sql, (id_,))
-                row = cursor.fetchone()
-                if row:
-                    return UserVerificationToken(id=row[0], user_id=row[1], token=row[2], expiry=row[3])
-                return None
+                return self.GET_BY_ID.fetch_one(self.manager.reader, (id_,))
             except Error as exc:
                 raise exc
 
         def delete_verification_token(self, token: str) -> None:
             sql = 'DELETE FROM verification_tokens WHERE token = ?'
             try:
-                cursor = self.db.cursor()
-                cursor.execute(sql, (token,))
-                self.db.commit()
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    cursor.execute(sql, (token,))
             except Error as exc:
                 raise exc
 
-    class AuthenticationTokenRepository:
-        def __init__(self, db: Connection):
-            self.db = db
+        def redeem_verification_token(self, token: str, now: int) -> Optional[User]:
+            # Both statements run under the writer lock and commit together, so of two concurrent redemptions
+            # only the first finds the token.
+            try:
+                with self.manager.writing() as db:
+                    user = self.VERIFY_TOKEN_USER.fetch_one(db, (token, now))
+                    if user:
+                        db.execute('DELETE FROM verification_tokens WHERE token = ?', (token,))
+
+                return user
+            except Error as exc:
+                raise exc
+
+        def delete_expired_verification_tokens(self, before: datetime) -> int:
+            sql = 'DELETE FROM verification_tokens WHERE expiry < ?'
+            try:
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    cursor.execute(sql, (to_epoch(before),))
+
+                return cursor.rowcount
+            except Error as exc:
+                raise exc
+
+    class AuthenticationTokenRepository(repositories.AuthenticationTokenRepository):
+        def __init__(self, manager: 'DatabaseManager'):
+            self.manager = manager
 
         def insert_auth_token(self, user_id: int, token: str, expiry: datetime) -> int:
-            sql = 'INSERT INTO auth_tokens(user_id, token, expiry) VALUES(?,?,?)'
+            sql = 'INSERT INTO auth_tokens(rowid, user_id, token, expiry) VALUES(?,?,?,?)'
             try:
-                cursor = self.db.cursor()
-                cursor.execute(sql, (user_id, token, expiry))
-                self.db.commit()
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    id_ = self.manager.allocate_id('auth_tokens', id_bucket(user_id))
+                    cursor.execute(sql, (id_, user_id, token, to_epoch(expiry)))
 
                 return cursor.lastrowid
             except Error as exc:
                 raise exc
 
-        def get_auth_token_user_by_id(self, user_id: int) -> str:
+        def get_auth_token_user_by_id(self, user_id: int) -> Optional[str]:
             sql = 'SELECT token FROM auth_tokens WHERE user_id = ?'
             try:
-                cursor = self.db.cursor()
-                cursor.execute(sql, (user_id,))
-                row = cursor.fetchone()
+                row = self.manager.reader.execute(sql, (user_id,)).fetchone()
 
                 return row[0] if row else None
             except Error as exc:
                 raise exc
+
+        def delete_expired_auth_tokens(self, before: datetime) -> int:
+            sql = 'DELETE FROM auth_tokens WHERE expiry < ?'
+            try:
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    cursor.execute(sql, (to_epoch(before),))
+
+                return cursor.rowcount
+            except Error as exc:
+                raise exc
+
+    class RefreshTokenRepository(repositories.RefreshTokenRepository):
+        GET_BY_TOKEN_HASH = Query(RefreshToken,
+                                  '''SELECT id, user_id, family_id, expiry, revoked
+                                     FROM refresh_tokens
+                                     WHERE token_hash = ?''')
+
+        def __init__(self, manager: 'DatabaseManager'):
+            self.manager = manager
+
+        def insert_refresh_token(self, user_id: int, token_hash: str, family_id: str, expiry: datetime) -> int:
+            sql = 'INSERT INTO refresh_tokens(id, user_id, token_hash, family_id, expiry) VALUES(?,?,?,?,?)'
+            try:
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    id_ = self.manager.allocate_id('refresh_tokens', id_bucket(user_id))
+                    cursor.execute(sql, (id_, user_id, token_hash, family_id, to_epoch(expiry)))
+
+                return cursor.lastrowid
+            except Error as exc:
+                raise exc
+
+        def get_refresh_token(self, token_hash: str) -> Optional[RefreshToken]:
+            try:
+                return self.GET_BY_TOKEN_HASH.fetch_one(self.manager.reader, (token_hash,))
+            except Error as exc:
+                raise exc
+
+        def revoke_refresh_token(self, id_: int) -> bool:
+            # Only the first of two concurrent refreshes with the same token sees a row change.
+            sql = 'UPDATE refresh_tokens SET revoked = 1 WHERE id = ? AND revoked = 0'
+            try:
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    cursor.execute(sql, (id_,))
+
+                return cursor.rowcount > 0
+            except Error as exc:
+                raise exc
+
+        def revoke_refresh_token_family(self, family_id: str, user_id: int) -> int:
+            sql = 'UPDATE refresh_tokens SET revoked = 1 WHERE family_id = ? AND user_id = ? AND revoked = 0'
+            try:
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    cursor.execute(sql, (family_id, user_id))
+
+                return cursor.rowcount
+            except Error as exc:
+                raise exc
+
+        def delete_expired_refresh_tokens(self, before: datetime) -> int:
+            sql = 'DELETE FROM refresh_tokens WHERE expiry < ?'
+            try:
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    cursor.execute(sql, (to_epoch(before),))
+
+                return cursor.rowcount
+            except Error as exc:
+                raise exc
+
+    class OutboxRepository(repositories.OutboxRepository):
+        # Claiming pushes next_attempt_at past the lease in the same statement that selects the rows, so
+        # dispatchers in other processes skip messages that are already being sent.
+        CLAIM_DUE = Query(OutboundEmail,
+                          '''UPDATE email_outbox
+                             SET next_attempt_at = ?
+                             WHERE id IN (SELECT id
+                                          FROM email_outbox
+                                          WHERE next_attempt_at <= ? AND attempts < ?
+                                          ORDER BY next_attempt_at
+                                          LIMIT ?)
+                             RETURNING id, recipient, subject, body, attempts''')
+
+        def __init__(self, manager: 'DatabaseManager'):
+            self.manager = manager
+
+        def enqueue(self, recipient: str, subject: str, body: str, send_after: int) -> int:
+            sql = 'INSERT INTO email_outbox(id, recipient, subject, body, next_attempt_at) VALUES(?,?,?,?,?)'
+            try:
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    id_ = self.manager.allocate_id('email_outbox', email_bucket(recipient))
+                    cursor.execute(sql, (id_, recipient, subject, body, send_after))
+
+                return cursor.lastrowid
+            except Error as exc:
+                raise exc
+
+        def claim_due(self, now: int, limit: int, max_attempts: int, lease_until: int) -> List[OutboundEmail]:
+            try:
+                with self.manager.writing() as db:
+                    return self.CLAIM_DUE.fetch_all(db, (lease_until, now, max_attempts, limit))
+            except Error as exc:
+                raise exc
+
+        def mark_sent(self, ids: List[int]) -> None:
+            sql = 'DELETE FROM email_outbox WHERE id = ?'
+            try:
+                with self.manager.writing() as db:
+                    db.executemany(sql, [(id_,) for id_ in ids])
+            except Error as exc:
+                raise exc
+
+        def mark_failed(self, id_: int, retry_at: int, error: str) -> None:
+            sql = '''UPDATE email_outbox
+                     SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?
+                     WHERE id = ?'''
+            try:
+                with self.manager.writing() as db:
+                    cursor = db.cursor()
+                    cursor.execute(sql, (retry_at, error, id_))
+            except Error as exc:
+                raise exc
+
+        def count_pending(self, max_attempts: int) -> int:
+            sql = 'SELECT COUNT(*) FROM email_outbox WHERE attempts < ?'
+            try:
+                return self.manager.reader.execute(sql, (max_attempts,)).fetchone()[0]
+            except Error as exc:
+                raise exc
@@ -2,16 +2,305 @@
 # All rights reserved
 
 
+import threading
+from abc import ABC, abstractmethod
 from contextlib import contextmanager
-from typing import Generator
+from typing import ContextManager, Dict, Generator, Iterator, List, Optional, Union
 
-from core.database_manager import DatabaseManager
+from core.configuration import Settings, get_settings
+from core.database_manager import DEFAULT_DB_PATH, BusyPolicy, DatabaseManager, DatabaseWriter
+from core.email_filter import EmailFilter
+from core.memory_database import InMemoryDatabase
+from core.repositories import Database
+from core.sharded_database import ShardedDatabase
+from core.sharding import shard_paths
+
+
+class DatabaseProvider(ABC):
+    # Set by build_email_filter() once the provider serves requests; None means every email may exist.
+    email_filter: Optional[EmailFilter] = None
+
+    @abstractmethod
+    def connection(self) -> ContextManager[Database]:
+        pass
+
+    @abstractmethod
+    def clear(self) -> None:
+        pass
+
+    def writers(self) -> Dict[str, DatabaseWriter]:
+        # The writer of every SQLite file behind the provider, by path; empty for storage without files.
+        return {}
+
+
+class SharedDatabase(DatabaseProvider):
+    # Hands the same thread-safe database to every request, e.g. the in-memory backend.
+    def __init__(self, db: Database):
+        self.db = db
+
+    @contextmanager
+    def connection(self) -> Generator[Database, None, None]:
+        yield self.db
+
+    def clear(self) -> None:
+        pass
+
+
+class DatabasePool(DatabaseProvider):  # pylint: disable=too-many-instance-attributes
+    # Pools read-only connections; every pooled manager routes its writes through the pool's single writer.
+    def __init__(self, db_path: str = DEFAULT_DB_PATH, size: Optional[int] = None,
+                 statement_cache_size: Optional[int] = None, sharded: bool = False):
+        settings = get_settings()
+        self.db_path = db_path
+        self.sharded = sharded
+        self.size = size or settings.db_pool_size
+        self.statement_cache_size = statement_cache_size or settings.statement_cache_size
+        self.busy_policy = BusyPolicy(settings.db_busy_timeout, settings.db_busy_retries,
+                                      settings.db_busy_retry_backoff)
+        self._idle: List[DatabaseManager] = []
+        self._lock = threading.Lock()
+        self._writer: Optional[DatabaseWriter] = None
+
+    def _get_writer(self) -> DatabaseWriter:
+        with self._lock:
+            if self._writer is None:
+                # The schema is created through a standalone manager, which also switches the file to WAL.
+                DatabaseManager(self.db_path, statement_cache_size=self.statement_cache_size,
+                                busy_policy=self.busy_policy).close()
+                self._writer = DatabaseWriter(self.db_path, statement_cache_size=self.statement_cache_size,
+                                              busy_policy=self.busy_policy)
+
+            return self._writer
+
+    def writers(self) -> Dict[str, DatabaseWriter]:
+        return {self.db_path: self._get_writer()}
+
+    def _connect(self) -> DatabaseManager:
+        return DatabaseManager(self.db_path, statement_cache_size=self.statement_cache_size,
+                               writer=self._get_writer(), sharded=self.sharded)
+
+    def warm_up(self) -> None:
+        managers = [self._connect() for _ in range(max(self.size - len(self._idle), 0))]
+        for manager in managers:
+            self.release(manager)
+
+    def resize(self, size: int) -> None:
+        with self._lock:
+            self.size = size
+            surplus, self._idle = self._idle[size:], self._idle[:size]
+        for db in surplus:
+            db.close()
+
+    def acquire(self) -> DatabaseManager:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+
+        return self._connect()
+
+    def release(self, db: DatabaseManager) -> None:
+        with self._lock:
+            # Managers still holding a writer closed by clear() are not reused.
+            if db.writer is self._writer and len(self._idle) < self.size:
+                self._idle.append(db)
+                return
+        db.close()
+
+    def clear(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+            writer, self._writer = self._writer, None
+        for db in idle:
+            db.close()
+        if writer:
+            writer.close()
+
+    @contextmanager
+    def connection(self) -> Generator[DatabaseManager, None, None]:
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+
+class ShardedDatabasePool(DatabaseProvider):
+    # One pool per shard file; each request gets a ShardedDatabase that borrows from the shards it touches.
+    def __init__(self, db_path: str = DEFAULT_DB_PATH, shard_count: int = 2, size: Optional[int] = None,
+                 statement_cache_size: Optional[int] = None):
+        self.db_path = db_path
+        self.pools = [DatabasePool(path, size=size, statement_cache_size=statement_cache_size, sharded=True)
+                      for path in shard_paths(db_path, shard_count)]
+        for index, path in enumerate(shard_paths(db_path, shard_count)):
+            db = DatabaseManager(path)
+            try:
+                db.check_shard_layout(index, shard_count)
+            finally:
+                db.close()
+
+    @property
+    def statement_cache_size(self) -> int:
+        return self.pools[0].statement_cache_size
+
+    @statement_cache_size.setter
+    def statement_cache_size(self, size: int) -> None:
+        for pool in self.pools:
+            pool.statement_cache_size = size
+
+    def warm_up(self) -> None:
+        for pool in self.pools:
+            pool.warm_up()
+
+    def resize(self, size: int) -> None:
+        for pool in self.pools:
+            pool.resize(size)
+
+    def clear(self) -> None:
+        for pool in self.pools:
+            pool.clear()
+
+    def writers(self) -> Dict[str, DatabaseWriter]:
+        return {path: writer for pool in self.pools for path, writer in pool.writers().items()}
+
+    @contextmanager
+    def connection(self) -> Generator[ShardedDatabase, None, None]:
+        db = ShardedDatabase(self.pools)
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+_provider: Optional[DatabaseProvider] = None  # pylint: disable=invalid-name
+_provider_lock = threading.Lock()
+
+
+def use_database(provider: Optional[DatabaseProvider]) -> Optional[DatabaseProvider]:
+    global _provider  # pylint: disable=global-statement
+    with _provider_lock:
+        previous, _provider = _provider, provider
+
+    return previous
+
+
+def configure_database(db_path: str = DEFAULT_DB_PATH, size: Optional[int] = None,
+                       shards: int = 0) -> DatabaseProvider:
+    # Any shard count, even 1, selects the sharded layout of <name>.<index>.db files next to db_path.
+    pool: Union[DatabasePool, ShardedDatabasePool]
+    if shards:
+        pool = ShardedDatabasePool(db_path=db_path, shard_count=shards, size=size)
+    else:
+        pool = DatabasePool(db_path=db_path, size=size)
+    pool.warm_up()
+    build_email_filter(pool)
+    previous = use_database(pool)
+    if previous:
+        previous.clear()
+
+    return pool
+
+
+def configure_in_memory_database() -> InMemoryDatabase:
+    db = InMemoryDatabase()
+    provider = SharedDatabase(db)
+    build_email_filter(provider)
+    previous = use_database(provider)
+    if previous:
+        previous.clear()
+
+    return db
+
+
+def get_database_provider() -> DatabaseProvider:
+    global _provider  # pylint: disable=global-statement
+    with _provider_lock:
+        if _provider is None:
+            _provider = DatabasePool()
+
+        return _provider
+
+
+def clear_database_pool() -> None:
+    with _provider_lock:
+        provider = _provider
+    if provider:
+        provider.clear()
+
+
+def _registered_emails(provider: DatabaseProvider) -> Iterator[str]:
+    with provider.connection() as db:
+        for user in db.user_repository.iter_users():
+            yield user.email
+
+
+def build_email_filter(provider: DatabaseProvider, settings: Optional[Settings] = None) -> Optional[EmailFilter]:
+    # Built from the users table when storage is configured, so it knows every user of a freshly started server,
+    # including after a rebalance; users written by other processes later are picked up by the periodic refresh.
+    settings = settings or get_settings()
+    if settings.email_filter == 'off':
+        provider.email_filter = None
+        return None
+
+    email_filter = EmailFilter(lambda: _registered_emails(provider), settings.email_filter_false_positive_rate)
+    email_filter.rebuild()
+    provider.email_filter = email_filter
+
+    return email_filter
+
+
+def get_email_filter() -> Optional[EmailFilter]:
+    return get_database_provider().email_filter
+
+
+_email_filter_refresh: Optional[threading.Event] = None  # pylint: disable=invalid-name
+
+
+def _refresh_email_filter(stopping: threading.Event) -> None:
+    while not stopping.wait(get_settings().email_filter_refresh_interval.total_seconds()):
+        email_filter = get_email_filter()
+        if email_filter is None:
+            continue
+        try:
+            email_filter.rebuild()
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f'Error refreshing the email filter: {exc}')
+
+
+def start_email_filter_refresh() -> bool:
+    # Rebuilds the filter every EMAIL_FILTER_REFRESH_INTERVAL_IN_MINS, so a user written by another process, such as
+    # the load generator seeding users or the previous process finishing its requests after a SIGUSR2 handover, can
+    # log in after at most that long. Only SQLite files can be written by anyone else.
+    global _email_filter_refresh  # pylint: disable=global-statement
+    if not get_database_provider().writers():
+        return False
+
+    stopping = _email_filter_refresh = threading.Event()
+    threading.Thread(target=_refresh_email_filter, args=(stopping,), name='email-filter-refresh', daemon=True).start()
+
+    return True
+
+
+def stop_email_filter_refresh() -> None:
+    global _email_filter_refresh  # pylint: disable=global-statement
+    stopping, _email_filter_refresh = _email_filter_refresh, None
+    if stopping:
+        stopping.set()
+
+
+def apply_settings(settings: Settings) -> None:
+    provider = get_database_provider()
+    if (settings.email_filter == 'on') != (provider.email_filter is not None):
+        build_email_filter(provider, settings)
+    elif provider.email_filter is not None:
+        # Takes effect with the next rebuild.
+        provider.email_filter.false_positive_rate = settings.email_filter_false_positive_rate
+    if isinstance(provider, (DatabasePool, ShardedDatabasePool)):
+        # Statement cache size only applies to connections opened after the reload.
+        provider.statement_cache_size = settings.statement_cache_size
+        provider.resize(settings.db_pool_size)
 
 
 @contextmanager
-def get_db() -> Generator[DatabaseManager, None, None]:
-    db = DatabaseManager()
-    try:
+def get_db() -> Generator[Database, None, None]:
+    with get_database_provider().connection() as db:
         yield db
-    finally:
-        db.close()
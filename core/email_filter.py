@@ -0,0 +1,136 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import hashlib
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+
+# Filters are sized for at least this many emails, and for twice the number of registered users when rebuilt.
+MIN_CAPACITY = 10000
+
+
+class BloomFilter:
+    # Bits are only ever set, so lookups can read without a lock; adds to a live filter are serialized by EmailFilter.
+    def __init__(self, capacity: int, false_positive_rate: float):
+        self.capacity = capacity
+        self.bit_count = max(int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2), 8)
+        self.hash_count = max(round(self.bit_count / capacity * math.log(2)), 1)
+        self.count = 0
+        self._bits = bytearray((self.bit_count + 7) // 8)
+
+    def _positions(self, key: str) -> Iterable[int]:
+        # Double hashing: k positions from the two halves of one digest.
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+
+        return ((first + index * second) % self.bit_count for index in range(self.hash_count))
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self._bits)
+
+    def estimated_false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.hash_count * self.count / self.bit_count)) ** self.hash_count
+
+
+class EmailFilter:  # pylint: disable=too-many-instance-attributes
+    # Answers "definitely not registered" for an email without a database query. `source` yields every registered
+    # email and is read on rebuild. Registrations are added as they happen, and those added while a rebuild reads
+    # the source are replayed into the new filter before it replaces the old one, so no user is ever missed.
+    # Once more emails were added than the filter was sized for, it rebuilds in the background.
+    def __init__(self, source: Callable[[], Iterable[str]], false_positive_rate: float):
+        self.source = source
+        self.false_positive_rate = false_positive_rate
+        self._current: Optional[BloomFilter] = None
+        self._added_during_rebuild: Optional[List[str]] = None
+        self._lock = threading.Lock()
+        self._rebuilds = 0
+        self._lookups = 0
+        self._negatives = 0
+
+    @staticmethod
+    def _key(email: str) -> str:
+        return email.strip().lower()
+
+    def might_contain(self, email: str) -> bool:
+        current = self._current
+        found = current is None or self._key(email) in current
+        with self._lock:
+            self._lookups += 1
+            if not found:
+                self._negatives += 1
+
+        return found
+
+    def add(self, email: str) -> None:
+        key = self._key(email)
+        with self._lock:
+            if self._current is not None:
+                self._current.add(key)
+            if self._added_during_rebuild is not None:
+                self._added_during_rebuild.append(key)
+            overfull = (self._added_during_rebuild is None and self._current is not None
+                        and self._current.count > self._current.capacity)
+        if overfull:
+            self.rebuild_in_background()
+
+    def _fill(self, capacity: int) -> BloomFilter:
+        bloom_filter = BloomFilter(capacity, self.false_positive_rate)
+        for email in self.source():
+            bloom_filter.add(self._key(email))
+
+        return bloom_filter
+
+    def rebuild(self) -> Dict[str, object]:
+        with self._lock:
+            rebuilding = self._added_during_rebuild is not None
+            if not rebuilding:
+                self._added_during_rebuild = []
+            capacity = max(2 * self._current.count if self._current else 0, MIN_CAPACITY)
+        if rebuilding:
+            return self.stats()
+        try:
+            bloom_filter = self._fill(capacity)
+            if bloom_filter.count > bloom_filter.capacity:
+                # Sized before the users were counted on a first build; fill once more at the right size.
+                bloom_filter = self._fill(2 * bloom_filter.count)
+            with self._lock:
+                for key in self._added_during_rebuild or ():
+                    bloom_filter.add(key)
+                self._current = bloom_filter
+                self._rebuilds += 1
+        finally:
+            with self._lock:
+                self._added_during_rebuild = None
+
+        return self.stats()
+
+    def rebuild_in_background(self) -> None:
+        threading.Thread(target=self.rebuild, name='email-filter-rebuild', daemon=True).start()
+
+    def stats(self) -> Dict[str, object]:
+        current = self._current
+        with self._lock:
+            stats: Dict[str, object] = {'target_false_positive_rate': self.false_positive_rate,
+                                        'rebuilding': self._added_during_rebuild is not None,
+                                        'rebuilds': self._rebuilds,
+                                        'lookups': self._lookups,
+                                        'negatives': self._negatives}
+        if current is not None:
+            stats.update(capacity=current.capacity,
+                         count=current.count,
+                         size_bytes=current.size_bytes,
+                         hash_count=current.hash_count,
+                         false_positive_rate=current.estimated_false_positive_rate())
+
+        return stats
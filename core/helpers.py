@@ -2,26 +2,39 @@
 # All rights reserved
 
 
+import calendar
 import inspect
 import re
 from dataclasses import fields
 from datetime import datetime
-from functools import wraps
-from typing import Any, Dict, Tuple, Type, TypeVar
+from functools import lru_cache, wraps
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple, Type, TypeVar
 from urllib.parse import parse_qs
 
-import jwt
-
-from core.configuration import SECRET_KEY
+from core.signing_keys import get_key_ring
 
 T = TypeVar('T', bound='ValidationMixin')
 
+EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+PASSWORD_PATTERN = re.compile(r'^(?=.*[A-Za-z])(?=.*\d)[A-Za-z\d]{8,}$')
+
+
+def schema_field_names(cls: type) -> FrozenSet[str]:
+    # A plain type is Hashable to mypy, unlike the Type[T] callers hold.
+    return _schema_field_names(cls)
+
+
+@lru_cache(maxsize=None)
+def _schema_field_names(cls: type) -> FrozenSet[str]:
+    return frozenset(field.name for field in fields(cls))
+
 
 class ValidationMixin:
+    __slots__ = ()
+
     @staticmethod
     def is_valid_email(email: str) -> bool:
-        pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        return re.match(pattern, email) is not None
+        return isinstance(email, str) and EMAIL_PATTERN.match(email) is not None
 
     @staticmethod
     def is_non_empty_string(string: str) -> bool:
@@ -29,27 +42,46 @@ class ValidationMixin:
 
     @staticmethod
     def password_strength(password: str) -> bool:
-        pattern = r'^(?=.*[A-Za-z])(?=.*\d)[A-Za-z\d]{8,}$'
-        return re.match(pattern, password) is not None
+        return isinstance(password, str) and PASSWORD_PATTERN.match(password) is not None
+
+    @staticmethod
+    def is_integer(value: Any) -> bool:
+        # bool is a subclass of int, but true/false are never meant as ids.
+        return isinstance(value, int) and not isinstance(value, bool)
 
     @classmethod
     def from_dict(cls: Type[T], request: Dict[str, Any]) -> T:
-        required_keys = {field.name for field in fields(cls)}
-        request_keys = set(request.keys())
+        if not isinstance(request, dict):
+            raise ValueError('Request body must be a JSON object.')
 
-        missing_keys = sorted(required_keys - request_keys)
-        extra_keys = sorted(request_keys - required_keys)
+        required_keys = schema_field_names(cls)
+        if request.keys() != required_keys:
+            request_keys = set(request.keys())
+            missing_keys = sorted(required_keys - request_keys)
+            extra_keys = sorted(request_keys - required_keys)
 
-        if missing_keys:
-            raise ValueError(
-                f"Request is missing required key(s): {', '.join(missing_keys)}.")
+            if missing_keys:
+                raise ValueError(
+                    f"Request is missing required key(s): {', '.join(missing_keys)}.")
 
-        if extra_keys:
-            raise ValueError(
-                f"Request contains unrecognized key(s): {', '.join(extra_keys)}.")
+            if extra_keys:
+                raise ValueError(
+                    f"Request contains unrecognized key(s): {', '.join(extra_keys)}.")
 
         return cls(**request)  # type: ignore
 
+    @classmethod
+    def validate_many(cls: Type[T], requests: Iterable[Dict[str, Any]]) -> List[Tuple[Optional[T], Optional[str]]]:
+        # Batch endpoints answer per item, so an invalid item only fails itself instead of the whole batch.
+        results: List[Tuple[Optional[T], Optional[str]]] = []
+        for request in requests:
+            try:
+                results.append((cls.from_dict(request), None))
+            except ValueError as exc:
+                results.append((None, str(exc)))
+
+        return results
+
 
 def parse_query_params(query_string: str) -> dict:
     query_params = parse_qs(query_string)
@@ -57,20 +89,67 @@ def parse_query_params(query_string: str) -> dict:
     return {key: value[0] if len(value) == 1 else value for key, value in query_params.items()}
 
 
+def get_header(headers: Dict[str, str], name: str) -> Optional[str]:
+    # Header names are case-insensitive, but the handler passes them on as sent by the client.
+    name = name.lower()
+
+    return next((value for key, value in headers.items() if key.lower() == name), None)
+
+
+UNIX_SOCKET_PEER = 'unix'
+
+
+def forwarded_client(peer: str, headers: Dict[str, str], trusted_proxies: Tuple[str, ...]) -> str:
+    # The peer is the client unless it is a trusted proxy, where 'unix' stands for peers on the Unix socket, which
+    # have no address. Then the client is the last X-Forwarded-For address that is not a trusted proxy itself; the
+    # ones before it are whatever the client sent. Without one the client is unknown, which is ''.
+    hops = [hop.strip() for hop in (get_header(headers, 'X-Forwarded-For') or '').split(',') if hop.strip()]
+    address = peer
+    while (address or UNIX_SOCKET_PEER) in trusted_proxies:
+        if not hops:
+            return ''
+        address = hops.pop()
+
+    return address
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored on both sides.
+    return etag.removeprefix('W/') in {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+
+
 def argument_injector(func):
+    parameters = frozenset(inspect.signature(func).parameters)
+
     @wraps(func)
     def wrapper(**kwargs):
-        sig = inspect.signature(func)
-        func_kwargs = {k: v for k, v in kwargs.items() if k in sig.parameters}
+        func_kwargs = {k: v for k, v in kwargs.items() if k in parameters}
 
         return func(**func_kwargs)
     return wrapper
 
 
+def to_epoch(value: datetime) -> int:
+    # Naive datetimes are UTC throughout the service (datetime.utcnow()).
+    return calendar.timegm(value.utctimetuple())
+
+
 def decode_jwt(token: str) -> Tuple[str, datetime]:
+    import jwt  # pylint: disable=import-outside-toplevel
+
     if token.startswith('Bearer '):
         token = token[7:]
 
-    decoded_token = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+    # The key is picked by the token's kid from the parsed key ring, and only that key's algorithm is accepted,
+    # so a token cannot choose how it is verified.
+    key = get_key_ring().get(jwt.get_unverified_header(token).get('kid'))
+    if key is None:
+        raise jwt.InvalidTokenError('Unknown signing key.')
+    decoded_token = jwt.decode(token, key.verifying_key, algorithms=[key.algorithm])
 
     return decoded_token['user_id'], decoded_token['expiry']
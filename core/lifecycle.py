@@ -0,0 +1,86 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Generator, List
+
+
+class LifecycleManager:
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._flush_callbacks: List[Callable[[], None]] = []
+        self.stopping = threading.Event()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @contextmanager
+    def track(self) -> Generator[None, None, None]:
+        with self._condition:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                if not self._in_flight:
+                    self._condition.notify_all()
+
+    def add_flush_callback(self, callback: Callable[[], None]) -> None:
+        self._flush_callbacks.append(callback)
+
+    def remove_flush_callback(self, callback: Callable[[], None]) -> None:
+        self._flush_callbacks.remove(callback)
+
+    def start(self) -> None:
+        # The module-level lifecycle outlives its servers, so one started again in the same process, as tests do,
+        # must not begin already stopping.
+        self.stopping.clear()
+
+    def stop(self, httpd) -> None:
+        # shutdown() blocks until serve_forever() returns, so it must not run on the serving thread, which is
+        # where signal handlers execute in the single-threaded mode.
+        if not self.stopping.is_set():
+            self.stopping.set()
+            threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    def wait_for_drain(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+
+        return True
+
+    def flush(self) -> None:
+        # Each callback runs once: it stops what the server it was registered for started, so a server started
+        # later on the same lifecycle (as tests do) registers its own instead of piling up on the old ones.
+        callbacks, self._flush_callbacks = self._flush_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as exc:  # pylint: disable=broad-except
+                print(f'Error flushing background work: {exc}')
+
+    def drain(self, timeout: float) -> bool:
+        drained = self.wait_for_drain(timeout)
+        if not drained:
+            print(f'Shutdown deadline reached with {self._in_flight} request(s) in flight.')
+        self.flush()
+
+        return drained
+
+
+_lifecycle = LifecycleManager()  # pylint: disable=invalid-name
+
+
+def get_lifecycle() -> LifecycleManager:
+    return _lifecycle
@@ -0,0 +1,153 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import random
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+from typing import List, Optional, Tuple
+
+from core.configuration import Settings, get_settings
+from core.dependencies import get_db
+from core.schemas import OutboundEmail
+
+# How long a claimed message stays invisible to other dispatchers before it is considered abandoned.
+CLAIM_LEASE_IN_SECS = 300
+MAX_RETRY_DELAY_IN_SECS = 3600
+
+
+def retry_delay(attempts: int, backoff: float) -> float:
+    # Exponential backoff with jitter, so a recovering mail server is not hit by every failed message at once.
+    delay = min(backoff * 2 ** attempts, MAX_RETRY_DELAY_IN_SECS)
+
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class MailDispatcher:
+    # Sends messages written to the outbox by the request path. Requests never wait on the mail server: they
+    # only insert a row, and this thread delivers due messages in batches over one SMTP connection that is
+    # kept open while there is work and closed once the outbox is empty.
+    def __init__(self, settings: Optional[Settings] = None, smtp_class=smtplib.SMTP):
+        self.settings = settings
+        self.smtp_class = smtp_class
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _current_settings(self) -> Settings:
+        # Without explicit settings the dispatcher follows configuration reloads.
+        return self.settings or get_settings()
+
+    def _connection(self, settings: Settings) -> smtplib.SMTP:
+        if self._smtp is None:
+            self._smtp = self.smtp_class(settings.smtp_host, settings.smtp_port, timeout=10)
+
+        return self._smtp
+
+    def _disconnect(self) -> None:
+        smtp, self._smtp = self._smtp, None
+        if smtp is None:
+            return
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def _send(self, message: OutboundEmail, settings: Settings) -> None:
+        email = EmailMessage()
+        email['From'] = settings.smtp_sender
+        email['To'] = message.recipient
+        email['Subject'] = message.subject
+        email.set_content(message.body)
+        try:
+            self._connection(settings).send_message(email)
+        except smtplib.SMTPServerDisconnected:
+            # The server may have dropped the reused connection while it was idle; reconnect once.
+            self._disconnect()
+            self._connection(settings).send_message(email)
+
+    def _fail_batch(self, messages: List[OutboundEmail], error: str,
+                    failed: List[Tuple[OutboundEmail, str]]) -> None:
+        # The server is unreachable: fail the rest of the batch now instead of timing out on each message.
+        self._disconnect()
+        failed.extend((message, error) for message in messages)
+
+    def dispatch_once(self) -> int:
+        settings = self._current_settings()
+        now = int(time.time())
+        with get_db() as db:
+            messages = db.outbox_repository.claim_due(now=now,
+                                                      limit=settings.outbox_batch_size,
+                                                      max_attempts=settings.outbox_max_attempts,
+                                                      lease_until=now + CLAIM_LEASE_IN_SECS)
+        if not messages:
+            self._disconnect()
+            return 0
+
+        sent: List[int] = []
+        failed: List[Tuple[OutboundEmail, str]] = []
+        for index, message in enumerate(messages):
+            try:
+                self._send(message, settings)
+                sent.append(message.id)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError) as exc:
+                self._fail_batch(messages[index:], str(exc), failed)
+                break
+            except smtplib.SMTPException as exc:
+                # Rejected by the server, e.g. a refused recipient; the connection itself is still usable.
+                failed.append((message, str(exc)))
+            except OSError as exc:
+                self._fail_batch(messages[index:], str(exc), failed)
+                break
+
+        with get_db() as db, db.transaction():
+            if sent:
+                db.outbox_repository.mark_sent(sent)
+            for message, error in failed:
+                retry_at = now + int(retry_delay(message.attempts, settings.outbox_retry_backoff))
+                db.outbox_repository.mark_failed(message.id, retry_at=retry_at, error=error)
+
+        return len(sent)
+
+    def _dispatch_safely(self) -> int:
+        try:
+            return self.dispatch_once()
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f'Error dispatching outbound email: {exc}')
+            self._disconnect()
+            return 0
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            if not self._dispatch_safely():
+                self._wake.wait(self._current_settings().outbox_poll_interval)
+                self._wake.clear()
+        # One last pass so messages queued by requests drained during shutdown go out before the process exits.
+        self._dispatch_safely()
+        self._disconnect()
+
+    def start(self) -> None:
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='mail-dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stopping.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+def start_mail_dispatcher(settings: Optional[Settings] = None) -> Optional[MailDispatcher]:
+    # Mail delivery is off unless SMTP_HOST is configured; messages then stay in the outbox until it is.
+    if not (settings or get_settings()).smtp_host:
+        return None
+
+    dispatcher = MailDispatcher(settings)
+    dispatcher.start()
+
+    return dispatcher
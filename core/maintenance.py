@@ -0,0 +1,181 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import os
+import threading
+import time
+from datetime import datetime
+from sqlite3 import Error
+from typing import Any, Callable, Dict, Optional
+
+from core.configuration import Settings, get_settings
+from core.database_manager import DatabaseWriter, connect
+from core.dependencies import get_database_provider
+from core.lifecycle import LifecycleManager, get_lifecycle
+from core.repositories import Database
+
+POLL_INTERVAL_IN_SECS = 1.0
+
+# What each task does to a database file; its interval is the MAINTENANCE_<TASK>_INTERVAL_IN_MINS setting.
+TASKS: Dict[str, Callable[[DatabaseWriter], object]] = {
+    'checkpoint': lambda writer: writer.checkpoint('PASSIVE'),
+    'truncate': lambda writer: writer.checkpoint('TRUNCATE'),
+    'optimize': lambda writer: writer.optimize(),
+    'analyze': lambda writer: writer.analyze(),
+}
+
+
+def purge_expired_tokens(db: Database) -> Dict[str, int]:
+    # Expired tokens are rejected on use anyway; deleting them keeps the token tables, and their indexes, from
+    # growing with every login.
+    now = datetime.utcnow()
+
+    return {'verification_tokens': db.verification_repository.delete_expired_verification_tokens(before=now),
+            'auth_tokens': db.auth_repository.delete_expired_auth_tokens(before=now),
+            'refresh_tokens': db.refresh_repository.delete_expired_refresh_tokens(before=now)}
+
+
+# Tasks run once through the repositories rather than on each file, so they apply to every storage backend.
+DATABASE_TASKS: Dict[str, Callable[[Database], Dict[str, int]]] = {
+    'purge': purge_expired_tokens,
+}
+
+
+def task_interval(task: str, settings: Settings) -> float:
+    return getattr(settings, f'maintenance_{task}_interval').total_seconds()
+
+
+class MaintenanceScheduler:
+    # Runs each task on every database file once its interval has passed, but only while at most
+    # MAINTENANCE_MAX_IN_FLIGHT requests are being served; a task postponed for another whole interval runs
+    # regardless, so a server that is never idle is still maintained. Intervals are read on every poll, so
+    # configuration reloads apply at once.
+    def __init__(self, lifecycle: Optional[LifecycleManager] = None):
+        self.lifecycle = lifecycle or get_lifecycle()
+        started = time.time()
+        self.tasks: Dict[str, Dict[str, Any]] = {task: {'runs': 0,
+                                                        'postponed': 0,
+                                                        'waiting_for_low_load': False,
+                                                        'errors': 0,
+                                                        'last_run_at': None,
+                                                        'last_duration': None,
+                                                        'last_result': None,
+                                                        'due_since': started} for task in [*TASKS, *DATABASE_TASKS]}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_task(self, task: str) -> None:
+        with self._lock:
+            state = self.tasks[task]
+            started = time.time()
+            results: Dict[str, object] = {}
+            try:
+                if task in DATABASE_TASKS:
+                    with get_database_provider().connection() as db:
+                        results.update(DATABASE_TASKS[task](db))
+                else:
+                    for db_path, writer in get_database_provider().writers().items():
+                        results[db_path] = TASKS[task](writer)
+            except Error as exc:
+                state['errors'] += 1
+                results['error'] = str(exc)
+            state['runs'] += 1
+            state['waiting_for_low_load'] = False
+            state['last_run_at'] = started
+            state['last_duration'] = time.time() - started
+            state['last_result'] = results
+
+    def run_due(self, now: Optional[float] = None) -> None:
+        settings = get_settings()
+        now = now or time.time()
+        low_load = self.lifecycle.in_flight <= settings.maintenance_max_in_flight
+        for task, state in self.tasks.items():
+            interval = task_interval(task, settings)
+            last_run = state['last_run_at'] or state['due_since']
+            if now < last_run + interval:
+                continue
+            if low_load or now >= last_run + 2 * interval:
+                self.run_task(task)
+            elif not state['waiting_for_low_load']:
+                state['waiting_for_low_load'] = True
+                state['postponed'] += 1
+
+    def _run(self) -> None:
+        while not self._stopping.wait(POLL_INTERVAL_IN_SECS):
+            try:
+                self.run_due()
+            except Exception as exc:  # pylint: disable=broad-except
+                print(f'Error running database maintenance: {exc}')
+
+    def start(self) -> None:
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='database-maintenance', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        # Not taken under the lock, which a running truncation may hold while it waits for readers.
+        return {task: {key: value for key, value in state.items() if key != 'due_since'}
+                for task, state in self.tasks.items()}
+
+
+def file_stats(db_path: str, tables: bool = False) -> Dict[str, object]:
+    # Read through a separate read-only connection, so the writer is not held up. The per-table sizes are only
+    # collected when asked for, as dbstat walks every page of the file.
+    db = connect(db_path, read_only=True)
+    try:
+        page_size = db.execute('PRAGMA page_size').fetchone()[0]
+        stats: Dict[str, object] = {'page_size': page_size,
+                                    'page_count': db.execute('PRAGMA page_count').fetchone()[0],
+                                    'freelist_pages': db.execute('PRAGMA freelist_count').fetchone()[0],
+                                    'size_bytes': os.path.getsize(db_path),
+                                    'wal_size_bytes': os.path.getsize(f'{db_path}-wal')
+                                    if os.path.exists(f'{db_path}-wal') else 0}
+        if not tables:
+            return stats
+        kinds = dict(db.execute("SELECT name, type FROM sqlite_master WHERE type IN ('table', 'index')").fetchall())
+        try:
+            sizes = dict(db.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name').fetchall())
+        except Error:
+            # SQLite built without the dbstat table.
+            sizes = {}
+        stats['tables'] = {name: sizes.get(name) for name, kind in sorted(kinds.items()) if kind == 'table'}
+        stats['indexes'] = {name: sizes.get(name) for name, kind in sorted(kinds.items()) if kind == 'index'}
+    finally:
+        db.close()
+
+    return stats
+
+
+_maintenance_scheduler: Optional[MaintenanceScheduler] = None  # pylint: disable=invalid-name
+
+
+def start_maintenance(settings: Optional[Settings] = None) -> Optional[MaintenanceScheduler]:
+    # Maintenance is on unless MAINTENANCE=off. Without SQLite files, only expired tokens are purged.
+    global _maintenance_scheduler  # pylint: disable=global-statement
+    if (settings or get_settings()).maintenance == 'off':
+        return None
+
+    scheduler = MaintenanceScheduler()
+    scheduler.start()
+    _maintenance_scheduler = scheduler
+
+    return scheduler
+
+
+def stop_maintenance() -> None:
+    global _maintenance_scheduler  # pylint: disable=global-statement
+    scheduler, _maintenance_scheduler = _maintenance_scheduler, None
+    if scheduler:
+        scheduler.stop()
+
+
+def get_maintenance_scheduler() -> Optional[MaintenanceScheduler]:
+    return _maintenance_scheduler
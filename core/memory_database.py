@@ -0,0 +1,402 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import itertools
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from datetime import datetime
+from sqlite3 import IntegrityError
+from typing import Callable, Dict, Generator, Iterator, List, Optional
+
+from core import repositories
+from core.helpers import to_epoch
+from core.row_mapping import DEFAULT_BATCH_SIZE
+from core.schemas import (InternalUser, OutboundEmail, RefreshToken, User, UserCredentials, UserIn,
+                          UserVerificationToken)
+
+
+@dataclass(slots=True)
+class AuthToken:
+    id: int
+    token: str
+    user_id: int
+    expiry: int
+
+
+@dataclass(slots=True)
+class OutboxEntry:
+    message: OutboundEmail
+    next_attempt_at: int
+    last_error: Optional[str] = None
+
+
+class InMemoryStore:  # pylint: disable=too-many-instance-attributes
+    # Mirrors the SQLite schema, including its unique constraints, and raises the same exception types so the
+    # service layer handles both backends identically. Every access goes through a single lock.
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users: Dict[int, InternalUser] = {}
+        self.user_ids_by_email: Dict[str, int] = {}
+        self.verification_tokens: Dict[int, UserVerificationToken] = {}
+        self.verification_token_ids: Dict[str, int] = {}
+        self.verification_token_user_ids: Dict[int, int] = {}
+        self.auth_tokens: Dict[int, AuthToken] = {}
+        self.auth_token_ids_by_user: Dict[int, List[int]] = {}
+        self.refresh_tokens: Dict[int, RefreshToken] = {}
+        self.refresh_token_ids: Dict[str, int] = {}
+        self.refresh_token_ids_by_family: Dict[str, List[int]] = {}
+        self.outbox: Dict[int, OutboxEntry] = {}
+        self.user_ids = itertools.count(1)
+        self.verification_token_row_ids = itertools.count(1)
+        self.auth_token_row_ids = itertools.count(1)
+        self.refresh_token_row_ids = itertools.count(1)
+        self.outbox_row_ids = itertools.count(1)
+        self.undo_log: Optional[List[Callable[[], None]]] = None
+
+    def on_rollback(self, undo: Callable[[], None]) -> None:
+        # Only called with the lock held, so inside a transaction it is always the transaction's own thread.
+        if self.undo_log is not None:
+            self.undo_log.append(undo)
+
+
+def _public_user(user: InternalUser) -> User:
+    return User(id=user.id,
+                email=user.email,
+                first_name=user.first_name,
+                last_name=user.last_name,
+                email_verified=user.email_verified,
+                version=user.version)
+
+
+class InMemoryDatabase(repositories.Database):
+    def __init__(self, store: Optional[InMemoryStore] = None):
+        self.store = store or InMemoryStore()
+        self._build_repositories(self.store)
+
+    @contextmanager
+    def transaction(self) -> Generator['InMemoryDatabase', None, None]:
+        # Holding the store lock for the whole block keeps other threads from seeing partial writes; a failure
+        # replays the undo log in reverse so the store ends up as it was before the block.
+        with self.store.lock:
+            if self.store.undo_log is not None:
+                yield self
+                return
+
+            self.store.undo_log = []
+            try:
+                yield self
+            except BaseException:
+                undo_log, self.store.undo_log = self.store.undo_log, None
+                for undo in reversed(undo_log):
+                    undo()
+                raise
+            finally:
+                self.store.undo_log = None
+
+    def close(self) -> None:
+        pass
+
+    class UserRepository(repositories.UserRepository):
+        def __init__(self, store: InMemoryStore):
+            self.store = store
+
+        def insert_user(self, user: UserIn) -> int:
+            with self.store.lock:
+                if user.email.lower() in self.store.user_ids_by_email:
+                    raise ValueError('Your request could not be processed. Please try again.')
+
+                id_ = next(self.store.user_ids)
+                self.store.users[id_] = InternalUser(id=id_,
+                                                     email=user.email,
+                                                     first_name=user.first_name,
+                                                     last_name=user.last_name,
+                                                     password=user.password,
+                                                     email_verified=False)
+                self.store.user_ids_by_email[user.email.lower()] = id_
+                self.store.on_rollback(lambda: self._delete(id_))
+
+                return id_
+
+        def _delete(self, id_: int) -> None:
+            user = self.store.users.pop(id_)
+            del self.store.user_ids_by_email[user.email.lower()]
+
+        def _restore(self, user: InternalUser) -> None:
+            self.store.users[user.id] = user
+
+        def get_internal_user_by_email(self, email: str) -> Optional[InternalUser]:
+            with self.store.lock:
+                id_ = self.store.user_ids_by_email.get(email.lower())
+                if id_ is None:
+                    return None
+
+                return replace(self.store.users[id_])
+
+        def get_credentials_by_email(self, email: str) -> Optional[UserCredentials]:
+            with self.store.lock:
+                id_ = self.store.user_ids_by_email.get(email.lower())
+                user = self.store.users.get(id_) if id_ is not None else None
+
+                return UserCredentials(id=user.id, password=user.password,
+                                       email_verified=user.email_verified) if user else None
+
+        def get_user_by_id(self, id_: int) -> Optional[User]:
+            with self.store.lock:
+                user = self.store.users.get(id_)
+
+                return _public_user(user) if user else None
+
+        def get_users_by_ids(self, ids: List[int]) -> List[User]:
+            with self.store.lock:
+                return [_public_user(self.store.users[id_]) for id_ in set(ids) if id_ in self.store.users]
+
+        def iter_users(self, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[User]:  # pylint: disable=unused-argument
+            # Ids only ever grow, so insertion order is id order.
+            with self.store.lock:
+                users = [_public_user(user) for user in self.store.users.values()]
+
+            yield from users
+
+        def verify_user(self, id_: int) -> bool:
+            with self.store.lock:
+                user = self.store.users.get(id_)
+                if not user:
+                    return False
+                previous = replace(user)
+                user.email_verified = True
+                user.version += 1
+                self.store.on_rollback(lambda: self._restore(previous))
+
+                return True
+
+    class VerificationTokenRepository(repositories.VerificationTokenRepository):
+        def __init__(self, store: InMemoryStore):
+            self.store = store
+
+        def insert_verification_token(self, user_id: int, token: str, expiry: datetime) -> int:
+            with self.store.lock:
+                if user_id in self.store.verification_token_user_ids:
+                    raise IntegrityError('UNIQUE constraint failed: verification_tokens.user_id')
+                if token in self.store.verification_token_ids:
+                    raise IntegrityError('UNIQUE constraint failed: verification_tokens.token')
+
+                id_ = next(self.store.verification_token_row_ids)
+                self.store.verification_tokens[id_] = UserVerificationToken(id=id_,
+                                                                            user_id=user_id,
+                                                                            token=token,
+                                                                            expiry=to_epoch(expiry))
+                self.store.verification_token_ids[token] = id_
+                self.store.verification_token_user_ids[user_id] = id_
+                self.store.on_rollback(lambda: self._delete(id_))
+
+                return id_
+
+        def get_verification_token(self, token: str) -> Optional[UserVerificationToken]:
+            with self.store.lock:
+                id_ = self.store.verification_token_ids.get(token)
+
+                return self.get_verification_token_by_id(id_) if id_ is not None else None
+
+        def get_verification_token_by_id(self, id_: int) -> Optional[UserVerificationToken]:
+            with self.store.lock:
+                verification_token = self.store.verification_tokens.get(id_)
+
+                return replace(verification_token) if verification_token else None
+
+        def _delete(self, id_: int) -> None:
+            verification_token = self.store.verification_tokens.pop(id_)
+            del self.store.verification_token_ids[verification_token.token]
+            del self.store.verification_token_user_ids[verification_token.user_id]
+            self.store.on_rollback(lambda: self._restore(verification_token))
+
+        def _restore(self, verification_token: UserVerificationToken) -> None:
+            self.store.verification_tokens[verification_token.id] = verification_token
+            self.store.verification_token_ids[verification_token.token] = verification_token.id
+            self.store.verification_token_user_ids[verification_token.user_id] = verification_token.id
+
+        def delete_verification_token(self, token: str) -> None:
+            with self.store.lock:
+                id_ = self.store.verification_token_ids.get(token)
+                if id_ is not None:
+                    self._delete(id_)
+
+        def redeem_verification_token(self, token: str, now: int) -> Optional[User]:
+            with self.store.lock:
+                id_ = self.store.verification_token_ids.get(token)
+                verification_token = self.store.verification_tokens.get(id_) if id_ is not None else None
+                if not verification_token or verification_token.expiry < now:
+                    return None
+                if not InMemoryDatabase.UserRepository(self.store).verify_user(verification_token.user_id):
+                    return None
+                self._delete(verification_token.id)
+
+                return _public_user(self.store.users[verification_token.user_id])
+
+        def delete_expired_verification_tokens(self, before: datetime) -> int:
+            cutoff = to_epoch(before)
+            with self.store.lock:
+                expired = [id_ for id_, verification_token in self.store.verification_tokens.items()
+                           if verification_token.expiry < cutoff]
+                for id_ in expired:
+                    self._delete(id_)
+
+                return len(expired)
+
+    class AuthenticationTokenRepository(repositories.AuthenticationTokenRepository):
+        def __init__(self, store: InMemoryStore):
+            self.store = store
+
+        def insert_auth_token(self, user_id: int, token: str, expiry: datetime) -> int:
+            with self.store.lock:
+                id_ = next(self.store.auth_token_row_ids)
+                auth_token = AuthToken(id=id_, token=token, user_id=user_id, expiry=to_epoch(expiry))
+                self._restore(auth_token)
+                self.store.on_rollback(lambda: self._delete(id_))
+
+                return id_
+
+        def _restore(self, auth_token: AuthToken) -> None:
+            self.store.auth_tokens[auth_token.id] = auth_token
+            ids = self.store.auth_token_ids_by_user.setdefault(auth_token.user_id, [])
+            ids.append(auth_token.id)
+            ids.sort()
+
+        def _delete(self, id_: int) -> None:
+            auth_token = self.store.auth_tokens.pop(id_)
+            ids = self.store.auth_token_ids_by_user[auth_token.user_id]
+            ids.remove(id_)
+            if not ids:
+                del self.store.auth_token_ids_by_user[auth_token.user_id]
+            self.store.on_rollback(lambda: self._restore(auth_token))
+
+        def get_auth_token_user_by_id(self, user_id: int) -> Optional[str]:
+            with self.store.lock:
+                ids = self.store.auth_token_ids_by_user.get(user_id)
+
+                return self.store.auth_tokens[ids[0]].token if ids else None
+
+        def delete_expired_auth_tokens(self, before: datetime) -> int:
+            cutoff = to_epoch(before)
+            with self.store.lock:
+                expired = [id_ for id_, auth_token in self.store.auth_tokens.items() if auth_token.expiry < cutoff]
+                for id_ in expired:
+                    self._delete(id_)
+
+                return len(expired)
+
+    class RefreshTokenRepository(repositories.RefreshTokenRepository):
+        def __init__(self, store: InMemoryStore):
+            self.store = store
+
+        def insert_refresh_token(self, user_id: int, token_hash: str, family_id: str, expiry: datetime) -> int:
+            with self.store.lock:
+                if token_hash in self.store.refresh_token_ids:
+                    raise IntegrityError('UNIQUE constraint failed: refresh_tokens.token_hash')
+
+                id_ = next(self.store.refresh_token_row_ids)
+                self.store.refresh_tokens[id_] = RefreshToken(id=id_, user_id=user_id, family_id=family_id,
+                                                              expiry=to_epoch(expiry), revoked=False)
+                self.store.refresh_token_ids[token_hash] = id_
+                self.store.refresh_token_ids_by_family.setdefault(family_id, []).append(id_)
+                self.store.on_rollback(lambda: self._delete(token_hash))
+
+                return id_
+
+        def get_refresh_token(self, token_hash: str) -> Optional[RefreshToken]:
+            with self.store.lock:
+                id_ = self.store.refresh_token_ids.get(token_hash)
+
+                return replace(self.store.refresh_tokens[id_]) if id_ is not None else None
+
+        def _revoke(self, refresh_token: RefreshToken) -> None:
+            refresh_token.revoked = True
+            self.store.on_rollback(lambda: setattr(refresh_token, 'revoked', False))
+
+        def revoke_refresh_token(self, id_: int) -> bool:
+            with self.store.lock:
+                refresh_token = self.store.refresh_tokens.get(id_)
+                if not refresh_token or refresh_token.revoked:
+                    return False
+                self._revoke(refresh_token)
+
+                return True
+
+        def revoke_refresh_token_family(self, family_id: str, user_id: int) -> int:
+            with self.store.lock:
+                active = [refresh_token
+                          for refresh_token in map(self.store.refresh_tokens.get,
+                                                   self.store.refresh_token_ids_by_family.get(family_id, []))
+                          if refresh_token and refresh_token.user_id == user_id and not refresh_token.revoked]
+                for refresh_token in active:
+                    self._revoke(refresh_token)
+
+                return len(active)
+
+        def _delete(self, token_hash: str) -> None:
+            id_ = self.store.refresh_token_ids.pop(token_hash)
+            refresh_token = self.store.refresh_tokens.pop(id_)
+            ids = self.store.refresh_token_ids_by_family[refresh_token.family_id]
+            ids.remove(id_)
+            if not ids:
+                del self.store.refresh_token_ids_by_family[refresh_token.family_id]
+            self.store.on_rollback(lambda: self._restore(token_hash, refresh_token))
+
+        def _restore(self, token_hash: str, refresh_token: RefreshToken) -> None:
+            self.store.refresh_tokens[refresh_token.id] = refresh_token
+            self.store.refresh_token_ids[token_hash] = refresh_token.id
+            self.store.refresh_token_ids_by_family.setdefault(refresh_token.family_id, []).append(refresh_token.id)
+
+        def delete_expired_refresh_tokens(self, before: datetime) -> int:
+            cutoff = to_epoch(before)
+            with self.store.lock:
+                expired = [token_hash for token_hash, id_ in self.store.refresh_token_ids.items()
+                           if self.store.refresh_tokens[id_].expiry < cutoff]
+                for token_hash in expired:
+                    self._delete(token_hash)
+
+                return len(expired)
+
+    class OutboxRepository(repositories.OutboxRepository):
+        def __init__(self, store: InMemoryStore):
+            self.store = store
+
+        def enqueue(self, recipient: str, subject: str, body: str, send_after: int) -> int:
+            with self.store.lock:
+                id_ = next(self.store.outbox_row_ids)
+                message = OutboundEmail(id=id_, recipient=recipient, subject=subject, body=body, attempts=0)
+                self.store.outbox[id_] = OutboxEntry(message=message, next_attempt_at=send_after)
+                self.store.on_rollback(lambda: self._delete(id_))
+
+                return id_
+
+        def _delete(self, id_: int) -> None:
+            del self.store.outbox[id_]
+
+        def claim_due(self, now: int, limit: int, max_attempts: int, lease_until: int) -> List[OutboundEmail]:
+            with self.store.lock:
+                due = sorted((entry for entry in self.store.outbox.values()
+                              if entry.next_attempt_at <= now and entry.message.attempts < max_attempts),
+                             key=lambda entry: (entry.next_attempt_at, entry.message.id))[:limit]
+                for entry in due:
+                    entry.next_attempt_at = lease_until
+
+                return [replace(entry.message) for entry in due]
+
+        def mark_sent(self, ids: List[int]) -> None:
+            with self.store.lock:
+                for id_ in ids:
+                    self.store.outbox.pop(id_, None)
+
+        def mark_failed(self, id_: int, retry_at: int, error: str) -> None:
+            with self.store.lock:
+                entry = self.store.outbox.get(id_)
+                if entry:
+                    entry.message.attempts += 1
+                    entry.next_attempt_at = retry_at
+                    entry.last_error = error
+
+        def count_pending(self, max_attempts: int) -> int:
+            with self.store.lock:
+                return sum(1 for entry in self.store.outbox.values() if entry.message.attempts < max_attempts)
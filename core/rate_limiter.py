@@ -0,0 +1,177 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from core.configuration import Settings, get_settings
+
+# Every so many takes the SQLite store drops buckets that have refilled completely, which is the same as having none.
+SQLITE_CLEANUP_INTERVAL = 1000
+
+
+@dataclass(frozen=True)
+class BucketPolicy:
+    burst: int
+    per_second: float
+
+    def refill(self, tokens: float, updated_at: float, now: float) -> float:
+        return min(self.burst, tokens + max(now - updated_at, 0) * self.per_second)
+
+    def full_at(self, tokens: float, now: float) -> float:
+        return now + (self.burst - tokens) / self.per_second
+
+
+def _take(policy: BucketPolicy, tokens: float) -> Tuple[float, float]:
+    # Returns the tokens left and how long to wait before retrying, which is 0 when the attempt is allowed.
+    if tokens >= 1:
+        return tokens - 1, 0.0
+
+    return tokens, (1 - tokens) / policy.per_second
+
+
+class MemoryBucketStore:
+    # Holds at most max_keys buckets and evicts the least recently used one; an evicted client starts over
+    # with a full bucket, which bounds memory at the price of forgetting the quietest clients first.
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, policy: BucketPolicy, now: float) -> float:
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            tokens = policy.refill(*bucket, now) if bucket else float(policy.burst)
+            tokens, retry_after = _take(policy, tokens)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        return retry_after
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteBucketStore:
+    # Shares buckets between processes on one host through a local database file. Each take is one short
+    # IMMEDIATE transaction, so concurrent processes serialize on the file lock instead of racing on a bucket.
+    def __init__(self, db_path: str, max_keys: int):
+        self.max_keys = max_keys
+        self._db = sqlite3.connect(db_path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                                key TEXT PRIMARY KEY,
+                                tokens REAL NOT NULL,
+                                updated_at REAL NOT NULL,
+                                full_at REAL NOT NULL)''')
+        self._db.execute('''CREATE INDEX IF NOT EXISTS rate_limit_buckets_updated_at
+                            ON rate_limit_buckets(updated_at)''')
+        self._db.execute('''CREATE INDEX IF NOT EXISTS rate_limit_buckets_full_at
+                            ON rate_limit_buckets(full_at)''')
+        self._lock = threading.Lock()
+        self._takes = 0
+
+    def take(self, key: str, policy: BucketPolicy, now: float) -> float:
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                bucket = self._db.execute('SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?',
+                                          (key,)).fetchone()
+                tokens = policy.refill(bucket[0], bucket[1], now) if bucket else float(policy.burst)
+                tokens, retry_after = _take(policy, tokens)
+                self._db.execute('''INSERT INTO rate_limit_buckets(key, tokens, updated_at, full_at) VALUES(?,?,?,?)
+                                    ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens,
+                                                                   updated_at = excluded.updated_at,
+                                                                   full_at = excluded.full_at''',
+                                 (key, tokens, now, policy.full_at(tokens, now)))
+                self._takes += 1
+                if self._takes % SQLITE_CLEANUP_INTERVAL == 0:
+                    self._cleanup(now)
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+        return retry_after
+
+    def _cleanup(self, now: float) -> None:
+        self._db.execute('DELETE FROM rate_limit_buckets WHERE full_at <= ?', (now,))
+        self._db.execute('''DELETE FROM rate_limit_buckets WHERE key IN (
+                                SELECT key FROM rate_limit_buckets ORDER BY updated_at DESC LIMIT -1 OFFSET ?)''',
+                         (self.max_keys,))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute('DELETE FROM rate_limit_buckets')
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM rate_limit_buckets').fetchone()[0]
+
+    def close(self) -> None:
+        # Waits for a take in progress; one made afterwards by a request still holding the store fails.
+        with self._lock:
+            self._db.close()
+
+
+class RateLimiter:
+    # Token buckets keyed by client address and by normalized email. Both must have a token left; the
+    # policies are read per attempt, so a configuration reload applies to existing buckets at once.
+    def __init__(self, store):
+        self.store = store
+
+    def check(self, client_address: Optional[str], email: str, settings: Optional[Settings] = None) -> float:
+        settings = settings or get_settings()
+        now = time.time()
+        if client_address:
+            retry_after = self.store.take(f'ip:{client_address}',
+                                          BucketPolicy(settings.rate_limit_ip_burst,
+                                                       settings.rate_limit_ip_per_minute / 60), now)
+            if retry_after:
+                return retry_after
+
+        return self.store.take(f'email:{email.strip().lower()}',
+                               BucketPolicy(settings.rate_limit_email_burst,
+                                            settings.rate_limit_email_per_minute / 60), now)
+
+
+_rate_limiter: Optional[Tuple[tuple, Optional[RateLimiter]]] = None  # pylint: disable=invalid-name
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    # The store is only replaced when its own settings change, so reloads keep the buckets.
+    global _rate_limiter  # pylint: disable=global-statement
+    settings = get_settings()
+    store_settings = (settings.rate_limit_store, settings.rate_limit_db_path, settings.rate_limit_max_keys)
+    cached = _rate_limiter
+    if cached is not None and cached[0] == store_settings:
+        return cached[1]
+
+    with _rate_limiter_lock:
+        if _rate_limiter is None or _rate_limiter[0] != store_settings:
+            rate_limiter = None
+            if settings.rate_limit_store == 'sqlite':
+                rate_limiter = RateLimiter(SQLiteBucketStore(settings.rate_limit_db_path,
+                                                             settings.rate_limit_max_keys))
+            elif settings.rate_limit_store == 'memory':
+                rate_limiter = RateLimiter(MemoryBucketStore(settings.rate_limit_max_keys))
+            _, previous = _rate_limiter or (None, None)
+            _rate_limiter = (store_settings, rate_limiter)
+            if previous is not None:
+                previous.store.close()
+
+        return _rate_limiter[1]
@@ -0,0 +1,157 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+from abc import ABC, abstractmethod
+from contextlib import AbstractContextManager
+from datetime import datetime
+from typing import Iterator, List, Optional
+
+from core.row_mapping import DEFAULT_BATCH_SIZE
+from core.schemas import (InternalUser, OutboundEmail, RefreshToken, User, UserCredentials, UserIn,
+                          UserVerificationToken)
+
+
+class UserRepository(ABC):
+    @abstractmethod
+    def insert_user(self, user: UserIn) -> int:
+        pass
+
+    @abstractmethod
+    def get_internal_user_by_email(self, email: str) -> Optional[InternalUser]:
+        pass
+
+    @abstractmethod
+    def get_credentials_by_email(self, email: str) -> Optional[UserCredentials]:
+        pass
+
+    @abstractmethod
+    def get_user_by_id(self, id_: int) -> Optional[User]:
+        pass
+
+    @abstractmethod
+    def get_users_by_ids(self, ids: List[int]) -> List[User]:
+        pass
+
+    @abstractmethod
+    def iter_users(self, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[User]:
+        pass
+
+    @abstractmethod
+    def verify_user(self, id_: int) -> bool:
+        pass
+
+
+class VerificationTokenRepository(ABC):
+    @abstractmethod
+    def insert_verification_token(self, user_id: int, token: str, expiry: datetime) -> int:
+        pass
+
+    @abstractmethod
+    def get_verification_token(self, token: str) -> Optional[UserVerificationToken]:
+        pass
+
+    @abstractmethod
+    def get_verification_token_by_id(self, id_: int) -> Optional[UserVerificationToken]:
+        pass
+
+    @abstractmethod
+    def delete_verification_token(self, token: str) -> None:
+        pass
+
+    @abstractmethod
+    def redeem_verification_token(self, token: str, now: int) -> Optional[User]:
+        # Marks the user of an unexpired token verified and deletes the token in one transaction, returning the
+        # updated user, or None when the token is unknown, expired or was redeemed by a concurrent request.
+        pass
+
+    @abstractmethod
+    def delete_expired_verification_tokens(self, before: datetime) -> int:
+        pass
+
+
+class AuthenticationTokenRepository(ABC):
+    @abstractmethod
+    def insert_auth_token(self, user_id: int, token: str, expiry: datetime) -> int:
+        pass
+
+    @abstractmethod
+    def get_auth_token_user_by_id(self, user_id: int) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def delete_expired_auth_tokens(self, before: datetime) -> int:
+        pass
+
+
+class RefreshTokenRepository(ABC):
+    @abstractmethod
+    def insert_refresh_token(self, user_id: int, token_hash: str, family_id: str, expiry: datetime) -> int:
+        pass
+
+    @abstractmethod
+    def get_refresh_token(self, token_hash: str) -> Optional[RefreshToken]:
+        pass
+
+    @abstractmethod
+    def revoke_refresh_token(self, id_: int) -> bool:
+        pass
+
+    @abstractmethod
+    def revoke_refresh_token_family(self, family_id: str, user_id: int) -> int:
+        pass
+
+    @abstractmethod
+    def delete_expired_refresh_tokens(self, before: datetime) -> int:
+        pass
+
+
+class OutboxRepository(ABC):
+    @abstractmethod
+    def enqueue(self, recipient: str, subject: str, body: str, send_after: int) -> int:
+        pass
+
+    @abstractmethod
+    def claim_due(self, now: int, limit: int, max_attempts: int, lease_until: int) -> List[OutboundEmail]:
+        pass
+
+    @abstractmethod
+    def mark_sent(self, ids: List[int]) -> None:
+        pass
+
+    @abstractmethod
+    def mark_failed(self, id_: int, retry_at: int, error: str) -> None:
+        pass
+
+    @abstractmethod
+    def count_pending(self, max_attempts: int) -> int:
+        pass
+
+
+# Each Database attribute and the name of the repository class implementations nest for it.
+REPOSITORY_CLASSES = {'user_repository': 'UserRepository',
+                      'verification_repository': 'VerificationTokenRepository',
+                      'auth_repository': 'AuthenticationTokenRepository',
+                      'refresh_repository': 'RefreshTokenRepository',
+                      'outbox_repository': 'OutboxRepository'}
+
+
+class Database(ABC):
+    user_repository: UserRepository
+    verification_repository: VerificationTokenRepository
+    auth_repository: AuthenticationTokenRepository
+    refresh_repository: RefreshTokenRepository
+    outbox_repository: OutboxRepository
+
+    def _build_repositories(self, backend: object) -> None:
+        # Builds the implementation's nested repository classes over the state they share.
+        for attribute, name in REPOSITORY_CLASSES.items():
+            setattr(self, attribute, getattr(self, name)(backend))
+
+    @abstractmethod
+    def transaction(self) -> AbstractContextManager:
+        pass
+
+    @abstractmethod
+    def close(self) -> None:
+        pass
@@ -0,0 +1,72 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+from dataclasses import fields
+from functools import lru_cache
+from sqlite3 import Connection, Cursor
+from typing import Any, Callable, Generic, Iterator, List, Optional, Sequence, Type, TypeVar
+
+S = TypeVar('S')
+
+RowFactory = Callable[[Cursor, Sequence[Any]], Any]
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def row_factory(schema: type) -> RowFactory:
+    # Takes the schema as a plain type: mypy does not count Type[S] as Hashable, which lru_cache asks of its arguments.
+    return _row_factory(schema)
+
+
+@lru_cache(maxsize=None)
+def _row_factory(schema: type) -> RowFactory:
+    # SQLite has no boolean type, so only bool fields need converting; every other column is passed through
+    # positionally, which requires the SELECT column order to match the dataclass field order.
+    converters = tuple(bool if field.type is bool else None for field in fields(schema))
+
+    if not any(converters):
+        def plain_factory(_cursor: Cursor, row: Sequence[Any]) -> Any:
+            return schema(*row)
+
+        return plain_factory
+
+    def converting_factory(_cursor: Cursor, row: Sequence[Any]) -> Any:
+        return schema(*[value if convert is None else convert(value)
+                        for convert, value in zip(converters, row)])
+
+    return converting_factory
+
+
+class Query(Generic[S]):
+    __slots__ = ('schema', 'sql', 'factory')
+
+    def __init__(self, schema: Type[S], sql: str):
+        self.schema = schema
+        self.sql = sql
+        self.factory = row_factory(schema)
+
+    def _execute(self, db: Connection, params: Sequence[Any]) -> Cursor:
+        cursor = db.cursor()
+        cursor.row_factory = self.factory
+        cursor.execute(self.sql, params)
+
+        return cursor
+
+    def fetch_one(self, db: Connection, params: Sequence[Any] = ()) -> Optional[S]:
+        return self._execute(db, params).fetchone()
+
+    def fetch_all(self, db: Connection, params: Sequence[Any] = ()) -> List[S]:
+        return self._execute(db, params).fetchall()
+
+    def stream(self, db: Connection, params: Sequence[Any] = (),
+               batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[S]:
+        cursor = self._execute(db, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
@@ -3,11 +3,13 @@
 
 
 from dataclasses import dataclass
+from typing import List, Optional
 
+from core.configuration import get_settings
 from core.helpers import ValidationMixin
 
 
-@dataclass
+@dataclass(slots=True)
 class InternalUser:
     id: int
     email: str
@@ -15,18 +17,28 @@ class InternalUser:
     last_name: str
     password: str
     email_verified: bool
+    version: int = 1
 
 
-@dataclass
+@dataclass(slots=True)
+class UserCredentials:
+    # Only what a login needs, so it reads three columns instead of the whole user row.
+    id: int
+    password: str
+    email_verified: bool
+
+
+@dataclass(slots=True)
 class User:
     id: int
     email: str
     first_name: str
     last_name: str
     email_verified: bool
+    version: int = 1
 
 
-@dataclass
+@dataclass(slots=True)
 class UserIn(ValidationMixin):
     email: str
     first_name: str
@@ -49,15 +61,92 @@ class UserIn(ValidationMixin):
             raise ValueError(message)
 
 
-@dataclass
+@dataclass(slots=True)
 class UserVerificationToken:
     id: int
     user_id: int
     token: str
+    expiry: int
+
+
+@dataclass(slots=True)
+class RefreshToken:
+    id: int
+    user_id: int
+    family_id: str
+    expiry: int
+    revoked: bool
+
+
+@dataclass(slots=True)
+class RefreshRequest(ValidationMixin):
+    refresh_token: str
+
+    def __post_init__(self):
+        if not self.is_non_empty_string(self.refresh_token):
+            raise ValueError('Refresh token is required.')
+
+
+def _check_batch(items: list, name: str, item_type: Optional[type] = None) -> None:
+    # Items are only type checked here when the batch cannot be answered per item without it.
+    if not isinstance(items, list) or not items:
+        raise ValueError(f'{name} must be a non-empty list.')
+    max_batch_size = get_settings().max_batch_size
+    if len(items) > max_batch_size:
+        raise ValueError(f'{name} must not contain more than {max_batch_size} items.')
+    if item_type is not None and any(not isinstance(item, item_type) for item in items):
+        raise ValueError(f'{name} must only contain {item_type.__name__} values.')
+
+
+@dataclass(slots=True)
+class UserBatchRequest(ValidationMixin):
+    ids: List[int]
+
+    def __post_init__(self):
+        _check_batch(self.ids, 'ids')
+
+
+@dataclass(slots=True)
+class UserLookup(ValidationMixin):
+    # One item of a UserBatchRequest.
+    id: int
+
+    def __post_init__(self):
+        if not self.is_integer(self.id):
+            raise ValueError('id must be an integer.')
+
+
+@dataclass(slots=True)
+class TokenBatchRequest(ValidationMixin):
+    tokens: List[str]
+
+    def __post_init__(self):
+        _check_batch(self.tokens, 'tokens', str)
+
+
+@dataclass(slots=True)
+class AccessTokenClaims(ValidationMixin):
+    # The claims of a correctly signed access token, which still need checking before they are trusted.
+    user_id: int
     expiry: str
 
+    def __post_init__(self):
+        if not self.is_integer(self.user_id):
+            raise ValueError('user_id must be an integer.')
+        if not self.is_non_empty_string(self.expiry):
+            raise ValueError('expiry is required.')
+
+
+@dataclass(slots=True)
+class OutboundEmail:
+    id: int
+    recipient: str
+    subject: str
+    body: str
+    attempts: int
+
 
-@dataclass
+@dataclass(slots=True)
 class Credentials(ValidationMixin):
     email: str
     password: str
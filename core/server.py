@@ -0,0 +1,204 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import os
+import select
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import threading
+from http.server import HTTPServer
+from socketserver import TCPServer, ThreadingMixIn
+from typing import Dict, Optional, Tuple, Type, cast
+
+from core.lifecycle import LifecycleManager, get_lifecycle
+
+LISTEN_FD_ENV = 'LISTEN_FD'
+UNIX_LISTEN_FD_ENV = 'UNIX_LISTEN_FD'
+READY_FD_ENV = 'READY_FD'
+DEFAULT_UNIX_SOCKET_MODE = 0o660
+
+
+class ServiceHTTPServer(HTTPServer):
+    # Servers started and stopped together with this one, e.g. a Unix socket next to the TCP port.
+    companions: Tuple['ServiceHTTPServer', ...] = ()
+
+    def __init__(self, server_address, handler_class, bind_and_activate=True,
+                 lifecycle: Optional[LifecycleManager] = None):
+        self.lifecycle = lifecycle or get_lifecycle()
+        super().__init__(server_address, handler_class, bind_and_activate=bind_and_activate)
+
+    def finish_request(self, request, client_address) -> None:
+        with self.lifecycle.track():
+            super().finish_request(request, client_address)
+
+
+class ThreadingServiceHTTPServer(ThreadingMixIn, ServiceHTTPServer):
+    daemon_threads = True
+
+
+SERVER_CLASSES: Dict[str, Type[ServiceHTTPServer]] = {
+    'single': ServiceHTTPServer,
+    'threaded': ThreadingServiceHTTPServer
+}
+
+
+def remove_stale_socket(path: str) -> None:
+    # A socket file left behind by a process that died is removed; one a live server still accepts on is not,
+    # and neither is anything that is not a socket.
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(f'{path} exists and is not a socket.')
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(f'Another server is listening on {path}.')
+
+
+class UnixServerMixin(TCPServer):
+    # Serves on a Unix domain socket instead of a TCP port, for callers on the same host. Clients have no
+    # address there, so their client_address is ('', 0): per-address rate limits only apply to them through
+    # X-Forwarded-For, when TRUSTED_PROXIES includes 'unix'.
+    address_family = socket.AF_UNIX
+    socket_mode = DEFAULT_UNIX_SOCKET_MODE
+    # Only set once this server bound the path, and cleared again when the socket is handed over to a replacement
+    # process, which keeps serving on it.
+    unlink_on_close = False
+
+    @property
+    def socket_path(self) -> str:
+        # TCPServer types server_address as a host and port; here it is the path the socket is bound to.
+        return cast(str, self.server_address)
+
+    def server_bind(self) -> None:
+        remove_stale_socket(self.socket_path)
+        TCPServer.server_bind(self)
+        self.unlink_on_close = True
+        os.chmod(self.socket_path, self.socket_mode)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+
+        return request, ('', 0)
+
+    def server_close(self) -> None:
+        super().server_close()
+        if self.unlink_on_close:
+            try:
+                os.remove(self.socket_path)
+            except FileNotFoundError:
+                pass
+
+
+def is_unix_server(httpd: HTTPServer) -> bool:
+    return httpd.socket.family == socket.AF_UNIX
+
+
+def create_server(server_class, handler_class, server_address) -> HTTPServer:
+    unix = isinstance(server_address, str)
+    inherited_fd = os.environ.pop(UNIX_LISTEN_FD_ENV if unix else LISTEN_FD_ENV, None)
+    if inherited_fd is None:
+        return server_class(server_address, handler_class)
+
+    # Replacement process: serve on the listening socket handed over by the previous process instead of
+    # binding a new one, so no connection is refused while the two processes overlap.
+    httpd = server_class(server_address, handler_class, bind_and_activate=False)
+    httpd.socket.close()
+    httpd.socket = socket.socket(fileno=int(inherited_fd))
+    if unix:
+        httpd.server_name = 'localhost'
+        httpd.server_port = 0
+        return httpd
+
+    host, port = httpd.socket.getsockname()[:2]
+    httpd.server_address = (host, port)
+    httpd.server_name = socket.getfqdn(host)
+    httpd.server_port = port
+
+    return httpd
+
+
+def create_unix_server(server_class, handler_class, path: str, mode: int = DEFAULT_UNIX_SOCKET_MODE) -> HTTPServer:
+    # Any serving mode works over a Unix socket. The mode is a class attribute, as the socket is bound and its
+    # permissions set inside the constructor.
+    unix_class = type(f'Unix{server_class.__name__}', (UnixServerMixin, server_class), {'socket_mode': mode})
+
+    return create_server(unix_class, handler_class, path)
+
+
+def notify_ready() -> None:
+    ready_fd = os.environ.pop(READY_FD_ENV, None)
+    if ready_fd is not None:
+        os.write(int(ready_fd), b'1')
+        os.close(int(ready_fd))
+
+
+def spawn_replacement(httpd: ServiceHTTPServer, timeout: float) -> bool:
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ, **{READY_FD_ENV: str(write_fd)})
+    listen_fds = []
+    for server in (httpd, *httpd.companions):
+        listen_fds.append(server.socket.fileno())
+        env[UNIX_LISTEN_FD_ENV if is_unix_server(server) else LISTEN_FD_ENV] = str(server.socket.fileno())
+    subprocess.Popen([sys.executable] + sys.argv, env=env,  # pylint: disable=consider-using-with
+                     pass_fds=(*listen_fds, write_fd))
+    os.close(write_fd)
+    try:
+        readable, _, _ = select.select([read_fd], [], [], timeout)
+        return bool(readable) and os.read(read_fd, 1) == b'1'
+    finally:
+        os.close(read_fd)
+
+
+def _hand_over(httpd: ServiceHTTPServer, timeout: float) -> None:
+    if spawn_replacement(httpd, timeout):
+        print('Replacement process is ready, draining.')
+        for server in (httpd, *httpd.companions):
+            if is_unix_server(server):
+                server.unlink_on_close = False  # type: ignore
+        httpd.lifecycle.stop(httpd)
+    else:
+        print('Replacement process did not become ready, keep serving.')
+
+
+def serve(httpd: ServiceHTTPServer, drain_timeout: float) -> bool:
+    # Companions serve on their own threads and stop with httpd; they share its lifecycle, so the drain waits
+    # for their requests as well.
+    companions = httpd.companions
+    lifecycle = httpd.lifecycle
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: lifecycle.stop(httpd))
+    signal.signal(signal.SIGUSR2,
+                  lambda _signum, _frame: threading.Thread(target=_hand_over, args=(httpd, drain_timeout),
+                                                           daemon=True).start())
+    for server in companions:
+        threading.Thread(target=server.serve_forever, name='companion-server', daemon=True).start()
+    notify_ready()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    # Stop accepting first; requests already accepted keep running until they finish or the deadline passes.
+    for server in companions:
+        server.shutdown()
+    for server in (httpd, *companions):
+        server.socket.close()
+    drained = lifecycle.drain(drain_timeout)
+    for server in (httpd, *companions):
+        server.server_close()
+
+    return drained
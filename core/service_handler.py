@@ -2,62 +2,108 @@
 # All rights reserved
 
 
+import hmac
+import importlib
 import json
+from functools import lru_cache
 from http.server import BaseHTTPRequestHandler
-from typing import Any, Dict
+from typing import Callable, Dict
 from urllib.parse import urlparse
 
-import jwt
-
-from core.authentication_service import (authenticate,
-                                         get_current_logged_user,
-                                         register,
-                                         verify_email)
+from core.admission import HIGH, LOW, Overloaded, get_admission_controller
+from core.configuration import get_settings
+from core.database_manager import DatabaseBusyError
 from core.dependencies import get_db
-from core.helpers import argument_injector, decode_jwt, parse_query_params
+from core.helpers import argument_injector, decode_jwt, forwarded_client, parse_query_params
 
 
 def health_check():
     return {'message': 'OK', 'status_code': 200}
 
 
+@lru_cache(maxsize=None)
+def resolve_handler(target: str) -> Callable[..., dict]:
+    module_name, _, function_name = target.partition(':')
+
+    return argument_injector(getattr(importlib.import_module(module_name), function_name))
+
+
 class ServiceRequestHandler(BaseHTTPRequestHandler):
 
-    GET_ROUTES: Dict[str, Any] = {
-        '/health-check': health_check,
-        '/verify-email': verify_email,
-        '/current-user': get_current_logged_user
+    # Handlers are referenced as 'module:function' and imported on first use (or by warm_up() at startup),
+    # so importing the request handler does not pull in bcrypt, jwt and the service layer.
+    GET_ROUTES: Dict[str, str] = {
+        '/health-check': 'core.service_handler:health_check',
+        '/verify-email': 'core.authentication_service:verify_email',
+        '/current-user': 'core.authentication_service:get_current_logged_user',
+        '/.well-known/jwks.json': 'core.authentication_service:get_jwks',
+        '/admin/email-filter': 'core.admin_service:email_filter_stats',
+        '/admin/admission': 'core.admin_service:admission_stats',
+        '/admin/single-flight': 'core.admin_service:single_flight_stats',
+        '/admin/database': 'core.admin_service:database_stats',
+        '/admin/backup': 'core.admin_service:backup_status'
     }
 
-    POST_ROUTES: Dict[str, Any] = {
-        '/register': register,
-        '/login': authenticate
+    POST_ROUTES: Dict[str, str] = {
+        '/register': 'core.authentication_service:register',
+        '/login': 'core.authentication_service:authenticate',
+        '/token/refresh': 'core.authentication_service:refresh_access_token',
+        '/users/batch': 'core.authentication_service:get_users_batch',
+        '/tokens/introspect': 'core.authentication_service:introspect_tokens',
+        '/admin/email-filter/rebuild': 'core.admin_service:rebuild_email_filter',
+        '/admin/backup': 'core.admin_service:start_backup'
     }
 
-    REQUEST_METHODS: Dict[str, Dict[str, Any]] = {
+    REQUEST_METHODS: Dict[str, Dict[str, str]] = {
         'GET': GET_ROUTES,
         'POST': POST_ROUTES
     }
 
-    PROTECTED_ROUTES = ['/current-user']
+    PROTECTED_ROUTES = ['/current-user', '/users/batch', '/tokens/introspect']
+    ADMIN_PREFIX = '/admin/'
+    # Routes hashing passwords; everything else, apart from the health check, is high priority.
+    LOW_PRIORITY_ROUTES = ['/register', '/login']
+    HEALTH_CHECK_ROUTE = '/health-check'
 
     def _request_handler(self) -> None:
-        handler_dict: Dict[str, Any] = self.REQUEST_METHODS.get(
+        handler_dict: Dict[str, str] = self.REQUEST_METHODS.get(
             self.command, {})
         parsed_path = urlparse(self.path)
         path = parsed_path.path
 
+        # The health check skips admission control and the database, so an overloaded node still answers its
+        # load balancer instead of being taken out of rotation and pushing its load onto the others.
+        if self.command == 'GET' and path == self.HEALTH_CHECK_ROUTE:
+            self._response_handler(health_check())
+            return
+
         if handler_dict is not None and path not in handler_dict:
             self._throw_exception(message='Not Found', code=404)
             return
 
-        handler_method = handler_dict.get(path, None)
-
+        handler_method = resolve_handler(handler_dict[path])
+        priority = LOW if path in self.LOW_PRIORITY_ROUTES else HIGH
+        try:
+            with get_admission_controller().admit(priority):
+                self._dispatch(path, parsed_path.query, handler_method)
+        except Overloaded as exc:
+            self._response_handler({'message': 'Service Unavailable',
+                                    'status_code': 503,
+                                    'headers': {'Retry-After': str(exc.retry_after)}})
+        except DatabaseBusyError:
+            # Another process held the database through every retry; the request is safe to repeat.
+            self._response_handler({'message': 'Service Unavailable',
+                                    'status_code': 503,
+                                    'headers': {'Retry-After': '1'}})
+
+    def _dispatch(self, path: str, query: str, handler_method: Callable[..., dict]) -> None:
         if path in self.PROTECTED_ROUTES and not self._validate_token():
             return
+        if path.startswith(self.ADMIN_PREFIX) and not self._validate_admin_token():
+            return
 
         headers = {key: self.headers[key] for key in self.headers.keys()}
-        query_params = parse_query_params(parsed_path.query)
+        query_params = parse_query_params(query)
 
         data = None
         if self.command == 'POST':
@@ -67,6 +113,10 @@ class ServiceRequestHandler(BaseHTTPRequestHandler):
                 return
 
             content_length = int(self.headers['Content-Length'])
+            if content_length > get_settings().max_request_body_bytes:
+                self._throw_exception(message='Payload Too Large', code=413)
+                return
+
             body = self.rfile.read(content_length)
             try:
                 data = json.loads(body.decode('utf-8'))
@@ -76,14 +126,18 @@ class ServiceRequestHandler(BaseHTTPRequestHandler):
                 return
 
         with get_db() as db:
-            response = argument_injector(handler_method)(headers=headers,
-                                                         query_params=query_params,
-                                                         db=db,
-                                                         data=data)
+            response = handler_method(headers=headers,
+                                      query_params=query_params,
+                                      db=db,
+                                      data=data,
+                                      client_address=forwarded_client(self.client_address[0], headers,
+                                                                      get_settings().trusted_proxies))
 
         self._response_handler(response)
 
     def _validate_token(self) -> bool:
+        import jwt  # pylint: disable=import-outside-toplevel
+
         token = self.headers.get('Authorization')
         if not token:
             self._throw_exception('Token is missing.', 401)
@@ -99,8 +153,28 @@ class ServiceRequestHandler(BaseHTTPRequestHandler):
             return False
         return True
 
+    def _validate_admin_token(self) -> bool:
+        # Admin routes only exist when ADMIN_TOKEN is configured.
+        admin_token = get_settings().admin_token
+        if not admin_token:
+            self._throw_exception('Not Found', 404)
+            return False
+        token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(token.encode('utf-8'), admin_token.encode('utf-8')):
+            self._throw_exception('Invalid admin token.', 401)
+            return False
+        return True
+
     def _response_handler(self, response: dict) -> None:
-        self.send_response(response.get('status_code', 200))
+        status_code = response.get('status_code', 200)
+        headers = response.pop('headers', None) or {}
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status_code == 304:
+            self.end_headers()
+            return
+
         self.send_header('Content-type', 'application/json')
         self.end_headers()
         self.wfile.write(json.dumps(response).encode())
@@ -110,6 +184,16 @@ class ServiceRequestHandler(BaseHTTPRequestHandler):
         body = {"message": message, 'status_code': code}
         self._response_handler(body)
 
+    def address_string(self) -> str:
+        # Clients connected over a Unix socket have no address.
+        return self.client_address[0] or 'unix-socket'
+
+    @classmethod
+    def warm_up(cls) -> None:
+        for routes in cls.REQUEST_METHODS.values():
+            for target in routes.values():
+                resolve_handler(target)
+
     def do_GET(self) -> None:
         self._request_handler()
 
@@ -0,0 +1,125 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import argparse
+import os
+import sqlite3
+from typing import Dict, List
+
+from core.database_manager import DEFAULT_DB_PATH, DatabaseManager
+from core.sharding import id_bucket, shard_index, shard_paths
+
+# Every table of a shard, with the column whose bucket decides where a row lives. Ids of rows belonging to a user
+# carry the user's bucket, so all of a user's rows move together.
+SHARDED_TABLES = {
+    'users': 'id',
+    'verification_tokens': 'id',
+    'auth_tokens': 'rowid',
+    'refresh_tokens': 'id',
+    'email_outbox': 'id',
+    'id_sequences': 'bucket',
+}
+
+
+def read_shard_count(db_path: str) -> int:
+    first = shard_paths(db_path, 1)[0]
+    if not os.path.exists(first):
+        raise ValueError(f'No sharded database found at {first}.')
+
+    db = sqlite3.connect(first)
+    try:
+        return db.execute('SELECT shard_count FROM shard_layout').fetchone()[0]
+    except sqlite3.OperationalError as exc:
+        raise ValueError(f'{first} is not a shard.') from exc
+    finally:
+        db.close()
+
+
+def _detach_sidecars(path: str) -> None:
+    # Folds the WAL back into the file and removes it along with the shared-memory index, so the file can be moved
+    # on its own and no stale WAL is left behind to be replayed over whatever file takes its place.
+    if os.path.exists(path):
+        db = sqlite3.connect(path)
+        try:
+            busy, _, _ = db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        finally:
+            db.close()
+        if busy:
+            raise ValueError(f'{path} is still in use; stop the server before rebalancing.')
+    for sidecar in (f'{path}-wal', f'{path}-shm'):
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+
+
+def _copy_rows(source: sqlite3.Connection, targets: List[DatabaseManager]) -> Dict[str, int]:
+    copied = {}
+    for table, key in SHARDED_TABLES.items():
+        cursor = source.execute(f'SELECT {key}, * FROM {table}')
+        columns = [description[0] for description in cursor.description][1:]
+        if key == 'rowid':
+            columns = ['rowid'] + columns
+        sql = f'INSERT INTO {table}({", ".join(columns)}) VALUES({", ".join("?" * len(columns))})'
+        copied[table] = 0
+        while rows := cursor.fetchmany(1000):
+            for row in rows:
+                target = targets[shard_index(id_bucket(row[0]), len(targets))]
+                target.db.execute(sql, row if key == 'rowid' else row[1:])
+            copied[table] += len(rows)
+
+    return copied
+
+
+def rebalance(db_path: str, shard_count: int) -> Dict[str, int]:
+    # Offline only: the server must be stopped. Rows are copied into new files, which replace the old ones only
+    # once every row has been written; the old files are kept with a .bak suffix.
+    current_count = read_shard_count(db_path)
+    current_paths = shard_paths(db_path, current_count)
+    new_paths = shard_paths(db_path, shard_count)
+
+    for path in new_paths:
+        if os.path.exists(f'{path}.rebalance'):
+            os.remove(f'{path}.rebalance')
+    targets = [DatabaseManager(f'{path}.rebalance', sharded=True) for path in new_paths]
+    copied: Dict[str, int] = {}
+    try:
+        for path in current_paths:
+            source = sqlite3.connect(path)
+            try:
+                for table, count in _copy_rows(source, targets).items():
+                    copied[table] = copied.get(table, 0) + count
+            finally:
+                source.close()
+        for index, target in enumerate(targets):
+            target.db.commit()
+            target.check_shard_layout(index, shard_count)
+    finally:
+        for target in targets:
+            target.close()
+
+    for path in current_paths:
+        _detach_sidecars(path)
+        os.replace(path, f'{path}.bak')
+    for path in new_paths:
+        _detach_sidecars(f'{path}.rebalance')
+        _detach_sidecars(path)
+        os.replace(f'{path}.rebalance', path)
+
+    return copied
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Change the number of shards of a stopped user database.')
+    parser.add_argument('--db-path', default=DEFAULT_DB_PATH)
+    parser.add_argument('--shards', type=int, required=True, help='the new number of shards')
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error('--shards must be at least 1')
+
+    copied = rebalance(args.db_path, args.shards)
+    print(f'Rebalanced {args.db_path} onto {args.shards} shard(s): '
+          + ', '.join(f'{count} {table}' for table, count in copied.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Generator, Iterator, List, Optional, Sequence, Set, TypeVar
+
+from core import repositories
+from core.database_manager import DatabaseManager
+from core.row_mapping import DEFAULT_BATCH_SIZE
+from core.schemas import (InternalUser, OutboundEmail, RefreshToken, User, UserCredentials, UserIn,
+                          UserVerificationToken)
+from core.sharding import email_bucket, id_bucket, shard_index
+
+R = TypeVar('R')
+
+
+class ShardedDatabase(repositories.Database):  # pylint: disable=too-many-instance-attributes
+    # Presents N shard files as one database. A user and every row belonging to it live on the shard owning
+    # the user's bucket, so lookups by email or id go to one shard, and only lookups by token fan out.
+    #
+    # `pools` are the per-shard connection pools; a manager is only taken from a pool once the request touches
+    # that shard, and all of them are returned by close().
+    def __init__(self, pools: Sequence):
+        self.pools = pools
+        self._managers: Dict[int, DatabaseManager] = {}
+        self._transaction: Optional[ExitStack] = None
+        self._joined: Set[int] = set()
+        self._build_repositories(self)
+
+    @property
+    def shard_count(self) -> int:
+        return len(self.pools)
+
+    def _acquire(self, index: int) -> DatabaseManager:
+        manager = self._managers.get(index)
+        if manager is None:
+            manager = self._managers[index] = self.pools[index].acquire()
+
+        return manager
+
+    def shard(self, index: int) -> DatabaseManager:
+        # Shards join an open transaction when they are first written to or routed to; each shard commits on its
+        # own, so only a transaction that stays on one shard (as every service operation does) is atomic.
+        manager = self._acquire(index)
+        if self._transaction is not None and index not in self._joined:
+            self._transaction.enter_context(manager.transaction())
+            self._joined.add(index)
+
+        return manager
+
+    def reader(self, index: int) -> DatabaseManager:
+        # Fan-out lookups read every shard but only join the ones the transaction already writes to.
+        return self.shard(index) if index in self._joined else self._acquire(index)
+
+    def for_email(self, email: str) -> DatabaseManager:
+        return self.shard(shard_index(email_bucket(email), self.shard_count))
+
+    def for_id(self, id_: int) -> DatabaseManager:
+        return self.shard(shard_index(id_bucket(id_), self.shard_count))
+
+    def group_by_shard(self, ids: List[int]) -> Dict[int, List[int]]:
+        groups: Dict[int, List[int]] = {}
+        for id_ in ids:
+            groups.setdefault(shard_index(id_bucket(id_), self.shard_count), []).append(id_)
+
+        return groups
+
+    def find(self, lookup: Callable[[DatabaseManager], Optional[R]]) -> Optional[R]:
+        for index in range(self.shard_count):
+            result = lookup(self.reader(index))
+            if result is not None:
+                return result
+
+        return None
+
+    def total(self, operation: Callable[[DatabaseManager], int]) -> int:
+        return sum(operation(self.shard(index)) for index in range(self.shard_count))
+
+    @contextmanager
+    def transaction(self) -> Generator['ShardedDatabase', None, None]:
+        if self._transaction is not None:
+            yield self
+            return
+
+        with ExitStack() as stack:
+            self._transaction = stack
+            try:
+                for index in list(self._managers):
+                    self.shard(index)
+                yield self
+            finally:
+                self._transaction = None
+                self._joined.clear()
+
+    def close(self) -> None:
+        managers, self._managers = self._managers, {}
+        for index, manager in managers.items():
+            self.pools[index].release(manager)
+
+    class UserRepository(repositories.UserRepository):
+        def __init__(self, db: 'ShardedDatabase'):
+            self.db = db
+
+        def insert_user(self, user: UserIn) -> int:
+            return self.db.for_email(user.email).user_repository.insert_user(user)
+
+        def get_internal_user_by_email(self, email: str) -> Optional[InternalUser]:
+            return self.db.for_email(email).user_repository.get_internal_user_by_email(email)
+
+        def get_credentials_by_email(self, email: str) -> Optional[UserCredentials]:
+            return self.db.for_email(email).user_repository.get_credentials_by_email(email)
+
+        def get_user_by_id(self, id_: int) -> Optional[User]:
+            return self.db.for_id(id_).user_repository.get_user_by_id(id_)
+
+        def get_users_by_ids(self, ids: List[int]) -> List[User]:
+            return [user
+                    for index, shard_ids in self.db.group_by_shard(ids).items()
+                    for user in self.db.shard(index).user_repository.get_users_by_ids(shard_ids)]
+
+        def iter_users(self, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[User]:
+            # Shard by shard, so ids are only ordered within each shard.
+            for index in range(self.db.shard_count):
+                yield from self.db.reader(index).user_repository.iter_users(batch_size)
+
+        def verify_user(self, id_: int) -> bool:
+            return self.db.for_id(id_).user_repository.verify_user(id_)
+
+    class VerificationTokenRepository(repositories.VerificationTokenRepository):
+        def __init__(self, db: 'ShardedDatabase'):
+            self.db = db
+
+        def insert_verification_token(self, user_id: int, token: str, expiry: datetime) -> int:
+            return self.db.for_id(user_id).verification_repository.insert_verification_token(user_id, token, expiry)
+
+        def get_verification_token(self, token: str) -> Optional[UserVerificationToken]:
+            return self.db.find(lambda shard: shard.verification_repository.get_verification_token(token))
+
+        def get_verification_token_by_id(self, id_: int) -> Optional[UserVerificationToken]:
+            return self.db.for_id(id_).verification_repository.get_verification_token_by_id(id_)
+
+        def delete_verification_token(self, token: str) -> None:
+            verification_token = self.get_verification_token(token)
+            if verification_token:
+                self.db.for_id(verification_token.user_id).verification_repository.delete_verification_token(token)
+
+        def redeem_verification_token(self, token: str, now: int) -> Optional[User]:
+            # The token is located with a fan-out read; only the shard owning its user is written to.
+            verification_token = self.get_verification_token(token)
+            if not verification_token:
+                return None
+
+            return self.db.for_id(verification_token.user_id).verification_repository.redeem_verification_token(
+                token, now)
+
+        def delete_expired_verification_tokens(self, before: datetime) -> int:
+            return self.db.total(lambda shard: shard.verification_repository.delete_expired_verification_tokens(before))
+
+    class AuthenticationTokenRepository(repositories.AuthenticationTokenRepository):
+        def __init__(self, db: 'ShardedDatabase'):
+            self.db = db
+
+        def insert_auth_token(self, user_id: int, token: str, expiry: datetime) -> int:
+            return self.db.for_id(user_id).auth_repository.insert_auth_token(user_id, token, expiry)
+
+        def get_auth_token_user_by_id(self, user_id: int) -> Optional[str]:
+            return self.db.for_id(user_id).auth_repository.get_auth_token_user_by_id(user_id)
+
+        def delete_expired_auth_tokens(self, before: datetime) -> int:
+            return self.db.total(lambda shard: shard.auth_repository.delete_expired_auth_tokens(before))
+
+    class RefreshTokenRepository(repositories.RefreshTokenRepository):
+        def __init__(self, db: 'ShardedDatabase'):
+            self.db = db
+
+        def insert_refresh_token(self, user_id: int, token_hash: str, family_id: str, expiry: datetime) -> int:
+            return self.db.for_id(user_id).refresh_repository.insert_refresh_token(user_id, token_hash, family_id,
+                                                                                   expiry)
+
+        def get_refresh_token(self, token_hash: str) -> Optional[RefreshToken]:
+            return self.db.find(lambda shard: shard.refresh_repository.get_refresh_token(token_hash))
+
+        def revoke_refresh_token(self, id_: int) -> bool:
+            return self.db.for_id(id_).refresh_repository.revoke_refresh_token(id_)
+
+        def revoke_refresh_token_family(self, family_id: str, user_id: int) -> int:
+            # A family descends from one login, so it lives on its user's shard; fanning out would join every
+            # shard's writer lock into the open transaction and could deadlock against another revocation.
+            return self.db.for_id(user_id).refresh_repository.revoke_refresh_token_family(family_id, user_id)
+
+        def delete_expired_refresh_tokens(self, before: datetime) -> int:
+            return self.db.total(lambda shard: shard.refresh_repository.delete_expired_refresh_tokens(before))
+
+    class OutboxRepository(repositories.OutboxRepository):
+        def __init__(self, db: 'ShardedDatabase'):
+            self.db = db
+
+        def enqueue(self, recipient: str, subject: str, body: str, send_after: int) -> int:
+            return self.db.for_email(recipient).outbox_repository.enqueue(recipient, subject, body, send_after)
+
+        def claim_due(self, now: int, limit: int, max_attempts: int, lease_until: int) -> List[OutboundEmail]:
+            # The starting shard rotates so a busy shard cannot starve the others of batch slots.
+            messages: List[OutboundEmail] = []
+            for offset in range(self.db.shard_count):
+                if len(messages) >= limit:
+                    break
+                shard = self.db.shard((now + offset) % self.db.shard_count)
+                messages.extend(shard.outbox_repository.claim_due(now, limit - len(messages), max_attempts,
+                                                                  lease_until))
+
+            return messages
+
+        def mark_sent(self, ids: List[int]) -> None:
+            for index, shard_ids in self.db.group_by_shard(ids).items():
+                self.db.shard(index).outbox_repository.mark_sent(shard_ids)
+
+        def mark_failed(self, id_: int, retry_at: int, error: str) -> None:
+            self.db.for_id(id_).outbox_repository.mark_failed(id_, retry_at, error)
+
+        def count_pending(self, max_attempts: int) -> int:
+            return sum(self.db.reader(index).outbox_repository.count_pending(max_attempts)
+                       for index in range(self.db.shard_count))
@@ -0,0 +1,36 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import hashlib
+from pathlib import Path
+from typing import List
+
+# Users are hashed into a fixed number of buckets, and every id allocated for a user or one of its rows carries
+# the bucket in its low bits (id = sequence * BUCKET_COUNT + bucket). Shards own whole buckets, so any id can be
+# routed without a lookup, and changing the shard count only moves buckets, never renumbers rows.
+BUCKET_COUNT = 1024
+
+
+def email_bucket(email: str) -> int:
+    digest = hashlib.blake2b(email.strip().lower().encode('utf-8'), digest_size=8).digest()
+
+    return int.from_bytes(digest, 'big') % BUCKET_COUNT
+
+
+def id_bucket(id_: int) -> int:
+    return id_ % BUCKET_COUNT
+
+
+def bucket_id(sequence: int, bucket: int) -> int:
+    return sequence * BUCKET_COUNT + bucket
+
+
+def shard_index(bucket: int, shard_count: int) -> int:
+    return bucket % shard_count
+
+
+def shard_paths(db_path: str, shard_count: int) -> List[str]:
+    path = Path(db_path)
+
+    return [str(path.with_name(f'{path.stem}.{index}{path.suffix}')) for index in range(shard_count)]
@@ -0,0 +1,159 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from core.configuration import Settings, add_activation_hook, get_settings
+
+KEY_SUFFIX = '.pem'
+ALGORITHMS = ('EdDSA', 'RS256')
+
+
+@dataclass(frozen=True)
+class SigningKey:
+    kid: Optional[str]
+    algorithm: str
+    signing_key: Any
+    verifying_key: Any
+    public_jwk: Optional[Dict[str, Any]] = None
+
+
+class KeyRing:
+    # Every key in JWT_KEY_DIR verifies tokens, indexed by key id, while only the active one signs new tokens.
+    # Keys are rotated by adding a new file and reloading the configuration; the previous key keeps verifying
+    # the tokens it signed until it is removed, which is safe once AUTH_TOKEN_EXPIRY_PERIOD_IN_MINS has passed.
+    def __init__(self, keys: List[SigningKey], active_kid: Optional[str]):
+        self.keys: Dict[Optional[str], SigningKey] = {key.kid: key for key in keys}
+        self.active = self.keys[active_kid]
+        public_keys = [key.public_jwk for key in keys if key.public_jwk is not None]
+        self.jwks = {'keys': public_keys}
+        self.etag = f'"{hashlib.sha256(json.dumps(public_keys, sort_keys=True).encode()).hexdigest()[:16]}"'
+
+    def get(self, kid: Optional[str]) -> Optional[SigningKey]:
+        return self.keys.get(kid)
+
+
+def _load_key(path: str, kid: str) -> SigningKey:
+    # pylint: disable=import-outside-toplevel
+    from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+    from jwt.algorithms import OKPAlgorithm, RSAAlgorithm
+
+    with open(path, 'rb') as key_file:
+        private_key = load_pem_private_key(key_file.read(), password=None)
+    public_key = private_key.public_key()
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        algorithm, jwk = 'EdDSA', OKPAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+    elif isinstance(private_key, rsa.RSAPrivateKey):
+        algorithm, jwk = 'RS256', RSAAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+    else:
+        raise ValueError(f'{path} must be an Ed25519 or RSA private key.')
+
+    return SigningKey(kid=kid,
+                      algorithm=algorithm,
+                      signing_key=private_key,
+                      verifying_key=public_key,
+                      public_jwk={**jwk, 'kid': kid, 'alg': algorithm, 'use': 'sig'})
+
+
+def load_key_ring(settings: Settings) -> KeyRing:
+    # Without JWT_KEY_DIR tokens keep being signed with SECRET_KEY (HS256), and the JWKS is empty.
+    if not settings.jwt_key_dir:
+        return KeyRing([SigningKey(kid=None, algorithm='HS256', signing_key=settings.secret_key,
+                                   verifying_key=settings.secret_key)], active_kid=None)
+
+    try:
+        names = sorted(name for name in os.listdir(settings.jwt_key_dir) if name.endswith(KEY_SUFFIX))
+    except OSError as exc:
+        raise ValueError(f'JWT_KEY_DIR cannot be read: {exc}') from exc
+    if not names:
+        raise ValueError(f'JWT_KEY_DIR contains no {KEY_SUFFIX} keys.')
+    try:
+        keys = [_load_key(os.path.join(settings.jwt_key_dir, name), name[:-len(KEY_SUFFIX)]) for name in names]
+    except ImportError as exc:
+        raise ValueError('Signing with JWT_KEY_DIR requires the cryptography package.') from exc
+
+    # Generated key ids start with their creation time, so the newest key signs unless one is pinned.
+    active_kid = settings.jwt_active_key_id or keys[-1].kid
+    if active_kid not in {key.kid for key in keys}:
+        raise ValueError(f'JWT_ACTIVE_KEY_ID {active_kid} is not in JWT_KEY_DIR.')
+
+    return KeyRing(keys, active_kid)
+
+
+_key_ring: Optional[Tuple[Settings, KeyRing]] = None  # pylint: disable=invalid-name
+_key_ring_lock = threading.Lock()
+
+
+def _prepare_key_ring(settings: Settings) -> Callable[[], None]:
+    # A key ring that does not load rejects the settings, so a bad JWT_KEY_DIR or JWT_ACTIVE_KEY_ID never goes live.
+    key_ring = load_key_ring(settings)
+
+    def install() -> None:
+        global _key_ring  # pylint: disable=global-statement
+        with _key_ring_lock:
+            _key_ring = (settings, key_ring)
+
+    return install
+
+
+add_activation_hook(_prepare_key_ring)
+
+
+def get_key_ring(settings: Optional[Settings] = None) -> KeyRing:
+    # Keys are parsed once per settings object, and installed along with the configuration when it is loaded or
+    # reloaded on SIGHUP, so never on the request path otherwise.
+    global _key_ring  # pylint: disable=global-statement
+    settings = settings or get_settings()
+    cached = _key_ring
+    if cached is not None and cached[0] is settings:
+        return cached[1]
+
+    with _key_ring_lock:
+        if _key_ring is None or _key_ring[0] is not settings:
+            _key_ring = (settings, load_key_ring(settings))
+
+        return _key_ring[1]
+
+
+def generate_key(key_dir: str, algorithm: str) -> str:
+    # pylint: disable=import-outside-toplevel
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+    if algorithm == 'EdDSA':
+        private_key: Any = ed25519.Ed25519PrivateKey.generate()
+    else:
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(encoding=serialization.Encoding.PEM,
+                                    format=serialization.PrivateFormat.PKCS8,
+                                    encryption_algorithm=serialization.NoEncryption())
+
+    kid = f'{datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")}-{os.urandom(4).hex()}'
+    os.makedirs(key_dir, exist_ok=True)
+    fd = os.open(os.path.join(key_dir, f'{kid}{KEY_SUFFIX}'), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as key_file:
+        key_file.write(pem)
+
+    return kid
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Add a new signing key to the JWT key ring.')
+    parser.add_argument('--key-dir', required=True)
+    parser.add_argument('--algorithm', choices=ALGORITHMS, default='EdDSA')
+    args = parser.parse_args()
+
+    print(f'Created signing key {generate_key(args.key_dir, args.algorithm)} in {args.key_dir}')
+
+
+if __name__ == '__main__':
+    main()
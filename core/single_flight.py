@@ -0,0 +1,87 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import threading
+from typing import Callable, Dict, Optional, TypeVar
+
+from core.configuration import get_settings
+
+R = TypeVar('R')
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution: the first caller runs it, the others wait for
+    # its result. Nothing is cached once the call returns, so callers never see a result older than their own
+    # request. A caller waiting longer than the timeout stops waiting and runs the call itself, so a stuck
+    # leader delays the others by at most the timeout and never fails them. Shared results must not be mutated.
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._metrics: Dict[str, Dict[str, int]] = {}
+        self._totals = {'executed': 0, 'shared': 0, 'timeouts': 0, 'errors': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key: str, metric: str) -> None:
+        # Counted per kind of call, the part of the key before its first ':', as the rest is an id or a token
+        # that must neither be exposed nor grow the metrics without bound.
+        kind = key.partition(':')[0]
+        with self._lock:
+            metrics = self._metrics.setdefault(kind, dict.fromkeys(self._totals, 0))
+            metrics[metric] += 1
+            self._totals[metric] += 1
+
+    def do(self, key: str, function: Callable[[], R], timeout: Optional[float] = None) -> R:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            try:
+                call.result = function()
+            except BaseException as exc:
+                call.error = exc
+                self._count(key, 'errors')
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            self._count(key, 'executed')
+            return call.result
+
+        if not call.done.wait(timeout):
+            self._count(key, 'timeouts')
+            return function()
+        if call.error is not None:
+            raise call.error
+        self._count(key, 'shared')
+
+        return call.result  # type: ignore
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {'totals': dict(self._totals),
+                    'in_flight': len(self._calls),
+                    'kinds': {kind: dict(metrics) for kind, metrics in self._metrics.items()}}
+
+
+_single_flight = SingleFlight()  # pylint: disable=invalid-name
+
+
+def get_single_flight() -> SingleFlight:
+    return _single_flight
+
+
+def coalesce(key: str, function: Callable[[], R]) -> R:
+    return _single_flight.do(key, function, timeout=get_settings().single_flight_timeout)
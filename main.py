@@ -2,14 +2,55 @@
 # All rights reserved
 
 
-from http.server import HTTPServer
-from core.service_handler import ServiceRequestHandler
+import argparse
 import threading
 
+from core.audit import start_audit_log, stop_audit_log
+from core.configuration import (DEFAULT_CONFIGURATION_PATH,
+                                add_reload_listener,
+                                get_settings,
+                                install_reload_handler,
+                                load_configuration)
+from core.database_manager import DEFAULT_DB_PATH
+from core.mail_dispatcher import start_mail_dispatcher
+from core.maintenance import start_maintenance, stop_maintenance
+from core.dependencies import (apply_settings,
+                               clear_database_pool,
+                               configure_database,
+                               configure_in_memory_database,
+                               start_email_filter_refresh,
+                               stop_email_filter_refresh)
+from core.server import (DEFAULT_UNIX_SOCKET_MODE,
+                         SERVER_CLASSES,
+                         ThreadingServiceHTTPServer,
+                         create_server,
+                         create_unix_server,
+                         serve)
+from core.service_handler import ServiceRequestHandler
+
+
+def warm_up(handler_class=ServiceRequestHandler, db_path=DEFAULT_DB_PATH, config_path=DEFAULT_CONFIGURATION_PATH,
+            storage='sqlite', shards=0):
+    load_configuration(config_path)
+    handler_class.warm_up()
+    if storage == 'memory':
+        configure_in_memory_database()
+    else:
+        configure_database(db_path=db_path, shards=shards)
+
+
+def run_server(server_class=ThreadingServiceHTTPServer, handler_class=ServiceRequestHandler, port=5000,
+               unix_socket=None, unix_socket_mode=DEFAULT_UNIX_SOCKET_MODE):
+    # With a Unix socket, the TCP port is optional: without one the socket is the only listener, with one
+    # the socket is served next to it.
+    if unix_socket is None:
+        return create_server(server_class, handler_class, ('', port))
 
-def run_server(server_class=HTTPServer, handler_class=ServiceRequestHandler, port=5000):
-    server_address = ('', port)
-    httpd = server_class(server_address, handler_class)
+    unix_httpd = create_unix_server(server_class, handler_class, unix_socket, unix_socket_mode)
+    if port is None:
+        return unix_httpd
+    httpd = create_server(server_class, handler_class, ('', port))
+    httpd.companions = (unix_httpd,)
 
     return httpd
 
@@ -20,27 +61,74 @@ class ServerThread(threading.Thread):
         self.httpd = httpd
 
     def run(self):
+        for companion in self.httpd.companions:
+            threading.Thread(target=companion.serve_forever, daemon=True).start()
         self.httpd.serve_forever()
 
     def stop_server(self):
-        self.httpd.shutdown()
-        self.httpd.server_close()
+        for server in (self.httpd, *self.httpd.companions):
+            server.shutdown()
+            server.socket.close()
+        self.httpd.lifecycle.drain(get_settings().drain_timeout)
+        for server in (self.httpd, *self.httpd.companions):
+            server.server_close()
         print('Server stopped.')
 
 
-def run(port):
-    httpd = run_server(port=port)
+def run(port, db_path=DEFAULT_DB_PATH, config_path=DEFAULT_CONFIGURATION_PATH,  # pylint: disable=too-many-arguments
+        mode='threaded', storage='sqlite', *, shards=0, unix_socket=None, unix_socket_mode=DEFAULT_UNIX_SOCKET_MODE):
+    # Configuration, handler imports, schema creation and the connection pool are all set up before the
+    # socket is bound, so the first request accepted is served as fast as any later one.
+    warm_up(db_path=db_path, config_path=config_path, storage=storage, shards=shards)
+    httpd = run_server(server_class=SERVER_CLASSES[mode], port=port, unix_socket=unix_socket,
+                       unix_socket_mode=unix_socket_mode)
+    httpd.lifecycle.start()
+    dispatcher = start_mail_dispatcher()
+    if dispatcher:
+        # Stopped after the drain, so verification emails queued by the last requests are still sent.
+        httpd.lifecycle.add_flush_callback(dispatcher.stop)
+    if start_audit_log():
+        # Likewise, events recorded by the drained requests are written before the process exits.
+        httpd.lifecycle.add_flush_callback(stop_audit_log)
+    if start_maintenance():
+        httpd.lifecycle.add_flush_callback(stop_maintenance)
+    if start_email_filter_refresh():
+        httpd.lifecycle.add_flush_callback(stop_email_filter_refresh)
     if __name__ == '__main__':
-        print(f'Starting server on port {httpd.server_port}')
-        try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            pass
-        httpd.server_close()
+        add_reload_listener(apply_settings)
+        install_reload_handler()
+        for server in (httpd, *httpd.companions):
+            print(f'Starting server on {server.server_address if server.server_port == 0 else server.server_port}')
+        serve(httpd, drain_timeout=get_settings().drain_timeout)
+        clear_database_pool()
         print('Server stopped.')
     else:
         return httpd
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the user management service.')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--db-path', default=DEFAULT_DB_PATH)
+    parser.add_argument('--config', default=DEFAULT_CONFIGURATION_PATH)
+    parser.add_argument('--mode', choices=sorted(SERVER_CLASSES), default='threaded',
+                        help='serve requests on the main thread or on one thread per request')
+    parser.add_argument('--storage', choices=['sqlite', 'memory'], default='sqlite',
+                        help='persist users in the SQLite database or keep them in memory for this process only')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='partition SQLite storage across this many database files (0 for a single file)')
+    parser.add_argument('--unix-socket', help='also serve on a Unix domain socket at this path')
+    parser.add_argument('--unix-socket-mode', type=lambda value: int(value, 8), default=DEFAULT_UNIX_SOCKET_MODE,
+                        help='permissions of the Unix socket, in octal (default: 660)')
+    parser.add_argument('--no-tcp', action='store_true', help='serve on the Unix socket only')
+
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    run(port=5000)
+    args = parse_args()
+    if args.no_tcp and not args.unix_socket:
+        raise SystemExit('--no-tcp requires --unix-socket')
+    run(port=None if args.no_tcp else args.port, db_path=args.db_path, config_path=args.config, mode=args.mode,
+        storage=args.storage, shards=args.shards, unix_socket=args.unix_socket,
+        unix_socket_mode=args.unix_socket_mode)
@@ -0,0 +1,11 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def storage(db):
+    # The server answers from whichever backend `db` installed, so every API test runs against SQLite and memory.
+    return db
@@ -6,9 +6,11 @@ from typing import Dict, Tuple
 
 from httpx import Client
 
+from core.configuration import load_configuration
 from core.database_manager import DatabaseManager
 from tests.fixtures import user_data
-from tests.helpers import extract_token
+from tests.core.test_configuration import write_config
+from tests.helpers import extract_token, sign_token
 
 
 def register_user(data: dict, client: Client) -> Tuple[Dict, int]:
@@ -64,3 +66,70 @@ def test_get_current_logged_in_user_with_invalid_token(client: Client, db: Datab
 
     assert response.status_code == 401
     assert json_response['message'] == 'Invalid token.'
+
+
+def test_get_current_logged_in_user_that_no_longer_exists(client: Client, db: DatabaseManager) -> None:
+    response = client.get('/current-user', headers={'Authorization': f'Bearer {sign_token(999999)}'})
+
+    assert response.status_code == 404
+    assert response.json()['message'] == 'User not found.'
+
+
+def test_get_current_logged_in_user_not_modified(user_data: dict, client: Client, db: DatabaseManager) -> None:
+    token = authenticate_user(user_data=user_data, client=client)
+
+    response = client.get('/current-user', headers={'Authorization': token})
+    etag = response.headers['ETag']
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+
+    response = client.get('/current-user', headers={'Authorization': token, 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.content == b''
+    assert response.headers['ETag'] == etag
+
+    response = client.get('/current-user', headers={'Authorization': token, 'If-None-Match': '"stale"'})
+    assert response.status_code == 200
+    assert response.json()['data']['email'] == user_data['email']
+
+
+def test_get_jwks(client: Client) -> None:
+    response = client.get('/.well-known/jwks.json')
+    etag = response.headers['ETag']
+
+    assert response.status_code == 200
+    assert response.json()['keys'] == []
+    assert response.headers['Cache-Control'].startswith('public, max-age=')
+
+    response = client.get('/.well-known/jwks.json', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def test_admin_routes_require_the_admin_token(client: Client, tmp_path) -> None:
+    assert client.get('/admin/email-filter').status_code == 404
+
+    load_configuration(write_config(tmp_path / '.env', ADMIN_TOKEN='admin-secret'))
+    try:
+        assert client.get('/admin/email-filter', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+
+        response = client.post('/admin/email-filter/rebuild', json={},
+                               headers={'Authorization': 'Bearer admin-secret'})
+        assert response.status_code == 200
+        assert response.json()['data']['rebuilds'] == 2
+
+        response = client.get('/admin/email-filter', headers={'Authorization': 'Bearer admin-secret'})
+        assert response.json()['data']['hash_count'] > 0
+    finally:
+        load_configuration()
+
+
+def test_database_stats_list_tables_on_request(client: Client, tmp_path) -> None:
+    load_configuration(write_config(tmp_path / '.env', ADMIN_TOKEN='admin-secret'))
+    try:
+        headers = {'Authorization': 'Bearer admin-secret'}
+        files = client.get('/admin/database', headers=headers).json()['data']['files']
+        assert all('tables' not in stats for stats in files.values())
+
+        files = client.get('/admin/database?tables=true', headers=headers).json()['data']['files']
+        assert all('users' in stats['tables'] for stats in files.values())
+    finally:
+        load_configuration()
@@ -0,0 +1,79 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+from httpx import Client
+
+from core.configuration import get_settings
+from core.database_manager import DatabaseManager
+from tests.api.test_authentication import authenticate_user
+from tests.fixtures import user_data
+from tests.helpers import sign_token
+
+
+def test_get_users_batch(user_data: dict, client: Client, db: DatabaseManager) -> None:
+    token = authenticate_user(user_data=user_data, client=client)
+    user_id = client.get('/current-user', headers={'Authorization': token}).json()['data']['id']
+
+    response = client.post('/users/batch', json={'ids': [user_id, 999999, user_id]},
+                           headers={'Authorization': token})
+    json_response = response.json()
+
+    assert response.status_code == 200
+    assert [item['status_code'] for item in json_response['data']] == [200, 404, 200]
+    assert json_response['data'][0]['data']['email'] == user_data['email']
+    assert json_response['data'][1]['id'] == 999999
+
+
+def test_batch_size_is_capped(user_data: dict, client: Client, db: DatabaseManager) -> None:
+    token = authenticate_user(user_data=user_data, client=client)
+
+    ids = list(range(get_settings().max_batch_size + 1))
+    response = client.post('/users/batch', json={'ids': ids}, headers={'Authorization': token})
+    assert response.status_code == 400
+
+    response = client.post('/users/batch', json={'ids': 'all'}, headers={'Authorization': token})
+    assert response.status_code == 400
+
+
+def test_invalid_ids_only_fail_their_item(user_data: dict, client: Client, db: DatabaseManager) -> None:
+    token = authenticate_user(user_data=user_data, client=client)
+    user_id = client.get('/current-user', headers={'Authorization': token}).json()['data']['id']
+
+    response = client.post('/users/batch', json={'ids': ['1', user_id, True]}, headers={'Authorization': token})
+
+    assert response.status_code == 200
+    assert [item['status_code'] for item in response.json()['data']] == [400, 200, 400]
+    assert response.json()['data'][0] == {'id': '1', 'message': 'id must be an integer.', 'status_code': 400}
+
+
+def test_introspect_tokens(user_data: dict, client: Client, db: DatabaseManager) -> None:
+    token = authenticate_user(user_data=user_data, client=client)
+
+    response = client.post('/tokens/introspect', json={'tokens': [token, 'invalid token']},
+                           headers={'Authorization': token})
+    json_response = response.json()
+
+    assert response.status_code == 200
+    assert json_response['data'][0]['active'] is True
+    assert json_response['data'][0]['data']['email'] == user_data['email']
+    assert json_response['data'][1] == {'active': False, 'message': 'Invalid token.'}
+
+
+def test_introspect_tokens_with_a_malformed_user_id(user_data: dict, client: Client, db: DatabaseManager) -> None:
+    token = authenticate_user(user_data=user_data, client=client)
+    malformed = [sign_token('abc'), sign_token(None)]
+
+    response = client.post('/tokens/introspect', json={'tokens': [*malformed, token]},
+                           headers={'Authorization': token})
+    json_response = response.json()
+
+    assert response.status_code == 200
+    assert json_response['data'][:2] == [{'active': False, 'message': 'Invalid token.'}] * 2
+    assert json_response['data'][2]['active'] is True
+
+
+def test_batch_requires_token(client: Client, db: DatabaseManager) -> None:
+    response = client.post('/users/batch', json={'ids': [1]})
+
+    assert response.status_code == 401
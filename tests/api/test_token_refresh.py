@@ -0,0 +1,72 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import hashlib
+from datetime import datetime, timedelta
+
+from httpx import Client
+
+from core.database_manager import DatabaseManager
+from tests.api.test_authentication import authenticate_user
+from tests.fixtures import user_data
+
+
+def login(user_data: dict, client: Client) -> dict:
+    authenticate_user(user_data=user_data, client=client)
+    credentials = {'email': user_data['email'],
+                   'password': user_data['password']}
+
+    return client.post('/login', json=credentials).json()['data']
+
+
+def test_refresh_rotates_tokens(user_data: dict, client: Client, db: DatabaseManager) -> None:
+    tokens = login(user_data=user_data, client=client)
+
+    response = client.post('/token/refresh', json={'refresh_token': tokens['refresh_token']})
+    json_response = response.json()
+
+    assert response.status_code == 200
+    assert json_response['data']['refresh_token'] != tokens['refresh_token']
+    assert json_response['data']['expires_in'] > 0
+
+    current_user = client.get('/current-user', headers={'Authorization': json_response['data']['access_token']})
+    assert current_user.status_code == 200
+    assert current_user.json()['data']['email'] == user_data['email']
+
+
+def test_refresh_token_reuse_revokes_family(user_data: dict, client: Client, db: DatabaseManager) -> None:
+    tokens = login(user_data=user_data, client=client)
+    rotated = client.post('/token/refresh', json={'refresh_token': tokens['refresh_token']}).json()['data']
+
+    reused = client.post('/token/refresh', json={'refresh_token': tokens['refresh_token']})
+    assert reused.status_code == 401
+    assert reused.json()['message'] == 'Invalid refresh token.'
+
+    response = client.post('/token/refresh', json={'refresh_token': rotated['refresh_token']})
+    assert response.status_code == 401
+
+
+def test_refresh_with_unknown_token(client: Client, db: DatabaseManager) -> None:
+    response = client.post('/token/refresh', json={'refresh_token': 'unknown'})
+
+    assert response.status_code == 401
+
+    response = client.post('/token/refresh', json={})
+    assert response.status_code == 400
+
+
+def test_expired_refresh_token_is_not_consumed(user_data: dict, client: Client, db: DatabaseManager) -> None:
+    tokens = login(user_data=user_data, client=client)
+    user_id = db.user_repository.get_internal_user_by_email(email=user_data['email']).id
+    token_hash = hashlib.sha256(b'expired').hexdigest()
+    db.refresh_repository.insert_refresh_token(user_id=user_id, token_hash=token_hash, family_id='family',
+                                               expiry=datetime.utcnow() - timedelta(minutes=1))
+
+    response = client.post('/token/refresh', json={'refresh_token': 'expired'})
+    assert response.status_code == 401
+    assert response.json()['message'] == 'Refresh token expired.'
+    assert db.refresh_repository.get_refresh_token(token_hash=token_hash).revoked is False
+
+    response = client.post('/token/refresh', json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == 200
@@ -0,0 +1,89 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import pytest
+from httpx import Client
+
+from benchmarks.load_generator import LoadOptions, parse_mix, percentile, run_load_test, seed_users
+from core.configuration import load_configuration
+from core.dependencies import ShardedDatabasePool, configure_database, use_database
+from tests.core.test_configuration import write_config
+
+
+ADMIN_TOKEN = 'admin-token'
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    # Configured like `python main.py --db-path` for a load test, email filter included and rate limiting off, while
+    # the generator seeds users through its own connection as it does against a real server.
+    db_path = str(tmp_path / 'ableton_user_management.db')
+    load_configuration(write_config(tmp_path / '.env', ADMIN_TOKEN=ADMIN_TOKEN, RATE_LIMIT_STORE='off'))
+    previous = use_database(None)
+    configure_database(db_path)
+
+    yield db_path
+
+    use_database(previous).clear()
+    load_configuration()
+
+
+def test_parse_mix() -> None:
+    assert parse_mix('register=1,/login=2, current-user=0') == {'/register': 1.0, '/login': 2.0}
+
+
+def test_parse_mix_with_unknown_route() -> None:
+    with pytest.raises(ValueError):
+        parse_mix('register=1,logout=1')
+
+
+def test_parse_mix_without_positive_weight() -> None:
+    with pytest.raises(ValueError):
+        parse_mix('register=0')
+
+
+def test_percentile() -> None:
+    values = [float(value) for value in range(1, 101)]
+
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile(values, 100) == 100.0
+    assert percentile([], 50) == 0.0
+
+
+def test_seeded_users_are_routed_to_their_shard(tmp_path) -> None:
+    db_path = str(tmp_path / 'ableton_user_management.db')
+    emails = seed_users(db_path, count=4, prefix='sharded', shards=2)
+
+    pool = ShardedDatabasePool(db_path, shard_count=2)
+    try:
+        with pool.connection() as db:
+            for email in emails:
+                assert db.user_repository.get_credentials_by_email(email=email).email_verified
+    finally:
+        pool.clear()
+
+
+@pytest.mark.parametrize('rps', [None, 20.0])
+def test_run_load_test(rps: float, client: Client, db_path: str) -> None:
+    report = run_load_test(LoadOptions(port=8001, db_path=db_path, users=2, concurrency=2, duration=0.5,
+                                       rps=rps, mix='register=1,login=1,current-user=4', admin_token=ADMIN_TOKEN))
+
+    assert report['mode'] == ('open' if rps else 'closed')
+    assert report['total']['requests'] > 0
+    assert report['total']['errors'] == 0
+    assert report['throttled'] == 0
+    assert set(report['routes']) == {'/register', '/login', '/current-user'}
+    for route in report['routes'].values():
+        latency = route['latency_ms']
+        assert latency['p50'] <= latency['p95'] <= latency['p99'] <= latency['max']
+
+
+def test_throttled_runs_are_reported(client: Client, db_path: str, tmp_path, capsys) -> None:
+    load_configuration(write_config(tmp_path / '.env', ADMIN_TOKEN=ADMIN_TOKEN, RATE_LIMIT_EMAIL_BURST=1))
+    report = run_load_test(LoadOptions(port=8001, db_path=db_path, users=2, concurrency=2, duration=0.5,
+                                       mix='login=1,current-user=1', admin_token=ADMIN_TOKEN))
+
+    assert report['throttled'] > 0
+    assert 'RATE_LIMIT_STORE=off' in capsys.readouterr().err
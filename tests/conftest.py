@@ -2,28 +2,65 @@
 # All rights reserved
 
 
-import os
 import threading
 
 import httpx
 import pytest
 
 from core.database_manager import DatabaseManager
+from core.dependencies import DatabasePool, SharedDatabase, build_email_filter, use_database
+from core.memory_database import InMemoryDatabase
+from core.rate_limiter import get_rate_limiter
 from main import run, ServerThread
 
 
+@pytest.fixture(autouse=True)
+def rate_limiter():
+    # Every test starts with full buckets: the suite logs in with the same few emails, all from 127.0.0.1, far more
+    # often than one client may.
+    yield
+
+    limiter = get_rate_limiter()
+    if limiter:
+        limiter.store.clear()
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    db_path = str(tmp_path / 'ableton_user_management.db')
+    db = DatabaseManager(db_path)
+    pool = DatabasePool(db_path)
+    # Set up like configure_database() does for the server.
+    build_email_filter(pool)
+    previous = use_database(pool)
+
+    yield db
+
+    use_database(previous).clear()
+    db.close()
+
+
 @pytest.fixture
-def db():
-    db_path = 'ableton_user_management.db'
+def memory_db():
+    db = InMemoryDatabase()
+    provider = SharedDatabase(db)
+    build_email_filter(provider)
+    previous = use_database(provider)
+
+    yield db
+
+    use_database(previous)
 
-    yield DatabaseManager(db_path)
 
-    os.remove(db_path)
+@pytest.fixture(params=['sqlite', 'memory'])
+def db(request):
+    return request.getfixturevalue(f'{request.param}_db')
 
 
 @pytest.fixture(scope='module')
 def client():
-    httpd = run(port=8001)
+    # The server looks its storage up per request, so it serves from whichever backend the test's `db` installed.
+    httpd = run(port=8001, storage='memory')
     server_thread = ServerThread(httpd)
     server_thread.start()
 
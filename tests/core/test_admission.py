@@ -0,0 +1,86 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import threading
+import time
+from dataclasses import replace
+
+import pytest
+from httpx import Client
+
+from core.admission import HIGH, LOW, AdmissionController, Overloaded, get_admission_controller
+from core.configuration import get_settings, load_configuration
+from tests.core.test_configuration import write_config
+
+
+def test_low_priority_requests_are_shed_after_the_queue_deadline(monkeypatch) -> None:
+    settings = replace(get_settings(), admission_low_concurrency=1, admission_low_queue_timeout=0.05)
+    monkeypatch.setattr('core.admission.get_settings', lambda: settings)
+    controller = AdmissionController()
+
+    with controller.admit(LOW):
+        with pytest.raises(Overloaded) as exc_info:
+            with controller.admit(LOW):
+                pass
+        with controller.admit(HIGH):
+            pass
+
+    assert exc_info.value.retry_after == 1
+    assert controller.stats()[LOW]['shed'] == 1
+    assert controller.stats()[HIGH]['admitted'] == 1
+
+
+def test_low_priority_requests_are_shed_at_once_while_high_priority_requests_wait(monkeypatch) -> None:
+    settings = replace(get_settings(), admission_low_concurrency=1, admission_high_concurrency=1)
+    monkeypatch.setattr('core.admission.get_settings', lambda: settings)
+    controller = AdmissionController()
+    released = threading.Event()
+
+    def hold_high_slot():
+        with controller.admit(HIGH):
+            released.wait()
+
+    def wait_until(condition):
+        while not condition():
+            time.sleep(0.001)
+
+    with controller.admit(LOW):
+        holder = threading.Thread(target=hold_high_slot)
+        holder.start()
+        wait_until(lambda: controller.stats()[HIGH]['active'])
+        waiter = threading.Thread(target=hold_high_slot)
+        waiter.start()
+        wait_until(lambda: controller.stats()[HIGH]['waiting'])
+
+        with pytest.raises(Overloaded):
+            with controller.admit(LOW):
+                pass
+        released.set()
+        holder.join()
+        waiter.join()
+
+
+def test_standing_queue_turns_shedding_on() -> None:
+    priority_class = AdmissionController().classes[LOW]
+
+    priority_class.observe_delay(0.5, target=0.1, now=10.0)
+    assert not priority_class.shedding
+    priority_class.observe_delay(0.5, target=0.1, now=11.5)
+    assert priority_class.shedding
+    priority_class.observe_delay(0.01, target=0.1, now=12.0)
+    assert not priority_class.shedding
+
+
+def test_health_check_is_served_while_logins_are_shed(client: Client, tmp_path) -> None:
+    load_configuration(write_config(tmp_path / '.env', ADMISSION_LOW_CONCURRENCY=1,
+                                    ADMISSION_LOW_QUEUE_TIMEOUT_IN_SECS=0.05))
+    try:
+        with get_admission_controller().admit(LOW):
+            response = client.post('/login', json={'email': 'user@example.com', 'password': 'SecurePassword123'})
+            assert response.status_code == 503
+            assert response.headers['Retry-After'] == '1'
+
+            assert client.get('/health-check').json()['message'] == 'OK'
+    finally:
+        load_configuration()
@@ -0,0 +1,59 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import json
+from dataclasses import replace
+
+from core.audit import AuditLog, audit, start_audit_log, stop_audit_log
+from core.configuration import get_settings
+
+
+def read_events(directory) -> list:
+    return [json.loads(line)
+            for path in sorted(directory.iterdir())
+            for line in path.read_text(encoding='utf-8').splitlines()]
+
+
+def test_audit_log_writes_events_as_json_lines(tmp_path) -> None:
+    start_audit_log(replace(get_settings(), audit_log_dir=str(tmp_path)))
+    audit('login', outcome='success', user_id=1)
+    audit('token_issued', grant='password', user_id=1)
+    stop_audit_log()
+
+    events = read_events(tmp_path)
+    assert [event['event'] for event in events] == ['login', 'token_issued']
+    assert events[0]['outcome'] == 'success'
+    assert events[1]['grant'] == 'password'
+    assert all(event['timestamp'] for event in events)
+
+
+def test_audit_is_a_no_op_without_a_log_dir(tmp_path) -> None:
+    assert start_audit_log(replace(get_settings(), audit_log_dir='')) is None
+    audit('login', outcome='success', user_id=1)
+
+    assert not list(tmp_path.iterdir())
+
+
+def test_audit_log_drops_events_when_the_queue_is_full(tmp_path) -> None:
+    audit_log = AuditLog(replace(get_settings(), audit_log_dir=str(tmp_path), audit_queue_size=2))
+    for user_id in range(5):
+        audit_log.record('login', outcome='success', user_id=user_id)
+    audit_log.start()
+    audit_log.stop()
+
+    assert audit_log.dropped == 3
+    assert audit_log.written == 2
+    assert [event['user_id'] for event in read_events(tmp_path)] == [0, 1]
+
+
+def test_audit_log_rotates_files_by_size(tmp_path) -> None:
+    audit_log = AuditLog(replace(get_settings(), audit_log_dir=str(tmp_path), audit_batch_size=1,
+                                 audit_max_file_bytes=1))
+    audit_log.start()
+    for user_id in range(3):
+        audit_log.record('login', outcome='success', user_id=user_id)
+    audit_log.stop()
+
+    assert len(list(tmp_path.iterdir())) == 3
+    assert [event['user_id'] for event in read_events(tmp_path)] == [0, 1, 2]
@@ -0,0 +1,84 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import gzip
+import sqlite3
+import threading
+from dataclasses import replace
+
+from core.backup import DONE, BackupJob, backup_file
+from core.configuration import get_settings
+from core.database_manager import DatabaseManager
+from core.dependencies import get_database_provider
+from core.schemas import UserIn
+
+
+def insert_users(db: DatabaseManager, count: int, prefix: str = 'user') -> None:
+    with db.transaction():
+        for index in range(count):
+            db.user_repository.insert_user(UserIn(email=f'{prefix}{index}@example.com', first_name='John',
+                                                  last_name='Doe', password='SecurePassword123'))
+
+
+def count_users(path: str) -> int:
+    snapshot = sqlite3.connect(path)
+    try:
+        assert snapshot.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+        return snapshot.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    finally:
+        snapshot.close()
+
+
+def test_backup_is_consistent_while_writes_continue(sqlite_db: DatabaseManager, tmp_path) -> None:
+    insert_users(sqlite_db, 500)
+    [writer] = get_database_provider().writers().values()
+    steps = []
+    batches = []
+    writing = threading.Event()
+
+    def write_during_backup():
+        with get_database_provider().connection() as db:
+            while not writing.is_set():
+                insert_users(db, 10, prefix=f'late{len(batches)}-')
+                batches.append(len(steps))
+                writing.wait(0.001)
+
+    thread = threading.Thread(target=write_during_backup)
+    thread.start()
+    try:
+        target = str(tmp_path / 'backup.db')
+        backup_file(writer, target, step_pages=4, step_pause=0.001,
+                    progress=lambda copied, total: steps.append((copied, total)))
+    finally:
+        writing.set()
+        thread.join()
+
+    # Writes went on between the backup's steps.
+    assert len(steps) > 1 and any(0 < step < len(steps) for step in batches)
+    assert steps[-1][0] == steps[-1][1]
+    assert count_users(target) >= 500
+
+
+def test_compressed_backup(sqlite_db: DatabaseManager, tmp_path) -> None:
+    insert_users(sqlite_db, 10)
+    settings = replace(get_settings(), backup_dir=str(tmp_path))
+    job = BackupJob(get_database_provider().writers(), settings, compress=True)
+    job.run()
+
+    stats = job.stats()
+    assert stats['state'] == DONE and stats['progress'] == 1.0
+    [backup] = stats['files']
+    assert backup['target'].endswith('.db.gz')
+    with gzip.open(backup['target'], 'rb') as source:
+        (tmp_path / 'restored.db').write_bytes(source.read())
+    assert count_users(str(tmp_path / 'restored.db')) == 10
+    assert [path.name for path in tmp_path.iterdir() if path.name.endswith('.partial')] == []
+
+
+def test_backups_started_within_a_second_keep_apart(sqlite_db: DatabaseManager, tmp_path) -> None:
+    settings = replace(get_settings(), backup_dir=str(tmp_path / 'backups'))
+    for _ in range(2):
+        BackupJob(get_database_provider().writers(), settings).run()
+
+    assert len(list((tmp_path / 'backups').iterdir())) == 2
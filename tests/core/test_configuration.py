@@ -0,0 +1,81 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+from datetime import timedelta
+
+import pytest
+
+from core.configuration import (add_reload_listener,
+                                get_settings,
+                                load_configuration,
+                                load_settings,
+                                reload_settings,
+                                remove_reload_listener)
+
+
+def write_config(path, **variables) -> str:
+    lines = ['[VARIABLES]'] + [f'{key}={value}' for key, value in variables.items()]
+    path.write_text('\n'.join(lines) + '\n')
+
+    return str(path)
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = tmp_path / '.env'
+
+    yield path
+
+    load_configuration()
+
+
+def test_load_settings(config_path) -> None:
+    settings = load_settings(write_config(config_path,
+                                          SECRET_KEY='secret',
+                                          AUTH_TOKEN_EXPIRY_PERIOD_IN_MINS=30,
+                                          VERIFICATION_TOKEN_EXPIRY_PERIOD_IN_MINS=1.5,
+                                          DB_POOL_SIZE=8))
+
+    assert settings.secret_key == 'secret'
+    assert settings.auth_token_expiry == timedelta(minutes=30)
+    assert settings.verification_token_expiry == timedelta(seconds=90)
+    assert settings.db_pool_size == 8
+
+
+@pytest.mark.parametrize('variables, message', [
+    ({'AUTH_TOKEN_EXPIRY_PERIOD_IN_MINS': 'soon'}, 'AUTH_TOKEN_EXPIRY_PERIOD_IN_MINS must be a number of minutes.'),
+    ({'VERIFICATION_TOKEN_EXPIRY_PERIOD_IN_MINS': 0},
+     'VERIFICATION_TOKEN_EXPIRY_PERIOD_IN_MINS must be greater than zero.'),
+    ({'DB_POOL_SIZE': 'many'}, 'DB_POOL_SIZE must be an integer.'),
+    ({'SECRET_KEY': ''}, 'SECRET_KEY must not be empty.'),
+])
+def test_load_invalid_settings(config_path, variables: dict, message: str) -> None:
+    with pytest.raises(ValueError, match=message):
+        load_settings(write_config(config_path, **variables))
+
+
+def test_reload_settings(config_path) -> None:
+    load_configuration(write_config(config_path, SECRET_KEY='before'))
+    previous = get_settings()
+    reloaded = []
+    add_reload_listener(reloaded.append)
+
+    write_config(config_path, SECRET_KEY='after')
+    settings = reload_settings()
+    remove_reload_listener(reloaded.append)
+
+    assert get_settings() is settings
+    assert settings.secret_key == 'after'
+    assert previous.secret_key == 'before'
+    assert reloaded == [settings]
+
+
+def test_reload_invalid_settings_keeps_current(config_path) -> None:
+    settings = load_configuration(write_config(config_path, SECRET_KEY='before'))
+
+    write_config(config_path, DB_POOL_SIZE=-1)
+    with pytest.raises(ValueError):
+        reload_settings()
+
+    assert get_settings() is settings
@@ -0,0 +1,91 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import time
+
+from core.authentication_service import authenticate, register
+from core.configuration import load_configuration
+from core.database_manager import DatabaseManager
+from core.dependencies import (build_email_filter, get_database_provider, start_email_filter_refresh,
+                               stop_email_filter_refresh)
+from core.email_filter import BloomFilter, EmailFilter
+from core.repositories import Database
+from core.schemas import UserIn
+from tests.core.test_configuration import write_config
+from tests.fixtures import user_data
+
+EMAILS = [f'user{index}@example.com' for index in range(1000)]
+
+
+def test_bloom_filter_has_no_false_negatives() -> None:
+    bloom_filter = BloomFilter(capacity=len(EMAILS), false_positive_rate=0.01)
+    for email in EMAILS:
+        bloom_filter.add(email)
+
+    assert all(email in bloom_filter for email in EMAILS)
+    false_positives = sum(f'other{index}@example.com' in bloom_filter for index in range(10000))
+    assert false_positives < 300
+    assert 0.005 < bloom_filter.estimated_false_positive_rate() < 0.02
+
+
+def test_rebuild_keeps_emails_added_while_reading() -> None:
+    emails = ['a@example.com']
+
+    def source():
+        yield from list(emails)
+        # Registered after the rebuild read the table.
+        email_filter.add('b@example.com')
+
+    email_filter = EmailFilter(source, false_positive_rate=0.01)
+    email_filter.rebuild()
+
+    assert email_filter.might_contain('A@example.com')
+    assert email_filter.might_contain('b@example.com')
+    assert not email_filter.might_contain('c@example.com')
+    assert email_filter.stats()['rebuilds'] == 1
+
+
+def test_unknown_emails_are_rejected_without_a_lookup(user_data: dict, db: Database) -> None:
+    email_filter = build_email_filter(get_database_provider())
+    assert register(data=dict(user_data), db=db)['status_code'] == 201
+
+    response = authenticate(data={'email': 'unknown@example.com', 'password': 'SecurePassword123'}, db=db)
+    assert response['status_code'] == 401
+    # Both the new registration and the unknown login were answered without a query.
+    assert email_filter.stats()['negatives'] == 2
+
+    response = register(data=dict(user_data), db=db)
+    assert response['message'] == 'Your request could not be processed. Please try again.'
+    assert authenticate(data={'email': user_data['email'], 'password': user_data['password']},
+                        db=db)['status_code'] == 403
+
+
+def test_users_written_elsewhere_are_known_after_a_rebuild(user_data: dict, db: Database) -> None:
+    email_filter = build_email_filter(get_database_provider())
+    # Written by another process: the filter was built before and never saw it.
+    db.user_repository.insert_user(UserIn.from_dict(dict(user_data, email=user_data['email'].lower())))
+    credentials = {'email': user_data['email'], 'password': user_data['password']}
+
+    assert authenticate(data=credentials, db=db)['status_code'] == 401
+    # The unique email index still turns the duplicate away.
+    assert register(data=dict(user_data), db=db)['status_code'] == 400
+
+    email_filter.rebuild()
+    assert authenticate(data=credentials, db=db)['status_code'] == 403
+
+
+def test_the_filter_is_refreshed_periodically(user_data: dict, sqlite_db: DatabaseManager, tmp_path) -> None:
+    load_configuration(write_config(tmp_path / '.env', EMAIL_FILTER_REFRESH_INTERVAL_IN_MINS=0.001))
+    email_filter = build_email_filter(get_database_provider())
+    assert start_email_filter_refresh()
+    try:
+        sqlite_db.user_repository.insert_user(UserIn.from_dict(dict(user_data, email=user_data['email'].lower())))
+        deadline = time.time() + 5
+        while not email_filter.might_contain(user_data['email']) and time.time() < deadline:
+            time.sleep(0.01)
+
+        assert email_filter.might_contain(user_data['email'])
+    finally:
+        stop_email_filter_refresh()
+        load_configuration()
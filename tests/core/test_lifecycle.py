@@ -0,0 +1,139 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+import httpx
+
+from core.lifecycle import LifecycleManager
+from core.server import ThreadingServiceHTTPServer, _hand_over
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Started by the SIGUSR2 handover in place of `python main.py`: it serves one request on the inherited socket.
+REPLACEMENT = f'''
+import sys
+sys.path.insert(0, {ROOT!r})
+from http.server import BaseHTTPRequestHandler
+from core.server import ServiceHTTPServer, create_server, notify_ready
+
+
+class ReplacementHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'replacement')
+
+    def log_message(self, format, *args):
+        pass
+
+
+httpd = create_server(ServiceHTTPServer, ReplacementHandler, ('localhost', 0))
+notify_ready()
+httpd.handle_request()
+httpd.server_close()
+'''
+
+
+class SlowRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        time.sleep(0.3)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'done')
+
+    def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+        pass
+
+
+def test_drain_waits_for_in_flight_requests() -> None:
+    lifecycle = LifecycleManager()
+    flushed = []
+    lifecycle.add_flush_callback(lambda: flushed.append(lifecycle.in_flight))
+    httpd = ThreadingServiceHTTPServer(('localhost', 0), SlowRequestHandler, lifecycle=lifecycle)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    responses = []
+    request = threading.Thread(
+        target=lambda: responses.append(httpx.get(f'http://localhost:{httpd.server_port}/')))
+    request.start()
+    while not lifecycle.in_flight:
+        time.sleep(0.01)
+
+    lifecycle.stop(httpd)
+    assert lifecycle.drain(timeout=5)
+    httpd.server_close()
+    request.join()
+
+    assert responses[0].status_code == 200
+    assert responses[0].text == 'done'
+    assert flushed == [0]
+
+
+def test_lifecycle_can_be_stopped_again_after_a_restart() -> None:
+    lifecycle = LifecycleManager()
+    for _ in range(2):
+        lifecycle.start()
+        httpd = ThreadingServiceHTTPServer(('localhost', 0), SlowRequestHandler, lifecycle=lifecycle)
+        serving = threading.Thread(target=httpd.serve_forever, daemon=True)
+        serving.start()
+
+        lifecycle.stop(httpd)
+        serving.join(timeout=5)
+        httpd.server_close()
+        assert not serving.is_alive()
+
+
+def test_drain_deadline() -> None:
+    lifecycle = LifecycleManager()
+
+    with lifecycle.track():
+        assert lifecycle.drain(timeout=0.05) is False
+
+    assert lifecycle.in_flight == 0
+    assert lifecycle.drain(timeout=0.05) is True
+
+
+def test_flush_callbacks_run_once() -> None:
+    lifecycle = LifecycleManager()
+    flushed = []
+    lifecycle.add_flush_callback(lambda: flushed.append('first server'))
+    lifecycle.flush()
+    lifecycle.add_flush_callback(lambda: flushed.append('second server'))
+    lifecycle.flush()
+
+    assert flushed == ['first server', 'second server']
+
+
+def test_handover_passes_the_listening_socket_to_the_replacement(tmp_path, monkeypatch) -> None:
+    script = tmp_path / 'replacement.py'
+    script.write_text(REPLACEMENT)
+    monkeypatch.setattr(sys, 'argv', [str(script)])
+    lifecycle = LifecycleManager()
+    httpd = ThreadingServiceHTTPServer(('localhost', 0), SlowRequestHandler, lifecycle=lifecycle)
+    serving = threading.Thread(target=httpd.serve_forever, daemon=True)
+    serving.start()
+
+    responses = []
+    request = threading.Thread(
+        target=lambda: responses.append(httpx.get(f'http://localhost:{httpd.server_port}/')))
+    request.start()
+    while not lifecycle.in_flight:
+        time.sleep(0.01)
+
+    _hand_over(httpd, timeout=10)
+    serving.join(timeout=5)
+    assert lifecycle.stopping.is_set() and not serving.is_alive()
+    httpd.socket.close()
+
+    # The old process drains the request it accepted; the port keeps answering through the replacement.
+    assert lifecycle.drain(timeout=5)
+    httpd.server_close()
+    request.join()
+    assert responses[0].text == 'done'
+    assert httpx.get(f'http://localhost:{httpd.server_port}/', timeout=5).text == 'replacement'
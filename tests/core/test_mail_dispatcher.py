@@ -0,0 +1,80 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import time
+from dataclasses import replace
+
+from core.configuration import get_settings
+from core.mail_dispatcher import MailDispatcher
+from core.repositories import Database
+from tests.helpers import LocalSMTPServer
+
+
+def enqueue(db: Database, count: int) -> None:
+    for index in range(count):
+        db.outbox_repository.enqueue(recipient=f'user{index}@example.com',
+                                     subject='Verify your email address',
+                                     body=f'message {index}',
+                                     send_after=int(time.time()))
+
+
+def test_dispatch_sends_batches_over_one_connection(db: Database) -> None:
+    enqueue(db, 5)
+
+    with LocalSMTPServer() as smtp_server:
+        settings = replace(get_settings(), smtp_host='localhost', smtp_port=smtp_server.server_address[1],
+                           outbox_batch_size=3)
+        dispatcher = MailDispatcher(settings)
+        assert dispatcher.dispatch_once() == 3
+        assert dispatcher.dispatch_once() == 2
+        assert dispatcher.dispatch_once() == 0
+
+    assert smtp_server.connections == 1
+    assert sorted(message['To'] for message in smtp_server.messages) == [f'user{i}@example.com' for i in range(5)]
+    assert db.outbox_repository.count_pending(max_attempts=settings.outbox_max_attempts) == 0
+
+
+def test_dispatch_retries_with_backoff(db: Database) -> None:
+    enqueue(db, 1)
+
+    with LocalSMTPServer() as smtp_server:
+        smtp_server.failures = 1
+        settings = replace(get_settings(), smtp_host='localhost', smtp_port=smtp_server.server_address[1],
+                           outbox_retry_backoff=30)
+        dispatcher = MailDispatcher(settings)
+        assert dispatcher.dispatch_once() == 0
+
+        # The failed message is not due again until its backoff has passed.
+        assert dispatcher.dispatch_once() == 0
+        now = int(time.time()) + 60
+        assert [message.attempts for message in db.outbox_repository.claim_due(
+            now=now, limit=10, max_attempts=settings.outbox_max_attempts, lease_until=0)] == [1]
+
+        assert dispatcher.dispatch_once() == 1
+        dispatcher.stop()
+
+    assert len(smtp_server.messages) == 1
+
+
+def test_unreachable_server_fails_whole_batch(db: Database) -> None:
+    enqueue(db, 3)
+    with LocalSMTPServer() as smtp_server:
+        port = smtp_server.server_address[1]
+
+    dispatcher = MailDispatcher(replace(get_settings(), smtp_host='localhost', smtp_port=port))
+    assert dispatcher.dispatch_once() == 0
+    assert db.outbox_repository.count_pending(max_attempts=1) == 0
+    assert db.outbox_repository.count_pending(max_attempts=2) == 3
+
+
+def test_stop_flushes_pending_messages(db: Database) -> None:
+    with LocalSMTPServer() as smtp_server:
+        settings = replace(get_settings(), smtp_host='localhost', smtp_port=smtp_server.server_address[1],
+                           outbox_poll_interval=60)
+        dispatcher = MailDispatcher(settings)
+        dispatcher.start()
+        enqueue(db, 2)
+        dispatcher.stop(timeout=5)
+
+    assert len(smtp_server.messages) == 2
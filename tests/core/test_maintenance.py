@@ -0,0 +1,69 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from core.database_manager import DatabaseManager
+from core.lifecycle import LifecycleManager
+from core.maintenance import MaintenanceScheduler, file_stats
+from core.repositories import Database
+from core.schemas import UserIn
+from tests.fixtures import new_user
+
+
+def test_truncating_checkpoint_empties_the_wal(new_user: UserIn, sqlite_db: DatabaseManager) -> None:
+    sqlite_db.user_repository.insert_user(new_user)
+    assert file_stats(sqlite_db.db_path)['wal_size_bytes'] > 0
+    # Per-table sizes walk every page, so they are left out unless asked for.
+    assert 'tables' not in file_stats(sqlite_db.db_path)
+
+    scheduler = MaintenanceScheduler(LifecycleManager())
+    scheduler.run_task('truncate')
+
+    stats = file_stats(sqlite_db.db_path, tables=True)
+    assert stats['wal_size_bytes'] == 0
+    assert 'users' in stats['tables'] and stats['freelist_pages'] == 0
+    assert scheduler.stats()['truncate']['runs'] == 1
+    assert scheduler.stats()['truncate']['last_result'] == {sqlite_db.db_path: (0, 0, 0)}
+
+
+@pytest.mark.usefixtures('sqlite_db')
+def test_tasks_wait_for_low_load() -> None:
+    lifecycle = LifecycleManager()
+    scheduler = MaintenanceScheduler(lifecycle)
+    # One minute after start, checkpoints are due; the others are not.
+    due = time.time() + 61
+
+    with lifecycle.track(), lifecycle.track(), lifecycle.track():
+        scheduler.run_due(now=due)
+        scheduler.run_due(now=due)
+    assert scheduler.stats()['checkpoint']['runs'] == 0
+    assert scheduler.stats()['checkpoint']['postponed'] == 1
+
+    scheduler.run_due(now=due)
+    assert scheduler.stats()['checkpoint']['runs'] == 1
+    assert scheduler.stats()['optimize']['runs'] == 0
+
+    # Overdue by a whole interval, a task runs even under load.
+    with lifecycle.track(), lifecycle.track(), lifecycle.track():
+        scheduler.run_due(now=due + 121)
+    assert scheduler.stats()['checkpoint']['runs'] == 2
+
+
+def test_expired_tokens_are_purged(new_user: UserIn, db: Database) -> None:
+    user_id = db.user_repository.insert_user(new_user)
+    expired = datetime.utcnow() - timedelta(minutes=1)
+    db.verification_repository.insert_verification_token(user_id=user_id, token='expired', expiry=expired)
+    db.auth_repository.insert_auth_token(user_id=user_id, token='expired', expiry=expired)
+    db.auth_repository.insert_auth_token(user_id=user_id, token='valid', expiry=expired + timedelta(days=1))
+
+    scheduler = MaintenanceScheduler(LifecycleManager())
+    scheduler.run_task('purge')
+
+    assert scheduler.stats()['purge']['last_result'] == {'verification_tokens': 1, 'auth_tokens': 1,
+                                                         'refresh_tokens': 0}
+    assert db.auth_repository.get_auth_token_user_by_id(user_id=user_id) == 'valid'
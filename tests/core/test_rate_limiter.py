@@ -0,0 +1,107 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import sqlite3
+
+import pytest
+from httpx import Client
+
+from core.configuration import load_configuration
+from core.helpers import forwarded_client
+from core.rate_limiter import BucketPolicy, MemoryBucketStore, SQLiteBucketStore, get_rate_limiter
+from tests.core.test_configuration import write_config
+
+POLICY = BucketPolicy(burst=3, per_second=0.5)
+
+
+def test_bucket_allows_a_burst_then_refills() -> None:
+    store = MemoryBucketStore(max_keys=10)
+
+    assert [store.take('ip:1', POLICY, now=100.0) for _ in range(3)] == [0, 0, 0]
+    assert store.take('ip:1', POLICY, now=100.0) == 2.0
+    assert store.take('ip:1', POLICY, now=102.0) == 0
+    assert store.take('ip:2', POLICY, now=102.0) == 0
+
+
+def test_memory_store_evicts_the_least_recently_used_bucket() -> None:
+    store = MemoryBucketStore(max_keys=2)
+    for key in ('a', 'b', 'a', 'c'):
+        store.take(key, POLICY, now=100.0)
+
+    assert len(store) == 2
+    # 'a' kept its state, while 'b' was evicted and starts over with a full bucket.
+    assert store.take('a', POLICY, now=100.0) == 0
+    assert store.take('a', POLICY, now=100.0) == 2.0
+    assert [store.take('b', POLICY, now=100.0) for _ in range(3)] == [0, 0, 0]
+
+
+def test_sqlite_store_is_shared_between_processes(tmp_path) -> None:
+    first = SQLiteBucketStore(str(tmp_path / 'rate_limits.db'), max_keys=10)
+    second = SQLiteBucketStore(str(tmp_path / 'rate_limits.db'), max_keys=10)
+    try:
+        assert first.take('email:a@example.com', POLICY, now=100.0) == 0
+        assert second.take('email:a@example.com', POLICY, now=100.0) == 0
+        assert first.take('email:a@example.com', POLICY, now=100.0) == 0
+        assert second.take('email:a@example.com', POLICY, now=100.0) == 2.0
+        assert len(first) == 1
+    finally:
+        first.close()
+        second.close()
+
+
+def test_login_attempts_are_throttled_per_email(client: Client, tmp_path) -> None:
+    load_configuration(write_config(tmp_path / '.env', RATE_LIMIT_EMAIL_BURST=2))
+    try:
+        credentials = {'email': 'throttled@example.com', 'password': 'SecurePassword123'}
+        assert [client.post('/login', json=credentials).status_code for _ in range(2)] == [401, 401]
+
+        response = client.post('/login', json=credentials)
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) >= 1
+
+        other = {'email': 'other@example.com', 'password': 'SecurePassword123'}
+        assert client.post('/login', json=other).status_code == 401
+    finally:
+        load_configuration()
+
+
+def test_replaced_sqlite_stores_are_closed(tmp_path) -> None:
+    load_configuration(write_config(tmp_path / '.env', RATE_LIMIT_STORE='sqlite',
+                                    RATE_LIMIT_DB_PATH=tmp_path / 'first.db'))
+    try:
+        first = get_rate_limiter()
+        load_configuration(write_config(tmp_path / '.env', RATE_LIMIT_STORE='sqlite',
+                                        RATE_LIMIT_DB_PATH=tmp_path / 'second.db'))
+        assert get_rate_limiter() is not first
+
+        with pytest.raises(sqlite3.ProgrammingError):
+            first.store.take('ip:1', POLICY, now=100.0)
+    finally:
+        load_configuration()
+
+
+def test_clients_behind_trusted_proxies_are_told_apart_by_x_forwarded_for() -> None:
+    trusted = ('10.0.0.1', 'unix')
+
+    assert forwarded_client('10.0.0.1', {'X-Forwarded-For': '198.51.100.7'}, trusted) == '198.51.100.7'
+    assert forwarded_client('', {'x-forwarded-for': '198.51.100.7'}, trusted) == '198.51.100.7'
+    # Only the hops appended by trusted proxies count; the client may have sent the rest.
+    assert forwarded_client('10.0.0.1', {'X-Forwarded-For': '1.1.1.1, 198.51.100.7, 10.0.0.1'},
+                            trusted) == '198.51.100.7'
+    assert forwarded_client('192.0.2.1', {'X-Forwarded-For': '198.51.100.7'}, trusted) == '192.0.2.1'
+    assert forwarded_client('', {'X-Forwarded-For': '198.51.100.7'}, ()) == ''
+    assert forwarded_client('10.0.0.1', {}, trusted) == ''
+
+
+def test_login_attempts_are_throttled_per_forwarded_client(client: Client, tmp_path) -> None:
+    load_configuration(write_config(tmp_path / '.env', TRUSTED_PROXIES='127.0.0.1', RATE_LIMIT_IP_BURST=2))
+    try:
+        def login(address: str, index: int) -> int:
+            return client.post('/login', json={'email': f'user{index}@example.com', 'password': 'SecurePassword123'},
+                               headers={'X-Forwarded-For': address}).status_code
+
+        assert [login('198.51.100.7', index) for index in range(3)] == [401, 401, 429]
+        assert [login('198.51.100.8', index) for index in range(2)] == [401, 401]
+    finally:
+        load_configuration()
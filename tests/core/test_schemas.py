@@ -0,0 +1,41 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import pytest
+
+from core.schemas import Credentials, User, UserIn
+from tests.fixtures import user_data
+
+
+def test_schemas_have_no_instance_dict(user_data: dict) -> None:
+    user_in = UserIn.from_dict(user_data)
+    user = User(id=1, email=user_in.email, first_name='John', last_name='Doe', email_verified=False)
+
+    assert not hasattr(user_in, '__dict__')
+    assert not hasattr(user, '__dict__')
+
+
+def test_from_dict_rejects_non_object() -> None:
+    with pytest.raises(ValueError, match='Request body must be a JSON object.'):
+        Credentials.from_dict(['example@example.com', 'password'])
+
+
+def test_credentials_with_null_email() -> None:
+    with pytest.raises(ValueError, match='Invalid email format: None'):
+        Credentials.from_dict({'email': None, 'password': 'SecurePassword123'})
+
+
+
+def test_validate_many(user_data: dict) -> None:
+    missing_password = {key: value for key, value in user_data.items() if key != 'password'}
+    invalid_email = dict(user_data, email='example@example')
+
+    results = UserIn.validate_many([user_data, missing_password, invalid_email])
+
+    assert len(results) == 3
+    user_in, error = results[0]
+    assert error is None
+    assert user_in.email == user_data['email']
+    assert results[1] == (None, 'Request is missing required key(s): password.')
+    assert results[2] == (None, 'Invalid email format: example@example')
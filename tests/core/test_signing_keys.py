@@ -0,0 +1,85 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import os
+
+import jwt
+import pytest
+
+from core.configuration import get_settings, load_configuration, reload_settings
+from core.helpers import decode_jwt
+from core.signing_keys import generate_key, get_key_ring
+from tests.core.test_configuration import write_config
+
+pytest.importorskip('cryptography')
+
+
+@pytest.fixture
+def key_dir(tmp_path):
+    yield tmp_path / 'keys'
+
+    load_configuration()
+
+
+def sign(user_id: int) -> str:
+    key = get_key_ring().active
+
+    return jwt.encode({'user_id': user_id, 'expiry': '2100-01-01T00:00:00'}, key.signing_key,
+                      algorithm=key.algorithm, headers={'kid': key.kid})
+
+
+@pytest.mark.parametrize('algorithm', ['EdDSA', 'RS256'])
+def test_tokens_are_signed_with_the_active_key(algorithm: str, key_dir, tmp_path) -> None:
+    kid = generate_key(str(key_dir), algorithm)
+    load_configuration(write_config(tmp_path / '.env', JWT_KEY_DIR=key_dir))
+
+    token = sign(1)
+
+    assert jwt.get_unverified_header(token) == {'alg': algorithm, 'kid': kid, 'typ': 'JWT'}
+    assert decode_jwt(f'Bearer {token}')[0] == 1
+    assert [key['kid'] for key in get_key_ring().jwks['keys']] == [kid]
+    assert 'd' not in get_key_ring().jwks['keys'][0]
+
+
+def test_rotated_keys_keep_verifying_until_removed(key_dir, tmp_path) -> None:
+    old_kid = generate_key(str(key_dir), 'EdDSA')
+    load_configuration(write_config(tmp_path / '.env', JWT_KEY_DIR=key_dir))
+    old_token = sign(1)
+
+    new_kid = generate_key(str(key_dir), 'EdDSA')
+    reload_settings()
+    new_token = sign(2)
+
+    assert jwt.get_unverified_header(new_token)['kid'] == new_kid != old_kid
+    assert decode_jwt(old_token)[0] == 1
+    assert decode_jwt(new_token)[0] == 2
+
+    os.remove(key_dir / f'{old_kid}.pem')
+    reload_settings()
+    with pytest.raises(jwt.InvalidTokenError):
+        decode_jwt(old_token)
+
+
+def test_tokens_signed_with_the_secret_key_are_rejected(key_dir, tmp_path) -> None:
+    generate_key(str(key_dir), 'EdDSA')
+    settings = load_configuration(write_config(tmp_path / '.env', JWT_KEY_DIR=key_dir))
+    token = jwt.encode({'user_id': 1, 'expiry': '2100-01-01T00:00:00'}, settings.secret_key, algorithm='HS256')
+
+    with pytest.raises(jwt.InvalidTokenError):
+        decode_jwt(token)
+
+
+@pytest.mark.parametrize('variables', [{'JWT_ACTIVE_KEY_ID': 'missing'}, {'JWT_KEY_DIR': 'missing-keys'}])
+def test_reloading_keys_that_do_not_load_keeps_the_current_ones(variables: dict, key_dir, tmp_path) -> None:
+    generate_key(str(key_dir), 'EdDSA')
+    settings = load_configuration(write_config(tmp_path / '.env', JWT_KEY_DIR=key_dir))
+    token = sign(1)
+
+    write_config(tmp_path / '.env', **{'JWT_KEY_DIR': key_dir, **variables})
+    with pytest.raises(ValueError):
+        reload_settings()
+
+    assert get_settings() is settings
+    assert decode_jwt(token)[0] == 1
+    assert decode_jwt(sign(2))[0] == 2
@@ -0,0 +1,101 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import threading
+from typing import List
+
+from core.single_flight import SingleFlight
+
+
+def run_concurrently(single_flight: SingleFlight, function, count: int, timeout: float = 5) -> List:
+    results: List = []
+
+    def call():
+        try:
+            results.append(single_flight.do('get_user_by_id:1', function, timeout=timeout))
+        except ValueError as exc:
+            results.append(exc)
+
+    threads = [threading.Thread(target=call) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def blocking(release: threading.Event, calls: List, result=None, error=None):
+    def function():
+        calls.append(1)
+        release.wait(5)
+        if error:
+            raise error
+        return result
+
+    return function
+
+
+def release_later(release: threading.Event, delay: float = 0.2) -> None:
+    # Gives every thread time to join the call before the leader returns.
+    threading.Timer(delay, release.set).start()
+
+
+def test_concurrent_calls_share_one_execution() -> None:
+    single_flight = SingleFlight()
+    release = threading.Event()
+    calls: List = []
+    release_later(release)
+
+    results = run_concurrently(single_flight, blocking(release, calls, result={'id': 1}), count=5)
+
+    assert len(calls) == 1
+    assert results == [{'id': 1}] * 5
+    stats = single_flight.stats()
+    assert stats['totals'] == {'executed': 1, 'shared': 4, 'timeouts': 0, 'errors': 0}
+    assert stats['kinds']['get_user_by_id']['shared'] == 4
+    assert stats['in_flight'] == 0
+
+
+def test_waiters_run_the_call_themselves_after_the_timeout() -> None:
+    single_flight = SingleFlight()
+    release = threading.Event()
+    calls: List = []
+    release_later(release, delay=0.5)
+
+    results = run_concurrently(single_flight, blocking(release, calls, result='user'), count=3, timeout=0.05)
+
+    assert results == ['user'] * 3
+    assert len(calls) == 3
+    assert single_flight.stats()['totals']['timeouts'] == 2
+
+
+def test_errors_are_shared_with_waiters() -> None:
+    single_flight = SingleFlight()
+    release = threading.Event()
+    calls: List = []
+    release_later(release)
+
+    results = run_concurrently(single_flight, blocking(release, calls, error=ValueError('database is locked')),
+                               count=3)
+
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    assert single_flight.stats()['totals']['errors'] == 1
+
+
+def test_results_are_not_cached() -> None:
+    single_flight = SingleFlight()
+
+    assert single_flight.do('a', lambda: 1) == 1
+    assert single_flight.do('a', lambda: 2) == 2
+
+
+def test_metrics_are_kept_per_kind_of_call() -> None:
+    single_flight = SingleFlight()
+    for token in ('first-token', 'second-token'):
+        single_flight.do(f'verify_email:{token}', lambda: None)
+
+    assert single_flight.stats()['kinds'] == {'verify_email': {'executed': 2, 'shared': 0, 'timeouts': 0,
+                                                               'errors': 0}}
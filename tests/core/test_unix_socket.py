@@ -0,0 +1,57 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import os
+import socket
+import stat
+
+import httpx
+import pytest
+
+from core.server import ServiceHTTPServer, create_unix_server
+from core.service_handler import ServiceRequestHandler
+from main import ServerThread, run
+
+
+def test_serves_on_a_unix_socket_next_to_tcp(tmp_path) -> None:
+    path = str(tmp_path / 'service.sock')
+    httpd = run(port=0, storage='memory', unix_socket=path, unix_socket_mode=0o600)
+    server_thread = ServerThread(httpd)
+    server_thread.start()
+    try:
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        with httpx.Client(transport=httpx.HTTPTransport(uds=path), base_url='http://localhost') as client:
+            assert client.get('/health-check').status_code == 200
+            # No client address over a Unix socket, so only the per-email rate limit applies.
+            response = client.post('/register', json={'email': 'unix@example.com', 'first_name': 'John',
+                                                      'last_name': 'Doe', 'password': 'SecurePassword123'})
+            assert response.status_code == 201
+        with httpx.Client(base_url=f'http://localhost:{httpd.server_port}') as client:
+            assert client.get('/health-check').status_code == 200
+    finally:
+        server_thread.stop_server()
+
+    assert not os.path.exists(path)
+
+
+def test_stale_sockets_are_replaced_but_live_ones_are_not(tmp_path) -> None:
+    path = str(tmp_path / 'service.sock')
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+
+    httpd = create_unix_server(ServiceHTTPServer, ServiceRequestHandler, path)
+    try:
+        with pytest.raises(OSError, match='Another server is listening'):
+            create_unix_server(ServiceHTTPServer, ServiceRequestHandler, path)
+        # The failed attempt left the live server's socket in place.
+        assert stat.S_ISSOCK(os.stat(path).st_mode)
+    finally:
+        httpd.server_close()
+
+    with open(path, 'w', encoding='utf-8'):
+        pass
+    with pytest.raises(OSError, match='is not a socket'):
+        create_unix_server(ServiceHTTPServer, ServiceRequestHandler, path)
+    assert os.path.exists(path)
@@ -3,13 +3,11 @@
 
 
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime
 
 import pytest
 
-from core.configuration import (AUTH_TOKEN_EXPIRY_PERIOD,
-                                SECRET_KEY,
-                                VERIFICATION_TOKEN_EXPIRY_PERIOD)
+from core.configuration import get_settings
 from core.schemas import UserIn
 
 
@@ -32,13 +30,14 @@ def user_data() -> dict:
 @pytest.fixture
 def new_verification_token():
     verification_token = str(uuid.uuid4())
-    expiry = datetime.utcnow() + timedelta(minutes=float(VERIFICATION_TOKEN_EXPIRY_PERIOD))
+    expiry = datetime.utcnow() + get_settings().verification_token_expiry
 
     return {'token': verification_token, 'expiry': expiry}
 
 
 @pytest.fixture
 def new_auth_token():
-    expiry = datetime.utcnow() + timedelta(minutes=float(AUTH_TOKEN_EXPIRY_PERIOD))
+    settings = get_settings()
+    expiry = datetime.utcnow() + settings.auth_token_expiry
 
-    return {'expiry': expiry, 'secret_key': SECRET_KEY, 'algorithm': 'HS256'}
+    return {'expiry': expiry, 'secret_key': settings.secret_key, 'algorithm': 'HS256'}
@@ -2,7 +2,16 @@
 # All rights reserved
 
 
+import email
 import re
+import socketserver
+import threading
+from email.message import Message
+from typing import List
+
+import jwt
+
+from core.signing_keys import get_key_ring
 
 
 def extract_token(message) -> str:
@@ -10,3 +19,63 @@ def extract_token(message) -> str:
     match = re.search(pattern, message)
 
     return match.group(1) if match else None
+
+
+def sign_token(user_id) -> str:
+    # Signed like the service's own access tokens, for any user_id claim.
+    key = get_key_ring().active
+
+    return jwt.encode({'user_id': user_id, 'expiry': '2100-01-01T00:00:00'}, key.signing_key,
+                      algorithm=key.algorithm, headers={'kid': key.kid} if key.kid else None)
+
+
+class _SMTPSession(socketserver.StreamRequestHandler):
+    def _reply(self, line: str) -> None:
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self) -> None:
+        server: LocalSMTPServer = self.server  # type: ignore
+        server.connections += 1
+        self._reply('220 localhost ready')
+        for raw in self.rfile:
+            command = raw.decode().strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self._reply('250 localhost')
+            elif command.startswith('DATA'):
+                self._reply('354 end data with <CR><LF>.<CR><LF>')
+                lines = []
+                for data in self.rfile:
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    lines.append(data.decode())
+                if server.failures:
+                    server.failures -= 1
+                    self._reply('451 try again later')
+                else:
+                    server.messages.append(email.message_from_string(''.join(lines)))
+                    self._reply('250 queued')
+            elif command.startswith('QUIT'):
+                self._reply('221 bye')
+                return
+            else:
+                self._reply('250 OK')
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    # Accepts every message and keeps it in memory; `failures` makes the next deliveries fail transiently.
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('localhost', 0), _SMTPSession)
+        self.messages: List[Message] = []
+        self.connections = 0
+        self.failures = 0
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -2,11 +2,15 @@
 # All rights reserved
 
 
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta
 
 import jwt
 
 from core.database_manager import DatabaseManager
+from core.dependencies import get_database_provider
+from core.helpers import to_epoch
 from core.schemas import InternalUser, UserIn, UserVerificationToken
 from tests.fixtures import new_auth_token, new_user, new_verification_token
 
@@ -54,8 +58,7 @@ def test_get_verification_token_by_token(new_user: UserIn, new_verification_toke
         token=new_verification_token['token'])
     assert token.token == new_verification_token['token']
 
-    expiry = datetime.strptime(token.expiry, '%Y-%m-%d %H:%M:%S.%f')
-    assert expiry == new_verification_token['expiry']
+    assert token.expiry == to_epoch(new_verification_token['expiry'])
 
 
 def test_get_verification_token_by_id(new_user: UserIn, new_verification_token: dict, db: DatabaseManager) -> None:
@@ -69,9 +72,7 @@ def test_get_verification_token_by_id(new_user: UserIn, new_verification_token:
         id_=token_id)
     assert verification_token.token == new_verification_token['token']
 
-    expiry = datetime.strptime(verification_token.expiry,
-                               '%Y-%m-%d %H:%M:%S.%f')
-    assert expiry == new_verification_token['expiry']
+    assert verification_token.expiry == to_epoch(new_verification_token['expiry'])
 
 
 def test_delete_verification_token(new_user: UserIn, new_verification_token: dict, db: DatabaseManager) -> None:
@@ -89,6 +90,65 @@ def test_delete_verification_token(new_user: UserIn, new_verification_token: dic
     assert token is None
 
 
+def test_redeem_verification_token(new_user: UserIn, new_verification_token: dict, db: DatabaseManager) -> None:
+    user = insert_user(new_user, db)
+    insert_verification_token(new_verification_token, user.id, db)
+    now = int(time.time())
+
+    verified_user = db.verification_repository.redeem_verification_token(token=new_verification_token['token'],
+                                                                         now=now)
+
+    assert verified_user.id == user.id
+    assert verified_user.email_verified is True
+    assert verified_user.version == user.version + 1
+    assert db.verification_repository.get_verification_token(token=new_verification_token['token']) is None
+    assert db.verification_repository.redeem_verification_token(token=new_verification_token['token'],
+                                                                now=now) is None
+
+
+def test_redeem_expired_verification_token(new_user: UserIn, new_verification_token: dict,
+                                           db: DatabaseManager) -> None:
+    user = insert_user(new_user, db)
+    insert_verification_token(new_verification_token, user.id, db)
+    after_expiry = to_epoch(new_verification_token['expiry']) + 1
+
+    assert db.verification_repository.redeem_verification_token(token=new_verification_token['token'],
+                                                                now=after_expiry) is None
+    assert db.verification_repository.get_verification_token(token=new_verification_token['token'])
+    assert db.user_repository.get_user_by_id(id_=user.id).email_verified is False
+
+
+def test_concurrent_redemptions_verify_once(new_user: UserIn, new_verification_token: dict,
+                                            db: DatabaseManager) -> None:
+    user = insert_user(new_user, db)
+    insert_verification_token(new_verification_token, user.id, db)
+    provider = get_database_provider()
+    results = []
+
+    def redeem():
+        with provider.connection() as connection:
+            results.append(connection.verification_repository.redeem_verification_token(
+                token=new_verification_token['token'], now=int(time.time())))
+
+    threads = [threading.Thread(target=redeem) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(result is not None for result in results) == 1
+    assert db.user_repository.get_user_by_id(id_=user.id).version == user.version + 1
+
+
+def test_get_credentials_by_email(new_user: UserIn, db: DatabaseManager) -> None:
+    user = insert_user(new_user, db)
+
+    credentials = db.user_repository.get_credentials_by_email(email=new_user.email.upper())
+
+    assert (credentials.id, credentials.password, credentials.email_verified) == (user.id, user.password, False)
+    assert db.user_repository.get_credentials_by_email(email='unknown@example.com') is None
+
+
 def test_insert_auth_token(new_user: UserIn, new_auth_token: dict, db: DatabaseManager) -> None:
     user = insert_user(new_user, db)
 
@@ -106,3 +166,42 @@ def test_get_auth_token_by_user_id(new_user: UserIn, new_auth_token: dict, db: D
         user.id)
 
     assert token == new_token
+
+
+def test_delete_expired_verification_tokens(new_user: UserIn, new_verification_token: dict,
+                                            db: DatabaseManager) -> None:
+    user = insert_user(new_user, db)
+    insert_verification_token(new_verification_token, user.id, db)
+
+    expiry = new_verification_token['expiry']
+    assert db.verification_repository.delete_expired_verification_tokens(before=expiry) == 0
+    assert db.verification_repository.delete_expired_verification_tokens(before=expiry + timedelta(seconds=1)) == 1
+    assert db.verification_repository.get_verification_token(token=new_verification_token['token']) is None
+
+
+def test_delete_expired_auth_tokens(new_user: UserIn, new_auth_token: dict, db: DatabaseManager) -> None:
+    user = insert_user(new_user, db)
+    insert_auth_token(new_auth_token, user.id, db)
+
+    expiry = new_auth_token['expiry']
+    assert db.auth_repository.delete_expired_auth_tokens(before=expiry) == 0
+    assert db.auth_repository.delete_expired_auth_tokens(before=datetime.utcnow() + timedelta(days=2)) == 1
+    assert db.auth_repository.get_auth_token_user_by_id(user.id) is None
+
+
+def test_refresh_token_rotation(new_user: UserIn, db: DatabaseManager) -> None:
+    user = insert_user(new_user, db)
+    expiry = datetime.utcnow() + timedelta(days=1)
+    first_id = db.refresh_repository.insert_refresh_token(user_id=user.id, token_hash='first', family_id='family',
+                                                          expiry=expiry)
+    db.refresh_repository.insert_refresh_token(user_id=user.id, token_hash='second', family_id='family',
+                                               expiry=expiry)
+
+    assert db.refresh_repository.revoke_refresh_token(id_=first_id) is True
+    assert db.refresh_repository.revoke_refresh_token(id_=first_id) is False
+    assert db.refresh_repository.get_refresh_token(token_hash='first').revoked is True
+
+    assert db.refresh_repository.revoke_refresh_token_family(family_id='family', user_id=user.id) == 1
+    assert db.refresh_repository.get_refresh_token(token_hash='second').revoked is True
+    assert db.refresh_repository.delete_expired_refresh_tokens(before=expiry + timedelta(seconds=1)) == 2
+    assert db.refresh_repository.get_refresh_token(token_hash='first') is None
@@ -0,0 +1,78 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import sqlite3
+import threading
+
+import pytest
+
+from core.database_manager import BusyPolicy, DatabaseBusyError, DatabaseManager, get_lock_stats
+from core.dependencies import get_db
+from core.schemas import UserIn
+from tests.fixtures import new_user
+
+
+def test_reads_use_a_read_only_connection(sqlite_db: DatabaseManager) -> None:
+    assert sqlite_db.reader is sqlite_db.read_only_db
+    assert sqlite_db.db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    with pytest.raises(sqlite3.OperationalError):
+        sqlite_db.reader.execute("DELETE FROM users")
+
+
+def test_reads_do_not_wait_for_writes(new_user: UserIn, sqlite_db: DatabaseManager) -> None:
+    user_id = sqlite_db.user_repository.insert_user(new_user)
+
+    with sqlite_db.transaction():
+        new_user.email = 'other@example.com'
+        other_id = sqlite_db.user_repository.insert_user(new_user)
+        # The transaction sees its own insert through the writer ...
+        assert sqlite_db.user_repository.get_user_by_id(id_=other_id)
+
+        # ... while readers elsewhere keep reading the last committed state without waiting for the write lock.
+        with get_db() as db:
+            assert db.user_repository.get_user_by_id(id_=user_id)
+            assert db.user_repository.get_user_by_id(id_=other_id) is None
+
+    with get_db() as db:
+        assert db.user_repository.get_user_by_id(id_=other_id)
+
+
+def hold_write_lock(db_path: str) -> sqlite3.Connection:
+    # Another process writing to the same file, which the manager's own writer lock does not cover.
+    connection = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    connection.execute('BEGIN IMMEDIATE')
+
+    return connection
+
+
+def test_writes_retry_while_another_connection_holds_the_lock(new_user: UserIn, tmp_path) -> None:
+    db_path = str(tmp_path / 'busy.db')
+    db = DatabaseManager(db_path, busy_policy=BusyPolicy(timeout=0.01, retries=10, backoff=0.02))
+    retries = get_lock_stats().snapshot()['busy_retries']
+    other = hold_write_lock(db_path)
+    threading.Timer(0.1, other.rollback).start()
+
+    user_id = db.user_repository.insert_user(new_user)
+
+    assert db.user_repository.get_user_by_id(id_=user_id)
+    assert get_lock_stats().snapshot()['busy_retries'] > retries
+    other.close()
+    db.close()
+
+
+def test_writes_fail_once_the_retries_are_exhausted(new_user: UserIn, tmp_path) -> None:
+    db_path = str(tmp_path / 'busy.db')
+    db = DatabaseManager(db_path, busy_policy=BusyPolicy(timeout=0.01, retries=2, backoff=0.01))
+    failures = get_lock_stats().snapshot()['busy_failures']
+    other = hold_write_lock(db_path)
+
+    with pytest.raises(DatabaseBusyError):
+        db.user_repository.insert_user(new_user)
+
+    assert get_lock_stats().snapshot()['busy_failures'] == failures + 1
+    other.rollback()
+    assert db.user_repository.insert_user(new_user)
+    other.close()
+    db.close()
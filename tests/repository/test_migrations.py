@@ -0,0 +1,60 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from core.database_manager import SCHEMA_VERSION, DatabaseManager
+from core.helpers import to_epoch
+from core.schemas import UserIn
+from tests.fixtures import new_user
+
+LEGACY_SCHEMA = '''
+CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE, first_name TEXT NOT NULL,
+                    last_name TEXT NOT NULL, password TEXT NOT NULL, email_verified BOOLEAN NOT NULL);
+CREATE TABLE verification_tokens (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL UNIQUE,
+                                  token TEXT NOT NULL, expiry DATETIME NOT NULL);
+CREATE TABLE auth_tokens (token TEXT NOT NULL, user_id INTEGER NOT NULL, expiry DATETIME NOT NULL);
+'''
+
+
+@pytest.fixture
+def legacy_db_path(tmp_path) -> str:
+    db_path = str(tmp_path / 'legacy.db')
+    expiry = datetime(2030, 1, 2, 3, 4, 5, 678901)
+    db = sqlite3.connect(db_path)
+    db.executescript(LEGACY_SCHEMA)
+    db.execute("INSERT INTO users VALUES (1, 'legacy@example.com', 'John', 'Doe', 'hash', True)")
+    db.execute("INSERT INTO verification_tokens VALUES (1, 1, 'token', ?)", (str(expiry),))
+    db.execute("INSERT INTO auth_tokens VALUES ('jwt', 1, ?)", (str(expiry),))
+    db.commit()
+    db.close()
+
+    return db_path
+
+
+def test_legacy_database_migration(legacy_db_path: str) -> None:
+    db = DatabaseManager(legacy_db_path)
+
+    assert db.db.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+    expiry = to_epoch(datetime(2030, 1, 2, 3, 4, 5))
+    assert db.verification_repository.get_verification_token(token='token').expiry == expiry
+    assert db.db.execute('SELECT expiry, typeof(expiry) FROM auth_tokens').fetchone() == (expiry, 'integer')
+    assert db.user_repository.get_user_by_id(id_=1).email_verified is True
+    assert db.user_repository.get_user_by_id(id_=1).version == 1
+    db.close()
+
+
+def test_email_uniqueness_ignores_case(new_user: UserIn, tmp_path) -> None:
+    db = DatabaseManager(str(tmp_path / 'users.db'))
+    db.user_repository.insert_user(new_user)
+
+    new_user.email = new_user.email.upper()
+    with pytest.raises(ValueError):
+        db.user_repository.insert_user(new_user)
+
+    assert db.user_repository.get_internal_user_by_email(email=new_user.email) is not None
+    db.close()
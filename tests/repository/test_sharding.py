@@ -0,0 +1,155 @@
+# Copyright 2024 Ableton
+# All rights reserved
+
+
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+import pytest
+
+from core.authentication_service import authenticate, refresh_access_token, register, verify_email
+from core.database_manager import DatabaseManager
+from core.dependencies import ShardedDatabasePool, use_database
+from core.schemas import UserIn
+from core.shard_rebalance import rebalance
+from core.sharding import BUCKET_COUNT, email_bucket, id_bucket, shard_index, shard_paths
+from tests.fixtures import user_data
+from tests.helpers import extract_token
+
+EMAILS = [f'user{index}@example.com' for index in range(20)]
+
+
+@pytest.fixture
+def sharded_pool(tmp_path):
+    pool = ShardedDatabasePool(str(tmp_path / 'users.db'), shard_count=3)
+    previous = use_database(pool)
+
+    yield pool
+
+    use_database(previous)
+    pool.clear()
+
+
+def insert_users(pool: ShardedDatabasePool) -> dict:
+    with pool.connection() as db:
+        return {email: db.user_repository.insert_user(UserIn(email=email, first_name='John', last_name='Doe',
+                                                             password='SecurePassword123'))
+                for email in EMAILS}
+
+
+def test_users_are_routed_by_email(sharded_pool: ShardedDatabasePool) -> None:
+    ids = insert_users(sharded_pool)
+
+    assert len(set(ids.values())) == len(EMAILS)
+    assert all(id_ % BUCKET_COUNT == email_bucket(email) for email, id_ in ids.items())
+
+    with sharded_pool.connection() as db:
+        assert db.user_repository.get_internal_user_by_email('USER3@example.com').id == ids['user3@example.com']
+        assert db.user_repository.get_user_by_id(ids['user7@example.com']).email == 'user7@example.com'
+        assert len(db.user_repository.get_users_by_ids(list(ids.values()))) == len(EMAILS)
+        assert sorted(user.email for user in db.user_repository.iter_users()) == sorted(EMAILS)
+
+    counts = []
+    for path in shard_paths(sharded_pool.db_path, 3):
+        db = DatabaseManager(path)
+        counts.append(db.db.execute('SELECT COUNT(*) FROM users').fetchone()[0])
+        db.close()
+    assert sum(counts) == len(EMAILS) and all(counts)
+
+
+def test_tokens_follow_their_user(sharded_pool: ShardedDatabasePool) -> None:
+    ids = insert_users(sharded_pool)
+    user_id = ids['user5@example.com']
+
+    with sharded_pool.connection() as db, db.transaction():
+        token_id = db.verification_repository.insert_verification_token(user_id, 'token', expiry=datetime.utcnow())
+
+    assert token_id % BUCKET_COUNT == user_id % BUCKET_COUNT
+    with sharded_pool.connection() as db:
+        assert db.verification_repository.get_verification_token('token').user_id == user_id
+        db.verification_repository.delete_verification_token('token')
+        assert db.verification_repository.get_verification_token('token') is None
+
+
+def test_shard_count_mismatch_is_rejected(sharded_pool: ShardedDatabasePool) -> None:
+    with pytest.raises(ValueError):
+        ShardedDatabasePool(sharded_pool.db_path, shard_count=2)
+
+
+def test_rebalance(sharded_pool: ShardedDatabasePool) -> None:
+    ids = insert_users(sharded_pool)
+    sharded_pool.clear()
+
+    # A WAL left behind by an earlier layout must not be replayed over the new shard taking its path.
+    stale_wal = shard_paths(sharded_pool.db_path, 5)[4] + '-wal'
+    with open(stale_wal, 'wb') as wal:
+        wal.write(b'stale')
+
+    copied = rebalance(sharded_pool.db_path, shard_count=5)
+    assert copied['users'] == len(EMAILS)
+    for path in shard_paths(sharded_pool.db_path, 5):
+        assert not os.path.exists(f'{path}-wal') and not os.path.exists(f'{path}.rebalance')
+    for path in shard_paths(sharded_pool.db_path, 3):
+        assert not os.path.exists(f'{path}.bak-wal')
+        backup = sqlite3.connect(f'{path}.bak')
+        try:
+            assert backup.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+        finally:
+            backup.close()
+
+    pool = ShardedDatabasePool(sharded_pool.db_path, shard_count=5)
+    with pool.connection() as db:
+        for email, id_ in ids.items():
+            assert db.user_repository.get_user_by_id(id_).email == email
+        # Sequences moved with their buckets, so new ids do not collide with existing ones.
+        new_id = db.user_repository.insert_user(UserIn(email='new@example.com', first_name='John', last_name='Doe',
+                                                       password='SecurePassword123'))
+        assert new_id not in ids.values()
+    pool.clear()
+
+
+def test_authentication_flow_is_shard_transparent(user_data: dict, sharded_pool: ShardedDatabasePool) -> None:
+    with sharded_pool.connection() as db:
+        response = register(data=user_data, db=db)
+    assert response['status_code'] == 201
+
+    with sharded_pool.connection() as db:
+        token = extract_token(response['message'])
+        assert verify_email(query_params={'token': token}, db=db)['status_code'] == 200
+
+    with sharded_pool.connection() as db:
+        tokens = authenticate(data={'email': user_data['email'], 'password': user_data['password']}, db=db)['data']
+
+    with sharded_pool.connection() as db:
+        response = refresh_access_token(data={'refresh_token': tokens['refresh_token']}, db=db)
+    assert response['status_code'] == 200
+
+
+def test_refresh_token_reuse_only_locks_the_users_shard(user_data: dict, sharded_pool: ShardedDatabasePool) -> None:
+    with sharded_pool.connection() as db:
+        verify_email(query_params={'token': extract_token(register(data=user_data, db=db)['message'])}, db=db)
+    with sharded_pool.connection() as db:
+        tokens = authenticate(data={'email': user_data['email'], 'password': user_data['password']}, db=db)['data']
+        user_id = db.user_repository.get_credentials_by_email(email=user_data['email']).id
+    with sharded_pool.connection() as db:
+        rotated = refresh_access_token(data={'refresh_token': tokens['refresh_token']}, db=db)['data']
+
+    responses = []
+
+    def replay() -> None:
+        with sharded_pool.connection() as db:
+            responses.append(refresh_access_token(data={'refresh_token': tokens['refresh_token']}, db=db))
+
+    # Another request writing to a different shard holds that shard's writer for the whole replay.
+    other = (shard_index(id_bucket(user_id), 3) + 1) % 3
+    with sharded_pool.writers()[shard_paths(sharded_pool.db_path, 3)[other]].lock:
+        thread = threading.Thread(target=replay)
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+
+    assert responses[0]['status_code'] == 401
+    with sharded_pool.connection() as db:
+        assert refresh_access_token(data={'refresh_token': rotated['refresh_token']}, db=db)['status_code'] == 401
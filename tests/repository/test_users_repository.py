@@ -2,6 +2,8 @@
 # All rights reserved
 
 
+from datetime import datetime
+
 from core.database_manager import DatabaseManager
 from core.schemas import UserIn
 from tests.fixtures import new_user
@@ -63,3 +65,49 @@ def test_get_user_by_invalid_email(new_user: UserIn, db: DatabaseManager) -> Non
 
     user = db.user_repository.get_internal_user_by_email(email=invalid_email)
     assert user is None
+
+
+def test_iter_users(new_user: UserIn, db: DatabaseManager) -> None:
+    emails = [f'user{index}@example.com' for index in range(5)]
+    for email in emails:
+        db.user_repository.insert_user(UserIn(email=email,
+                                              first_name=new_user.first_name,
+                                              last_name=new_user.last_name,
+                                              password=new_user.password))
+
+    users = list(db.user_repository.iter_users(batch_size=2))
+
+    assert [user.email for user in users] == emails
+    assert all(user.email_verified is False for user in users)
+
+
+def test_failed_transaction_is_rolled_back(new_user: UserIn, db: DatabaseManager) -> None:
+    try:
+        with db.transaction():
+            user_id = db.user_repository.insert_user(new_user)
+            db.outbox_repository.enqueue(recipient=new_user.email, subject='subject', body='body', send_after=0)
+            db.verification_repository.insert_verification_token(user_id=user_id, token='token',
+                                                                 expiry=datetime.utcnow())
+            db.user_repository.insert_user(new_user)
+    except ValueError:
+        pass
+
+    assert db.user_repository.get_internal_user_by_email(email=new_user.email) is None
+    assert db.verification_repository.get_verification_token(token='token') is None
+    assert db.outbox_repository.count_pending(max_attempts=1) == 0
+    assert db.user_repository.insert_user(new_user)
+
+
+def test_get_users_by_ids(new_user: UserIn, db: DatabaseManager) -> None:
+    user_id = db.user_repository.insert_user(new_user)
+
+    users = db.user_repository.get_users_by_ids([user_id, user_id + 1])
+    assert [user.email for user in users] == [new_user.email]
+
+
+def test_verify_user_bumps_version(new_user: UserIn, db: DatabaseManager) -> None:
+    user_id = db.user_repository.insert_user(new_user)
+    assert db.user_repository.get_user_by_id(id_=user_id).version == 1
+
+    db.user_repository.verify_user(id_=user_id)
+    assert db.user_repository.get_user_by_id(id_=user_id).version == 2